@@ -0,0 +1,800 @@
+#! /usr/bin/python
+
+"""
+    InfluxDB data exploration and checking: benchmark
+    Copyright (C) 2019 Francesco Melchiori
+    <https://www.francescomelchiori.com/>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import os
+import argparse
+import json
+import re
+import time
+import random
+import hashlib
+import tempfile
+import zlib
+import socket
+import threading
+import urlparse
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import influxdb_explorer
+
+
+# engine arguments of every case, 'max_row_limit' setting the one of the
+# stand-in server; the check results of the first case are the reference
+# of the others
+benchmark_cases = [
+    ('single_fetch', {}),
+    ('batch_fetch', {'query_mode': 'batch'}),
+    ('single_pushdown', {'check_mode': 'pushdown'}),
+    ('single_stream', {'check_mode': 'stream', 'chunk_size': 100}),
+    ('batch_pushdown_packed', {'query_mode': 'batch',
+                               'check_mode': 'pushdown',
+                               'pack_size': 20}),
+    ('workers_pushdown_packed', {'check_mode': 'pushdown',
+                                 'pack_size': 20,
+                                 'workers': 8}),
+    ('async_pushdown', {'check_mode': 'pushdown',
+                        'connections': 16}),
+    ('processes_pushdown_packed', {'check_mode': 'pushdown',
+                                   'pack_size': 20,
+                                   'processes': 2}),
+    ('batch_rollup_packed', {'query_mode': 'batch',
+                             'check_mode': 'rollup',
+                             'pack_size': 20}),
+    ('batch_fetch_paged', {'query_mode': 'batch',
+                           'max_rows': 20}),
+    ('batch_fetch_row_limited', {'query_mode': 'batch',
+                                 'max_row_limit': 7}),
+    ('batch_pushdown_row_limited', {'query_mode': 'batch',
+                                    'check_mode': 'pushdown',
+                                    'pack_size': 20,
+                                    'max_row_limit': 7}),
+    ('batch_rollup_row_limited', {'query_mode': 'batch',
+                                  'check_mode': 'rollup',
+                                  'pack_size': 20,
+                                  'max_row_limit': 7})]
+
+
+class InfluxDBStandIn:
+    """
+        series: {(<database>, <measurement>): [(host, test, transaction)]}
+        latency: seconds waited before answering every request
+        step: seconds between two points of the same series
+        failure_rate: share of points whose state is not 'ok'
+        error_rate: share of requests answered with http 500
+        history: seconds of points every series holds
+        max_row_limit: max number of points of a not chunked response,
+                       the series cut by it being 'partial' and the
+                       following ones dropped, as influxdb does (0: none)
+        the '<measurement>_<feature>_rollup' measurements are rolled up
+        from the points of every complete minute, whatever the continuous
+        queries created
+    """
+    def __init__(self, series=None, latency=0.0, step=60, failure_rate=0.3,
+                 error_rate=0.0, history=2*24*60*60, max_row_limit=0):
+        self.series = series if series else {}
+        self.latency = latency
+        self.step = step
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.history = history
+        self.max_row_limit = max_row_limit
+        self.counters = {}
+        self.counters_lock = threading.Lock()
+        self.reset_counters()
+
+    def __repr__(self):
+        print_message = 'Series: {0}\n'.format(
+            sum([len(series_names) for series_names in self.series.values()]))
+        print_message += 'Latency: {0}s\n'.format(self.latency)
+        print_message += 'Step: {0}s\n'.format(self.step)
+        print_message += 'Failure rate: {0}\n'.format(self.failure_rate)
+        print_message += 'Error rate: {0}\n'.format(self.error_rate)
+        print_message += 'Max row limit: {0}\n'.format(self.max_row_limit)
+        return print_message
+
+    def reset_counters(self):
+        with self.counters_lock:
+            self.counters = {'requests': 0,
+                             'queries': 0,
+                             'errors': 0,
+                             'bytes_in': 0,
+                             'bytes_out': 0}
+        return self.counters
+
+    def count(self, counter_name, counter_value=1):
+        with self.counters_lock:
+            self.counters[counter_name] += counter_value
+        return True
+
+    def load_check_map(self, check_map):
+        for customer_data in check_map['customers']:
+            for data_source in customer_data['data_sources']:
+                for database in data_source['databases']:
+                    for measurement in database['measurements']:
+                        series_names = self.series.setdefault(
+                            (database['database'],
+                             measurement['measurement']), [])
+                        for host in measurement['hosts']:
+                            for test in host['tests']:
+                                for transaction in test['transactions']:
+                                    series_names.append((
+                                        host['host'],
+                                        test['test_name'],
+                                        transaction['transaction_name']))
+        return self.series
+
+    def get_state(self, series_name, timestamp):
+        point_hash = hashlib.md5('{0}{1}'.format(series_name,
+                                                 timestamp)).hexdigest()
+        if int(point_hash[:8], 16) % 1000 < self.failure_rate * 1000:
+            return 'ko'
+        return 'ok'
+
+    def run_statement(self, database, statement, epoch, now):
+        self.count('queries')
+        if statement.strip().upper().startswith('CREATE'):
+            return {}
+        if into_pattern.search(statement):
+            # rolled up when queried
+            return {'series': [{'name': 'result',
+                                'columns': ['time', 'written'],
+                                'values': [[get_timestamp(0, epoch), 0]]}]}
+        statement_match = statement_pattern.match(statement.strip())
+        if not statement_match:
+            return {'error': 'error parsing query: {0}'.format(statement)}
+        features = [feature.strip() for feature
+                    in statement_match.group('features').split(',')]
+        measurement = statement_match.group('measurement').strip('"')
+        rollup_time = None
+        rollup_feature = None
+        if measurement.endswith('_rollup'):
+            measurement, rollup_feature = measurement[:-len('_rollup')] \
+                .rsplit('_', 1)
+            rollup_time = (now // 60) * 60
+        where = statement_match.group('where') or ''
+        selection = parse_selection(where, now)
+        time_from = parse_time_from(where, now, now - self.history)
+        time_to = parse_time_to(where, now)
+        groups = [group.strip() for group
+                  in (statement_match.group('groups') or '').split(',')
+                  if group.strip()]
+        order_desc = (statement_match.group('order') or '').upper() == 'DESC'
+        limit = int(statement_match.group('limit') or 0)
+        offset = int(statement_match.group('offset') or 0)
+        aggregate_match = aggregate_pattern.match(features[0])
+        if rollup_feature and not aggregate_match:
+            return {'error': 'only sum() of the rollup is supported'}
+        grouped_points = {}
+        for series_name in self.series.get((database, measurement), []):
+            series_tags = dict(zip(['host', 'test_name', 'transaction_name'],
+                                   series_name))
+            if not selection(dict(series_tags, time=time_to - 1,
+                                  state='ok')) and \
+                    not selection(dict(series_tags, time=time_to - 1,
+                                       state='ko')):
+                continue
+            points = []
+            timestamp = (time_to // self.step) * self.step
+            while timestamp > time_from:
+                point = dict(series_tags, time=timestamp,
+                             state=self.get_state(series_name, timestamp),
+                             performance=1000, warning_threshold=2000,
+                             critical_threshold=3000)
+                if rollup_feature and (
+                        point['time'] >= rollup_time or
+                        (aggregate_match.group(2) == 'ok' and
+                         point[rollup_feature] != 'ok')):
+                    # minute not rolled up yet, or not an 'ok' point
+                    pass
+                elif selection(point):
+                    points.append(point)
+                    if limit and order_desc and not groups and \
+                            not aggregate_match and \
+                            len(points) >= offset + limit:
+                        break
+                timestamp -= self.step
+            if points:
+                group_key = tuple([(group, series_tags[group])
+                                   for group in groups])
+                grouped_points.setdefault(group_key, []).extend(points)
+        influxdb_series_list = []
+        for group_key, points in sorted(grouped_points.items()):
+            points.sort(key=lambda point: point['time'], reverse=order_desc)
+            if aggregate_match:
+                columns = ['time', aggregate_match.group(3) or
+                           aggregate_match.group(1).lower()]
+                values = [[get_timestamp(time_from, epoch), len(points)]]
+            else:
+                if features == ['*']:
+                    features = ['critical_threshold', 'host', 'performance',
+                                'state', 'test_name', 'transaction_name',
+                                'warning_threshold']
+                columns = ['time'] + [feature for feature in features
+                                      if feature != 'time']
+                if not set(columns) & set(['performance', 'state',
+                                           'warning_threshold',
+                                           'critical_threshold']):
+                    # no field selected: no series
+                    continue
+                points = points[offset:]
+                if limit:
+                    points = points[:limit]
+                values = [[get_timestamp(point['time'], epoch)] +
+                          [point.get(column) for column in columns[1:]]
+                          for point in points]
+            influxdb_series = {'name': measurement,
+                               'columns': columns,
+                               'values': values}
+            if group_key:
+                influxdb_series['tags'] = dict(group_key)
+            influxdb_series_list.append(influxdb_series)
+        influxdb_result = {}
+        if influxdb_series_list:
+            influxdb_result['series'] = influxdb_series_list
+        return influxdb_result
+
+    def run_query(self, query_params):
+        database = query_params.get('db', [''])[0]
+        query = query_params.get('q', [''])[0]
+        epoch = query_params.get('epoch', [''])[0]
+        now = int(time.time())
+        influxdb_results = []
+        for statement_id, statement in enumerate(
+                [statement for statement in query.split(';')
+                 if statement.strip()]):
+            influxdb_result = self.run_statement(database, statement, epoch,
+                                                 now)
+            influxdb_result['statement_id'] = statement_id
+            influxdb_results.append(influxdb_result)
+        return influxdb_results
+
+    def limit_rows(self, influxdb_results):
+        if not self.max_row_limit:
+            return influxdb_results
+        influxdb_rows = 0
+        for result_index, influxdb_result in enumerate(influxdb_results):
+            influxdb_series_list = influxdb_result.get('series', [])
+            for series_index, influxdb_series in enumerate(
+                    influxdb_series_list):
+                rows_left = self.max_row_limit - influxdb_rows
+                if rows_left < len(influxdb_series['values']):
+                    influxdb_series['values'] = \
+                        influxdb_series['values'][:rows_left]
+                    influxdb_series['partial'] = True
+                influxdb_rows += len(influxdb_series['values'])
+                if influxdb_rows >= self.max_row_limit:
+                    del influxdb_series_list[series_index + 1:]
+                    return influxdb_results[:result_index + 1]
+        return influxdb_results
+
+
+statement_pattern = re.compile(
+    r"SELECT\s+(?P<features>.+?)\s+FROM\s+(?P<measurement>\S+)"
+    r"(?:\s+WHERE\s+(?P<where>.+?))?"
+    r"(?:\s+GROUP BY\s+(?P<groups>.+?))?"
+    r"(?:\s+ORDER BY time\s+(?P<order>ASC|DESC))?"
+    r"(?:\s+LIMIT\s+(?P<limit>\d+))?"
+    r"(?:\s+OFFSET\s+(?P<offset>\d+))?\s*$", re.I | re.S)
+aggregate_pattern = re.compile(r"(count|sum)\((\w+)\)(?:\s+AS\s+(\w+))?",
+                               re.I)
+into_pattern = re.compile(r"\sINTO\s", re.I)
+selection_token_pattern = re.compile(
+    r"\s*(\(|\)|AND\b|OR\b"
+    r"|time\s*[<>]=?\s*now\(\)(?:\s*-\s*\d+[smhd])?"
+    r"|time\s*[<>]=?\s*\d+s"
+    r"|\w+\s*=\s*'[^']*')", re.I)
+time_units = {'s': 1, 'm': 60, 'h': 60*60, 'd': 60*60*24}
+
+
+def parse_time_bound(token, now):
+    time_match = re.match(r"time\s*([<>]=?)\s*now\(\)"
+                          r"(?:\s*-\s*(\d+)([smhd]))?", token)
+    if time_match:
+        time_offset = int(time_match.group(2) or 0) * \
+            time_units[time_match.group(3) or 's']
+        return time_match.group(1), now - time_offset
+    time_match = re.match(r"time\s*([<>]=?)\s*(\d+)s", token)
+    if time_match:
+        return time_match.group(1), int(time_match.group(2))
+    return None, None
+
+
+def parse_time_from(where, now, default_time_from):
+    time_from = default_time_from
+    for token in selection_token_pattern.findall(where):
+        time_operator, time_bound = parse_time_bound(token.strip(), now)
+        if time_operator in ('>', '>='):
+            time_from = max(time_from, time_bound - 1)
+    return time_from
+
+
+def parse_time_to(where, now):
+    time_to = now
+    for token in selection_token_pattern.findall(where):
+        time_operator, time_bound = parse_time_bound(token.strip(), now)
+        if time_operator == '<':
+            time_to = min(time_to, time_bound)
+        elif time_operator == '<=':
+            time_to = min(time_to, time_bound + 1)
+    return time_to
+
+
+def parse_selection(where, now):
+    """
+        where: influxql condition made of time bounds, tag = 'value'
+               comparisons, AND, OR and parentheses
+        return: function telling if a point matches the condition
+    """
+    tokens = []
+    token_position = 0
+    where = where.strip()
+    while token_position < len(where):
+        token_match = selection_token_pattern.match(where, token_position)
+        if not token_match:
+            raise ValueError('where clause not supported: {0}'.format(
+                where[token_position:]))
+        tokens.append(token_match.group(1).strip())
+        token_position = token_match.end()
+    tokens.append(None)
+    token_index = [0]
+
+    def compare(point_time, time_operator, time_bound):
+        return {'>': point_time > time_bound,
+                '<': point_time < time_bound,
+                '>=': point_time >= time_bound,
+                '<=': point_time <= time_bound}[time_operator]
+
+    def parse_term():
+        token = tokens[token_index[0]]
+        token_index[0] += 1
+        if token == '(':
+            term = parse_any()
+            token_index[0] += 1
+            return term
+        time_operator, time_bound = parse_time_bound(token, now)
+        if time_operator:
+            return lambda point: compare(point['time'], time_operator,
+                                         time_bound)
+        tag_name, tag_value = re.match(r"(\w+)\s*=\s*'([^']*)'",
+                                       token).groups()
+        return lambda point: point.get(tag_name) == tag_value
+
+    def parse_all():
+        term = parse_term()
+        while tokens[token_index[0]] and \
+                tokens[token_index[0]].upper() == 'AND':
+            token_index[0] += 1
+            term = (lambda first_term, second_term: lambda point:
+                    first_term(point) and second_term(point))(
+                term, parse_term())
+        return term
+
+    def parse_any():
+        term = parse_all()
+        while tokens[token_index[0]] and \
+                tokens[token_index[0]].upper() == 'OR':
+            token_index[0] += 1
+            term = (lambda first_term, second_term: lambda point:
+                    first_term(point) or second_term(point))(
+                term, parse_all())
+        return term
+
+    if not where:
+        return lambda point: True
+    return parse_any()
+
+
+def get_timestamp(timestamp, epoch):
+    if epoch:
+        return timestamp
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+class InfluxDBStandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes: no delayed ack stall
+    disable_nagle_algorithm = True
+
+    def log_message(self, *log_args):
+        pass
+
+    def do_GET(self):
+        request_url = urlparse.urlparse(self.path)
+        self.reply_query(urlparse.parse_qs(request_url.query))
+
+    def do_POST(self):
+        request_body = self.rfile.read(int(self.headers.get(
+            'Content-Length', 0)))
+        self.server.stand_in.count('bytes_in', len(request_body))
+        request_url = urlparse.urlparse(self.path)
+        query_params = urlparse.parse_qs(request_url.query)
+        query_params.update(urlparse.parse_qs(request_body))
+        self.reply_query(query_params)
+
+    def reply_query(self, query_params):
+        stand_in = self.server.stand_in
+        stand_in.count('requests')
+        stand_in.count('bytes_in', len(self.path))
+        if stand_in.latency:
+            time.sleep(stand_in.latency)
+        if stand_in.error_rate and random.random() < stand_in.error_rate:
+            stand_in.count('errors')
+            self.reply_body(500, json.dumps({'error': 'stand-in error'}))
+            return
+        influxdb_results = stand_in.run_query(query_params)
+        if query_params.get('chunked', [''])[0] == 'true':
+            chunk_size = int(query_params.get('chunk_size', ['10000'])[0])
+            self.reply_chunks(influxdb_results, chunk_size)
+        else:
+            influxdb_results = stand_in.limit_rows(influxdb_results)
+            self.reply_body(200, json.dumps({'results': influxdb_results}))
+
+    def accept_gzip(self):
+        return 'gzip' in self.headers.get('Accept-Encoding', '')
+
+    def reply_body(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if self.accept_gzip():
+            body_compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                               16 + zlib.MAX_WBITS)
+            body = body_compressor.compress(body) + body_compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.stand_in.count('bytes_out', len(body))
+
+    def reply_chunks(self, influxdb_results, chunk_size):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        body_compressor = None
+        if self.accept_gzip():
+            body_compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                               16 + zlib.MAX_WBITS)
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        try:
+            for influxdb_result in influxdb_results:
+                for response_line in get_result_chunks(influxdb_result,
+                                                       chunk_size):
+                    if body_compressor:
+                        response_line = body_compressor.compress(
+                            response_line) + body_compressor.flush(
+                            zlib.Z_SYNC_FLUSH)
+                    self.write_chunk(response_line)
+            if body_compressor:
+                self.write_chunk(body_compressor.flush())
+            self.wfile.write('0\r\n\r\n')
+        except Exception:
+            # the client stopped reading
+            self.close_connection = 1
+
+    def write_chunk(self, response_chunk):
+        if response_chunk:
+            self.wfile.write('{0:x}\r\n{1}\r\n'.format(len(response_chunk),
+                                                      response_chunk))
+            self.server.stand_in.count('bytes_out', len(response_chunk))
+
+
+def get_result_chunks(influxdb_result, chunk_size):
+    result_chunks = []
+    for influxdb_series in influxdb_result.get('series', []):
+        values = influxdb_series['values']
+        for value_index in range(0, len(values), chunk_size):
+            series_chunk = dict(influxdb_series, values=values[
+                value_index:value_index + chunk_size])
+            if value_index + chunk_size < len(values):
+                series_chunk['partial'] = True
+            result_chunks.append(series_chunk)
+    if not result_chunks:
+        result_chunks.append(None)
+    for chunk_index, series_chunk in enumerate(result_chunks):
+        result_chunk = {'statement_id': influxdb_result['statement_id']}
+        if 'error' in influxdb_result:
+            result_chunk['error'] = influxdb_result['error']
+        if series_chunk is not None:
+            result_chunk['series'] = [series_chunk]
+        if chunk_index < len(result_chunks) - 1:
+            result_chunk['partial'] = True
+        yield json.dumps({'results': [result_chunk]}) + '\n'
+
+
+class InfluxDBStandInServer(SocketServer.ThreadingMixIn,
+                            BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, stand_in, ip='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (ip, port),
+                                           InfluxDBStandInHandler)
+        self.stand_in = stand_in
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+    def start(self):
+        server_thread = threading.Thread(target=self.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return self.server_address
+
+
+def make_check_map(data_source_ip_port, customers=10, hosts=5, tests=2,
+                   transactions=5, sanity_period=60, measure_unit='minutes',
+                   availability_mode=''):
+    """
+        availability_mode: availability mode of every check, with its
+                           default thresholds ('': at_least_one_ok)
+    """
+    check_availability = {
+        'check_name': 'check_feature_availability',
+        'feature_name': 'state',
+        'measure_unit': measure_unit,
+        'sanity_period': sanity_period}
+    if availability_mode:
+        check_availability['availability_mode'] = availability_mode
+    check_map = {'customers': []}
+    for customer_index in range(customers):
+        customer_name = 'customer_{0}'.format(customer_index)
+        check_hosts = []
+        for host_index in range(hosts):
+            check_tests = []
+            for test_index in range(tests):
+                check_transactions = []
+                for transaction_index in range(transactions):
+                    check_transactions.append({
+                        'transaction_name': 'transaction_{0}'.format(
+                            transaction_index),
+                        'checks': [dict(check_availability)]})
+                check_tests.append({
+                    'test_name': 'test_{0}'.format(test_index),
+                    'transactions': check_transactions})
+            check_hosts.append({
+                'host': 'host_{0}'.format(host_index),
+                'tests': check_tests})
+        check_map['customers'].append({
+            'customer_name': customer_name,
+            'data_sources': [{
+                'data_source_name': 'influxdb',
+                'data_source_ip_port': data_source_ip_port,
+                'databases': [{
+                    'database': customer_name,
+                    'measurements': [{
+                        'measurement': 'alyvix',
+                        'hosts': check_hosts}]}]}]})
+    return check_map
+
+
+def get_peak_memory():
+    if resource is None:
+        return None
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_benchmark_case(json_path, engine_args, benchmark_results):
+    start_memory = get_peak_memory()
+    start_time = time.time()
+    engine_args = dict(engine_args)
+    processes = engine_args.pop('processes', 1)
+    if processes > 1:
+        engine = influxdb_explorer.CheckEngine(**engine_args)
+        customers_checks = influxdb_explorer.ShardedCustomersInfluxDBChecks(
+            json_path=json_path, verbose_level=1, engine=engine,
+            processes=processes)
+    elif 'connections' in engine_args:
+        engine = influxdb_explorer.AsyncCheckEngine(**engine_args)
+        customers_checks = influxdb_explorer.AsyncCustomersInfluxDBChecks(
+            json_path=json_path, verbose_level=1, engine=engine)
+    else:
+        engine = influxdb_explorer.CheckEngine(**engine_args)
+        customers_checks = influxdb_explorer.CustomersInfluxDBChecks(
+            json_path=json_path, verbose_level=1, engine=engine)
+    customers_checks.run_customers_checks()
+    wall_time = time.time() - start_time
+    check_results = [customer_checks.check_result for customer_checks
+                     in customers_checks.customers_checks]
+    series_results = [check.check_result for customer_checks
+                      in customers_checks.customers_checks
+                      for check in customer_checks.check_sequence]
+    benchmark_results.put({'wall_time': wall_time,
+                           'start_memory': start_memory,
+                           'peak_memory': get_peak_memory(),
+                           'check_results': check_results,
+                           'series_results': series_results})
+
+
+def run_benchmark(customers=10, hosts=5, tests=2, transactions=5,
+                  sanity_period=60, measure_unit='minutes', latency=0.0,
+                  step=60, failure_rate=0.3, error_rate=0.0, max_row_limit=0,
+                  availability_mode='', cases=None):
+    """
+        cases: [<list_of_benchmark_case_names_to_run>] (None: all)
+        max_row_limit: max-row-limit of the stand-in server, for the
+                       cases not setting their own
+        return: [<list_of_(case_name, benchmark_result)>], every result
+                telling if its checks match the ones of the first case
+    """
+    stand_in = InfluxDBStandIn(latency=latency, step=step,
+                               failure_rate=failure_rate,
+                               error_rate=error_rate,
+                               max_row_limit=max_row_limit)
+    server = InfluxDBStandInServer(stand_in)
+    server_ip, server_port = server.start()
+    check_map = make_check_map('{0}:{1}'.format(server_ip, server_port),
+                               customers, hosts, tests, transactions,
+                               sanity_period, measure_unit,
+                               availability_mode)
+    stand_in.load_check_map(check_map)
+    json_file, json_path = tempfile.mkstemp(suffix='_check_map.json')
+    os.write(json_file, json.dumps(check_map))
+    os.close(json_file)
+    benchmark_results = []
+    reference_results = None
+    try:
+        for case_name, engine_args in benchmark_cases:
+            if cases and case_name not in cases:
+                continue
+            engine_args = dict(engine_args)
+            stand_in.max_row_limit = engine_args.pop('max_row_limit',
+                                                     max_row_limit)
+            stand_in.reset_counters()
+            case_results = multiprocessing.Queue()
+            # a process per case: its own peak memory, no warm cache
+            case_process = multiprocessing.Process(
+                target=run_benchmark_case,
+                args=(json_path, engine_args, case_results))
+            case_process.start()
+            case_process.join()
+            if case_results.empty():
+                benchmark_result = {'error': case_process.exitcode}
+            else:
+                benchmark_result = case_results.get()
+                if reference_results is None:
+                    reference_results = benchmark_result['series_results']
+                benchmark_result['same_results'] = \
+                    benchmark_result.pop('series_results') == \
+                    reference_results
+            benchmark_result.update(stand_in.counters)
+            benchmark_results.append((case_name, benchmark_result))
+    finally:
+        server.shutdown()
+        os.remove(json_path)
+        if os.path.isfile('{0}.cache'.format(json_path)):
+            os.remove('{0}.cache'.format(json_path))
+    return benchmark_results
+
+
+def print_benchmark(benchmark_results, checks_count):
+    print_message = '\n'
+    print_message += 'Benchmark ({0} checks)\n'.format(checks_count)
+    print_message += '---------\n\n'
+    print_message += '{0:<28}{1:>10}{2:>10}{3:>10}{4:>12}{5:>12}' \
+                     '{6:>10}{7:>10}\n'.format(
+                         'case', 'wall [s]', 'requests', 'queries', 'bytes',
+                         'peak [KB]', 'worst', 'results')
+    for case_name, benchmark_result in benchmark_results:
+        if 'error' in benchmark_result:
+            print_message += '{0:<28}failed, exit code {1}\n'.format(
+                case_name, benchmark_result['error'])
+            continue
+        # worst customer result, as the plugin exits with
+        worst_result = influxdb_explorer.get_error_label(
+            max(benchmark_result['check_results']))
+        print_message += '{0:<28}{1:>10.3f}{2:>10}{3:>10}{4:>12}' \
+                         '{5:>12}{6:>10}{7:>10}\n'.format(
+                             case_name,
+                             benchmark_result['wall_time'],
+                             benchmark_result['requests'],
+                             benchmark_result['queries'],
+                             benchmark_result['bytes_out'],
+                             benchmark_result['peak_memory'],
+                             worst_result,
+                             'same' if benchmark_result['same_results']
+                             else 'differ')
+    print(print_message)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--customers',
+                        help='set how many customers the check map holds')
+    parser.add_argument('--hosts',
+                        help='set how many hosts every customer holds')
+    parser.add_argument('--tests',
+                        help='set how many tests every host holds')
+    parser.add_argument('--transactions',
+                        help='set how many transactions every test holds')
+    parser.add_argument('--sanity_period',
+                        help='set the sanity period of every check, '
+                             'in minutes')
+    parser.add_argument('--latency',
+                        help='set the seconds the stand-in server waits '
+                             'before answering')
+    parser.add_argument('--step',
+                        help='set the seconds between two points of a '
+                             'series')
+    parser.add_argument('--failure_rate',
+                        help="set the share of points not 'ok'")
+    parser.add_argument('--error_rate',
+                        help='set the share of requests answered with '
+                             'http 500')
+    parser.add_argument('--max_row_limit',
+                        help='set how many points a not chunked response '
+                             'of the stand-in server holds at most')
+    parser.add_argument('--availability_mode',
+                        help='set the availability mode of every check')
+    parser.add_argument('--cases',
+                        help='set the comma separated benchmark cases to '
+                             'run: {0}'.format(', '.join(
+                                 [case_name for case_name, engine_args
+                                  in benchmark_cases])))
+    parser.add_argument('--json_output',
+                        help='save the benchmark results as json')
+
+    args = parser.parse_args()
+    customers = int(args.customers) if args.customers else 10
+    hosts = int(args.hosts) if args.hosts else 5
+    tests = int(args.tests) if args.tests else 2
+    transactions = int(args.transactions) if args.transactions else 5
+    sanity_period = int(args.sanity_period) if args.sanity_period else 60
+    latency = float(args.latency) if args.latency else 0.0
+    step = int(args.step) if args.step else 60
+    failure_rate = float(args.failure_rate) if args.failure_rate else 0.3
+    error_rate = float(args.error_rate) if args.error_rate else 0.0
+    max_row_limit = int(args.max_row_limit) if args.max_row_limit else 0
+    availability_mode = args.availability_mode \
+        if args.availability_mode else ''
+    cases = args.cases.split(',') if args.cases else None
+    benchmark_results = run_benchmark(customers=customers,
+                                      hosts=hosts,
+                                      tests=tests,
+                                      transactions=transactions,
+                                      sanity_period=sanity_period,
+                                      latency=latency,
+                                      step=step,
+                                      failure_rate=failure_rate,
+                                      error_rate=error_rate,
+                                      max_row_limit=max_row_limit,
+                                      availability_mode=availability_mode,
+                                      cases=cases)
+    print_benchmark(benchmark_results,
+                    customers * hosts * tests * transactions)
+    if args.json_output:
+        influxdb_explorer.save_json(args.json_output,
+                                    dict(benchmark_results))
+
+
+if __name__ == '__main__':
+    main()
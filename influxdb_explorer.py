@@ -55,12 +55,35 @@
     ddddddddddddddddddddddddddhhhhhhhhhhhhhhhhhyyyyyyyhhhhhhhhyyhysosssy
 """
 
+import time
+# taken before the other imports, to report them with --profile_startup
+module_start_time = time.time()
 import sys
 import os
-import argparse
+import stat
 import json
 import urllib
 import urllib2
+import httplib
+import socket
+import select
+import errno
+import threading
+import Queue
+import itertools
+import collections
+import heapq
+import hashlib
+import marshal
+import zlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+# argparse, multiprocessing and numpy are imported where needed, numpy
+# (the availability modes only) being most of the import time
+numpy = None
+numpy_imported = False
 
 
 error_level = {'OK': 0,
@@ -68,6 +91,199 @@ error_level = {'OK': 0,
                'CRITICAL': 2,
                'UNKNOWN': 3}
 
+# default thresholds of the availability modes computing a metric over
+# every point of the sanity period
+availability_modes = {
+    'at_least_one_ok': None,
+    # percentage of 'ok' points, the lower the worse
+    'availability_ratio': {'availability_warning': 90,
+                           'availability_critical': 50,
+                           'lower_is_worse': True},
+    # longest seconds of consecutive not 'ok' points
+    'longest_outage': {'availability_warning': 600,
+                       'availability_critical': 1800,
+                       'lower_is_worse': False},
+    # consecutive not 'ok' points up to the latest one
+    'last_failures': {'availability_warning': 1,
+                      'availability_critical': 3,
+                      'lower_is_worse': False}}
+
+
+class CheckMapIndex:
+    """
+        json_path: check map compiled into customer indexed influxdb data
+                   and flattened check lists, cached in
+                   '<json_path>.cache' until the json file changes, every
+                   customer loaded from it when first needed
+    """
+    cache_version = 4
+
+    def __init__(self, json_path=''):
+        self.json_path = json_path if json_path else 'check_map.json'
+        self.cache_path = '{0}.cache'.format(self.json_path)
+        self.file_key = (None, None)
+        self.file_hash = ''
+        self.customer_names = []
+        self.customers = {}
+        self.cache_offsets = {}
+        self.cache_items = None
+        self.load_check_map_index()
+
+    def __repr__(self):
+        print_message = "JSON path: '{0}'\n".format(self.json_path)
+        print_message += "Cache path: '{0}'\n".format(self.cache_path)
+        print_message += "JSON hash: '{0}'\n".format(self.file_hash)
+        print_message += 'Customers: {0}\n'.format(
+            len(self.customer_names))
+        return print_message
+
+    def get_file_key(self):
+        try:
+            file_stat = os.stat(self.json_path)
+        except OSError:
+            print('error | json file opening issue')
+            exit(error_level['UNKNOWN'])
+            return False
+        return file_stat.st_mtime, file_stat.st_size
+
+    def is_fresh(self):
+        return self.file_key == self.get_file_key()
+
+    def load_check_map_index(self):
+        file_key = self.get_file_key()
+        self.file_key = file_key
+        check_map_cache, cache_items = self.load_cache()
+        if check_map_cache and check_map_cache['file_key'] == file_key:
+            self.set_check_map_index(check_map_cache, cache_items)
+            return True
+        try:
+            json_file = open(self.json_path, 'rb')
+            json_text = json_file.read()
+            json_file.close()
+        except IOError:
+            print('error | json file opening issue')
+            exit(error_level['UNKNOWN'])
+            return False
+        file_hash = hashlib.md5(json_text).hexdigest()
+        if check_map_cache and check_map_cache['file_hash'] == file_hash:
+            # touched but not changed
+            self.set_check_map_index(check_map_cache, cache_items)
+            for customer_name in self.customer_names:
+                self.get_customer_index(customer_name)
+            self.file_key = file_key
+        else:
+            try:
+                check_map = json.loads(json_text)
+            except ValueError:
+                print('error | json file loading issue')
+                exit(error_level['UNKNOWN'])
+                return False
+            self.file_hash = file_hash
+            self.set_check_map_index(self.compile_check_map(check_map))
+        self.save_cache()
+        return True
+
+    def load_cache(self):
+        check_map_cache, cache_items = load_marshal_items(self.cache_path)
+        if check_map_cache is None or \
+                check_map_cache.get('cache_version') != self.cache_version:
+            return None, None
+        return check_map_cache, cache_items
+
+    def save_cache(self):
+        # read-only json folder: keep the index in memory only
+        return save_marshal_items(self.cache_path,
+                                 {'cache_version': self.cache_version,
+                                  'file_key': self.file_key,
+                                  'file_hash': self.file_hash,
+                                  'customer_names': self.customer_names},
+                                 self.customers)
+
+    def set_check_map_index(self, check_map_cache, cache_items=None):
+        """
+            cache_items: marshalled customers of the cache, loaded by
+                         get_customer_index
+        """
+        self.file_key = check_map_cache['file_key']
+        self.file_hash = check_map_cache['file_hash']
+        self.customer_names = check_map_cache['customer_names']
+        self.customers = check_map_cache.get('customers', {})
+        self.cache_offsets = check_map_cache.get('item_offsets', {})
+        self.cache_items = cache_items
+        return True
+
+    def compile_check_map(self, check_map):
+        customer_names = []
+        customers = {}
+        for customer_data in check_map['customers']:
+            customer_name = customer_data['customer_name']
+            customer_names.append(customer_name)
+            customer_index = {'check_map': customer_data,
+                              'influxdb': None,
+                              'checks': []}
+            for data_source in customer_data['data_sources']:
+                if data_source['data_source_name'] == 'influxdb':
+                    customer_index['influxdb'] = data_source
+            if customer_index['influxdb']:
+                customer_index['checks'] = self.compile_checks(
+                    customer_index['influxdb'])
+            customers[customer_name] = customer_index
+        return {'cache_version': self.cache_version,
+                'file_key': self.file_key,
+                'file_hash': self.file_hash,
+                'customer_names': customer_names,
+                'customers': customers}
+
+    def compile_checks(self, influxdb_data_source):
+        checks = []
+        data_source_ip_port = influxdb_data_source['data_source_ip_port']
+        data_source_ip = data_source_ip_port.split(':')[0]
+        data_source_port = data_source_ip_port.split(':')[1]
+        for database in influxdb_data_source['databases']:
+            database_name = database['database']
+            for measurement in database['measurements']:
+                measurement_name = measurement['measurement']
+                for host in measurement['hosts']:
+                    host_name = host['host']
+                    for test in host['tests']:
+                        test_name = test['test_name']
+                        for transaction in test['transactions']:
+                            transaction_name = transaction['transaction_name']
+                            for check in transaction['checks']:
+                                check_name = check['check_name']
+                                check_feature = [
+                                    data_source_ip,
+                                    data_source_port,
+                                    database_name,
+                                    measurement_name,
+                                    host_name,
+                                    test_name,
+                                    transaction_name]
+                                check_options = {}
+                                if check_name == 'check_feature_availability':
+                                    check_feature.append(check['feature_name'])
+                                    check_feature.append(check['measure_unit'])
+                                    check_feature.append(check['sanity_period'])
+                                    check_options = dict(
+                                        (option_name, check[option_name])
+                                        for option_name
+                                        in CheckRecord.option_names
+                                        if option_name in check)
+                                checks.append((check_name, check_feature,
+                                               check_options))
+        return checks
+
+    def get_customer_index(self, customer_name):
+        if customer_name not in self.customers:
+            if customer_name not in self.cache_offsets:
+                raise DataNotFound(data_name=customer_name,
+                                   source_name='customers')
+            step_start = time.time()
+            self.customers[customer_name] = load_marshal_item(
+                self.cache_offsets, self.cache_items, customer_name)
+            startup_timings.add_timing('check map', step_start)
+        return self.customers[customer_name]
+
 
 class CustomerData:
     def __init__(self, customer_name, json_path=''):
@@ -89,10 +305,9 @@ class CustomerData:
         if not self.json_path:
             self.json_path = 'check_map.json'
             # self.json_path = '{0}_check_map.json'.format(self.customer_name)
-        check_map = load_json(self.json_path)
-        for customer_data in check_map['customers']:
-            if customer_data['customer_name'] == self.customer_name:
-                self.check_map = customer_data
+        self.check_map_index = get_check_map_index(self.json_path)
+        self.check_map = self.check_map_index.get_customer_index(
+            self.customer_name)['check_map']
         if not self.check_map:
             raise DataNotFound(data_name=self.customer_name,
                                source_name='customers')
@@ -116,11 +331,12 @@ class CustomerInfluxDBData(CustomerData):
         return print_message
 
     def load_influxdb_check_map(self):
-        for data_source in self.check_map['data_sources']:
-            if data_source['data_source_name'] == 'influxdb':
-                self.data_source_name = data_source['data_source_name']
-                self.data_source_ip_port = data_source['data_source_ip_port']
-                self.databases = data_source['databases']
+        data_source = self.check_map_index.get_customer_index(
+            self.customer_name)['influxdb']
+        if data_source:
+            self.data_source_name = data_source['data_source_name']
+            self.data_source_ip_port = data_source['data_source_ip_port']
+            self.databases = data_source['databases']
         if not self.data_source_name:
             raise DataNotFound(data_name='influxdb',
                                source_name='data_sources')
@@ -128,37 +344,32 @@ class CustomerInfluxDBData(CustomerData):
 
 
 class CustomerInfluxDBCheck(CustomerInfluxDBData):
-    def __init__(self, customer_name, json_path='', verbose_level=1):
+    """
+        check_status: check results saved by a previous run, loaded
+                      instead of planning the checks again
+        the checks are only planned, run_checks queries influxdb
+    """
+    def __init__(self, customer_name, json_path='', verbose_level=1,
+                 engine=None, check_status=None):
         CustomerInfluxDBData.__init__(self, customer_name, json_path)
         self.verbose_level = verbose_level
+        self.engine = engine if engine else CheckEngine()
         self.data_source_ip = self.data_source_ip_port.split(':')[0]
         self.data_source_port = self.data_source_ip_port.split(':')[1]
         self.check_sequence = []
-        self.get_check_sequence()
-        self.run_check_sequence()
         self.check_result = error_level['UNKNOWN']
-        self.analyze_check_results()
+        self.checks_done = False
+        if check_status:
+            self.load_check_status(check_status)
+        else:
+            self.get_check_sequence()
 
     def __repr__(self):
-
-        def get_check_indexed_value(check_to_index, check_key):
-            return check_to_index[self.check_sequence[0].index(
-                check_key)]
-
-        def get_check_indexed_detail_value(check_to_index,
-                                           check_detail_key=None):
-            if not check_detail_key:
-                return check_to_index[1][:]
-            else:
-                return check_to_index[1][self.check_sequence[0][1].index(
-                    check_detail_key)]
-
         print_message = ''
         if self.verbose_level in (1, 2):
             error_label = get_error_label(self.check_result)
-            first_check = self.check_sequence[1]
-            database_name = get_check_indexed_detail_value(
-                first_check, 'database_name')
+            first_check = self.check_sequence[0]
+            database_name = first_check.database_name
             print_message += "{0}: {1} ".format(error_label, database_name)
             if error_label == 'OK':
                 print_message += "checks are healthy. Enjoy the hindu calm."
@@ -170,142 +381,2899 @@ class CustomerInfluxDBCheck(CustomerInfluxDBData):
                 self.check_result)
         if self.verbose_level == 2:
             print_message += " | "
-            for check in self.check_sequence[1:]:
-                host_name = get_check_indexed_detail_value(
-                    check, 'host_name')
-                test_name = get_check_indexed_detail_value(
-                    check, 'test_name')
-                transaction_name = get_check_indexed_detail_value(
-                    check, 'transaction_name')
-                check_result = get_check_indexed_value(
-                    check, 'check_result')
+            for check in self.check_sequence:
                 print_message += "'{0}_{1}_{2}'={3};1;2;; ".format(
-                    host_name,
-                    test_name,
-                    transaction_name,
-                    check_result)
+                    check.host_name,
+                    check.test_name,
+                    check.transaction_name,
+                    check.check_result)
         if self.verbose_level >= 3:
             print_message += '\n'
             print_message += 'Check results:\n'
-            for check in self.check_sequence[1:]:
-                error_label = get_error_label(get_check_indexed_value(
-                    check, 'check_result'))
-                check_name = get_check_indexed_value(
-                    check, 'check_name')
-                print_message += '[ {0} '.format(error_label)
-                print_message += '| {0} '.format(check_name)
-                for feature in get_check_indexed_detail_value(check):
-                    print_message += '| {0} '.format(feature)
-                print_message += ']\n'
+            for check in self.check_sequence:
+                print_message += get_check_line(check) + '\n'
+        if self.verbose_level >= 4:
+            print_message += 'Query timings: | '
+            print_message += self.get_query_timings_perfdata() + '\n'
         return print_message
 
+    def get_query_timings_perfdata(self):
+        perfdata = ''
+        query_timings = self.get_query_timings()
+        for data_source in sorted(query_timings.keys()):
+            for database, timing in sorted(
+                    query_timings[data_source].items()):
+                timing_label = '{0}_{1}'.format(data_source, database)
+                perfdata += "'{0}_requests'={1}c;;;; " \
+                            "'{0}_queries'={2}c;;;; ".format(
+                                timing_label,
+                                timing['requests'],
+                                timing['queries'])
+                for timing_name in QueryTimings.timing_names[2:-1]:
+                    perfdata += "'{0}_{1}'={2:.6f}s;;;; ".format(
+                        timing_label, timing_name, timing[timing_name])
+                perfdata += "'{0}_response_bytes'={1}B;;;; ".format(
+                    timing_label, timing['response_bytes'])
+        return perfdata
+
     def get_check_sequence(self):
-        check_header = []
-        check_headed = False
-        for database in self.databases:
-            database_name = database['database']
-            for measurement in database['measurements']:
-                measurement_name = measurement['measurement']
-                for host in measurement['hosts']:
-                    host_name = host['host']
-                    for test in host['tests']:
-                        test_name = test['test_name']
-                        for transaction in test['transactions']:
-                            transaction_name = transaction['transaction_name']
-                            for check in transaction['checks']:
-                                check_name = check['check_name']
-                                check_feature = [
-                                    self.data_source_ip,
-                                    self.data_source_port,
-                                    database_name,
-                                    measurement_name,
-                                    host_name,
-                                    test_name,
-                                    transaction_name]
-                                if check_name == 'check_feature_availability':
-                                    check_feature.append(check['feature_name'])
-                                    check_feature.append(check['measure_unit'])
-                                    check_feature.append(check['sanity_period'])
-                                check_result = None
-                                if not check_headed:
-                                    check_header.append('check_name')
-                                    check_header.append([
-                                        'data_source_ip',
-                                        'data_source_port',
-                                        'database_name',
-                                        'measurement_name',
-                                        'host_name',
-                                        'test_name',
-                                        'transaction_name',
-                                        'feature_name',
-                                        'measure_unit',
-                                        'sanity_period'])
-                                    check_header.append('check_result')
-                                    self.check_sequence.append(check_header)
-                                    check_headed = True
-                                self.check_sequence.append([check_name,
-                                                            check_feature,
-                                                            check_result])
+        checks = self.check_map_index.get_customer_index(
+            self.customer_name)['checks']
+        step_start = time.time()
+        for check_name, check_feature, check_options in checks:
+            self.check_sequence.append(CheckRecord(
+                check_name, check_feature, check_options=check_options))
+        startup_timings.add_timing('check list', step_start)
         return self.check_sequence
 
     def run_check_sequence(self):
-        for check in self.check_sequence[1:]:
-            check_name = check[0]
-            check_args = check[1]
-            if check_name == 'check_feature_availability':
-                check[2] = check_feature_availability(*check_args)
+        self.engine.run_checks(self.check_sequence)
         return self.check_sequence
 
+    def run_checks(self):
+        if not self.checks_done:
+            self.run_check_sequence()
+            self.analyze_check_results()
+        return self.check_result
+
     def analyze_check_results(self):
-        max_check_result = max([check[2] for check in self.check_sequence[1:]])
-        min_check_result = min([check[2] for check in self.check_sequence[1:]])
+        """
+            one pass over the check results, then the builtin max and min,
+            not vectorized: a customer has too few checks for numpy
+            arrays to be worth their import and building
+        """
+        self.checks_done = True
+        check_results = [check.check_result for check in self.check_sequence]
+        max_check_result = max(check_results)
+        min_check_result = min(check_results)
         if max_check_result == error_level['UNKNOWN']:
             self.check_result = error_level['CRITICAL']
         elif max_check_result == error_level['CRITICAL']:
             self.check_result = error_level['CRITICAL']
+        elif max_check_result == error_level['WARNING']:
+            self.check_result = error_level['WARNING']
         elif max_check_result == error_level['OK']:
             if min_check_result == error_level['OK']:
                 self.check_result = error_level['OK']
         else:
             self.check_result = error_level['CRITICAL']
 
+    def get_query_timings(self):
+        """
+            return: query timings of the data sources and databases of
+                    the customer checks, shared with any other customer
+                    checking the same database
+        """
+        timing_keys = set([('{0}:{1}'.format(check.data_source_ip,
+                                              check.data_source_port),
+                            check.database_name)
+                           for check in self.check_sequence])
+        return influxdb_query_timings.get_timings(timing_keys)
+
+    def get_check_status(self):
+        return {'check_result': self.check_result,
+                'check_sequence': [[check.check_name,
+                                    check.get_check_features(),
+                                    check.check_result]
+                                   for check in self.check_sequence]}
+
+    def load_check_status(self, check_status):
+        self.check_result = check_status['check_result']
+        self.check_sequence = [CheckRecord(check_name, check_feature,
+                                           check_result)
+                               for check_name, check_feature, check_result
+                               in check_status['check_sequence']]
+        self.checks_done = True
+        return True
+
     def exit_check_result(self):
         exit(self.check_result)
         return True
 
 
+class CheckRecord(object):
+    """
+        check_name: '<check_name>'
+        check_feature: [<data_source_ip>, <data_source_port>,
+                        <database_name>, <measurement_name>, <host_name>,
+                        <test_name>, <transaction_name>, <feature_name>,
+                        <measure_unit>, <sanity_period>]
+        check_options: {'availability_mode': <availability_modes_key>,
+                        'availability_warning': <metric_threshold>,
+                        'availability_critical': <metric_threshold>}
+    """
+    feature_names = ('data_source_ip', 'data_source_port', 'database_name',
+                     'measurement_name', 'host_name', 'test_name',
+                     'transaction_name', 'feature_name', 'measure_unit',
+                     'sanity_period')
+    option_names = ('availability_mode', 'availability_warning',
+                    'availability_critical')
+    __slots__ = ('check_name', 'check_result', 'feature_count') + \
+        feature_names + option_names
+
+    def __init__(self, check_name, check_feature, check_result=None,
+                 check_options=None):
+        self.check_name = intern_string(check_name)
+        self.check_result = check_result
+        self.feature_count = len(check_feature)
+        for feature_name, feature in itertools.izip_longest(
+                self.feature_names, check_feature):
+            setattr(self, feature_name, intern_string(feature))
+        check_options = check_options if check_options else {}
+        self.availability_mode = intern_string(
+            check_options.get('availability_mode', 'at_least_one_ok'))
+        self.availability_warning = check_options.get('availability_warning')
+        self.availability_critical = check_options.get(
+            'availability_critical')
+
+    def __repr__(self):
+        return '[{0}, {1}, {2}]'.format(repr(self.check_name),
+                                        self.get_check_features(),
+                                        self.check_result)
+
+    def get_check_features(self):
+        return [getattr(self, feature_name) for feature_name
+                in self.feature_names[:self.feature_count]]
+
+    def get_series_name(self):
+        return self.host_name, self.test_name, self.transaction_name
+
+
 class CustomersInfluxDBChecks:
-    def __init__(self, json_path='', verbose_level=1):
+    """
+        shard: (<shard_number>, <shard_count>) to check only the
+               customers of that shard, from 1 to shard_count
+        output_stream: CheckOutputStream writing every customer as soon
+                       as its checks are done (None: printed at the end)
+        the checks of every customer are only planned,
+        run_customers_checks queries influxdb for all of them at once
+    """
+    def __init__(self, json_path='', verbose_level=1, engine=None,
+                 check_statuses=None, shard=None, output_stream=None):
         self.json_path = json_path
         self.verbose_level = verbose_level
+        self.engine = engine if engine else CheckEngine()
+        self.check_statuses = check_statuses if check_statuses else {}
+        self.shard = shard
+        self.output_stream = output_stream
+        self.customers_pending_checks = {}
+        self.customers_pending_counts = {}
+        self.customers_pending_lock = threading.Lock()
         self.customer_names = []
         self.load_customer_names()
         self.customers_checks = []
-        self.run_customers_checks()
+        self.plan_customers_checks()
 
     def __repr__(self):
         print_message = ''
         for customer_checks in self.customers_checks:
             print(customer_checks)
+        if not self.customers_checks and self.shard:
+            print_message += 'OK: no customers in shard {0}/{1}.'.format(
+                *self.shard)
+        return print_message
+
+    def load_customer_names(self):
+        if not self.json_path:
+            self.json_path = 'check_map.json'
+        check_map_index = get_check_map_index(self.json_path)
+        self.customer_names.extend(check_map_index.customer_names)
+        if not self.customer_names:
+            raise DataNotFound(data_name='customers',
+                               source_name='json file')
+        if self.shard:
+            shard_number, shard_count = self.shard
+            self.customer_names = [
+                customer_name for customer_name in self.customer_names
+                if get_customer_shard(customer_name, shard_count) ==
+                shard_number]
+        return True
+
+    def get_customer_checks(self, customer, check_status=None):
+        if check_status is None:
+            check_status = self.check_statuses.get(customer)
+        return CustomerInfluxDBCheck(
+            customer_name=customer,
+            json_path=self.json_path,
+            verbose_level=self.verbose_level,
+            engine=self.engine,
+            check_status=check_status)
+
+    def plan_customers_checks(self):
+        self.customers_checks = [self.get_customer_checks(customer)
+                                 for customer in self.customer_names]
+        return self.customers_checks
+
+    def get_checks_to_run(self):
+        return [check for customer_checks in self.customers_checks
+                if not customer_checks.checks_done
+                for check in customer_checks.check_sequence]
+
+    def start_customers_output(self):
+        """
+            return: the checks callback of the engine run writing the
+                    customers as soon as their checks are done (None:
+                    no output stream)
+        """
+        if not self.output_stream:
+            return None
+        self.customers_pending_checks = {}
+        self.customers_pending_counts = {}
+        for customer_checks in self.customers_checks:
+            if customer_checks.checks_done:
+                self.write_customer_output(customer_checks,
+                                           customer_checks.check_sequence)
+                continue
+            for check in customer_checks.check_sequence:
+                if check.check_name == 'check_feature_availability':
+                    self.customers_pending_checks[id(check)] = \
+                        customer_checks
+                    self.customers_pending_counts[id(customer_checks)] = \
+                        self.customers_pending_counts.get(
+                            id(customer_checks), 0) + 1
+        return self.set_checks_done
+
+    def set_checks_done(self, checks):
+        customers_checks_done = collections.OrderedDict()
+        with self.customers_pending_lock:
+            for check in checks:
+                customer_checks = self.customers_pending_checks.pop(
+                    id(check), None)
+                if customer_checks is None:
+                    continue
+                self.customers_pending_counts[id(customer_checks)] -= 1
+                customers_checks_done.setdefault(
+                    id(customer_checks), (customer_checks, []))[1].append(
+                    check)
+            for customer_checks, checks_done in \
+                    customers_checks_done.values():
+                self.write_customer_output(
+                    customer_checks, checks_done,
+                    not self.customers_pending_counts[id(customer_checks)])
+        return True
+
+    def write_customer_output(self, customer_checks, checks_done,
+                              customer_done=True):
+        """
+            checks_done: checks of customer_checks just done, written at
+                         verbose level 3 or more in 'ndjson' mode, the
+                         'stream' mode writing them with their customer
+        """
+        if self.verbose_level >= 3 and \
+                self.output_stream.output_mode == 'ndjson':
+            for check in checks_done:
+                self.output_stream.write_check(customer_checks, check)
+        if customer_done:
+            if not customer_checks.checks_done:
+                customer_checks.analyze_check_results()
+            self.output_stream.write_customer(customer_checks)
+        return True
+
+    def end_customers_output(self):
+        for customer_checks in self.customers_checks:
+            if customer_checks.checks_done:
+                continue
+            if not self.output_stream:
+                customer_checks.analyze_check_results()
+                continue
+            # checks without any result, as unknown
+            with self.customers_pending_lock:
+                checks_done = [check for check
+                               in customer_checks.check_sequence
+                               if self.customers_pending_checks.pop(
+                                   id(check), None)]
+            self.write_customer_output(customer_checks, checks_done)
+        return self.customers_checks
+
+    def run_customers_checks(self):
+        checks_callback = self.start_customers_output()
+        # one workload: the engine batches and packs across customers
+        self.engine.run_checks(self.get_checks_to_run(), checks_callback)
+        return self.end_customers_output()
+
+
+class AsyncCustomersInfluxDBChecks(CustomersInfluxDBChecks):
+    """
+        engine: AsyncCheckEngine running the checks of every customer
+                together on its event loop
+        see CustomersInfluxDBChecks
+    """
+    def __init__(self, json_path='', verbose_level=1, engine=None,
+                 check_statuses=None, shard=None, output_stream=None):
+        engine = engine if engine else AsyncCheckEngine()
+        CustomersInfluxDBChecks.__init__(self, json_path=json_path,
+                                         verbose_level=verbose_level,
+                                         engine=engine,
+                                         check_statuses=check_statuses,
+                                         shard=shard,
+                                         output_stream=output_stream)
+
+
+class ShardedCustomersInfluxDBChecks(CustomersInfluxDBChecks):
+    """
+        processes: number of processes sharing the customers, every one
+                   of them checking its customers at once with an engine
+                   built as engine
+        see CustomersInfluxDBChecks
+    """
+    def __init__(self, json_path='', verbose_level=1, engine=None,
+                 check_statuses=None, shard=None, processes=2,
+                 output_stream=None):
+        self.processes = max(processes, 1)
+        CustomersInfluxDBChecks.__init__(self, json_path=json_path,
+                                         verbose_level=verbose_level,
+                                         engine=engine,
+                                         check_statuses=check_statuses,
+                                         shard=shard,
+                                         output_stream=output_stream)
+
+    def run_customers_checks(self):
+        self.start_customers_output()
+        customers_checks = dict([(customer_checks.customer_name,
+                                  customer_checks)
+                                 for customer_checks in self.customers_checks])
+        process_customer_names = [[] for _ in range(self.processes)]
+        # round robin, as the customers of a shard share their hash modulo
+        # any divisor of the shard count
+        for customer_index, customer_name in enumerate(sorted(
+                [customer_checks.customer_name
+                 for customer_checks in self.customers_checks
+                 if not customer_checks.checks_done])):
+            process_customer_names[customer_index % self.processes].append(
+                customer_name)
+        process_customer_names = [customer_names for customer_names
+                                  in process_customer_names if customer_names]
+        if process_customer_names:
+            import multiprocessing
+            step_start = time.time()
+            process_pool = multiprocessing.Pool(
+                len(process_customer_names),
+                initializer=set_shard_worker,
+                initargs=(self.get_shard_worker_setup(),))
+            try:
+                for customers_statuses, query_timings, scope_plan in \
+                        process_pool.imap_unordered(run_shard_worker,
+                                                    process_customer_names):
+                    influxdb_query_timings.merge_timings(query_timings)
+                    influxdb_query_plan.merge_plan(scope_plan)
+                    for customer_name, check_status in \
+                            customers_statuses.items():
+                        customer_checks = customers_checks[customer_name]
+                        customer_checks.load_check_status(check_status)
+                        if self.output_stream:
+                            self.write_customer_output(
+                                customer_checks,
+                                customer_checks.check_sequence)
+                process_pool.close()
+            except:
+                process_pool.terminate()
+                raise
+            finally:
+                process_pool.join()
+            startup_timings.add_timing('queries', step_start)
+        return self.end_customers_output()
+
+    def get_shard_worker_setup(self):
+        """
+            return: {<setting>: <value>} the worker processes build their
+                    engine from, as the engine holds locks, pools and a
+                    circuit breaker that only a fork would copy
+        """
+        return {'json_path': self.json_path,
+                'engine_class': self.engine.__class__,
+                'engine_args': self.engine.get_engine_args(),
+                'deadline': self.engine.deadline,
+                'pool_args': {
+                    'pool_size': influxdb_connection_pool.pool_size,
+                    'idle_timeout': influxdb_connection_pool.idle_timeout},
+                'cache_args': {'max_size': influxdb_query_cache.max_size,
+                               'ttl': influxdb_query_cache.ttl},
+                'plan_cache': bool(influxdb_query_plan.plan_path),
+                'plan_scope': influxdb_query_plan.plan_scope}
+
+
+class CheckOutputStream:
+    """
+        output_mode: 'stream' (the text output of every customer, its
+                     checks included at verbose level 3 or more, as
+                     soon as its checks are done, then a summary
+                     line) or
+                     'ndjson' (one json line per customer, per check at
+                     verbose level 3 or more, then the summary one)
+        output_file: file written and flushed line by line (None: stdout)
+    """
+    def __init__(self, output_mode='stream', verbose_level=1,
+                 output_file=None):
+        self.output_mode = output_mode
+        self.verbose_level = verbose_level
+        self.output_file = output_file if output_file else sys.stdout
+        self.start_time = time.time()
+        self.customers_results = dict([(error_label, 0)
+                                       for error_label in error_level])
+        self.checks_results = dict([(error_label, 0)
+                                    for error_label in error_level])
+        self.output_lock = threading.Lock()
+
+    def __repr__(self):
+        print_message = "Output mode: '{0}'\n".format(self.output_mode)
+        print_message += 'Customers: {0}\n'.format(
+            sum(self.customers_results.values()))
+        print_message += 'Checks: {0}\n'.format(
+            sum(self.checks_results.values()))
+        return print_message
+
+    def write_output(self, output_lines, results, error_label):
+        with self.output_lock:
+            if error_label in results:
+                results[error_label] += 1
+            for output_line in output_lines:
+                self.output_file.write(output_line + '\n')
+            self.output_file.flush()
+        return True
+
+    def write_check(self, customer_checks, check):
+        error_label = get_error_label(check.check_result)
+        if self.output_mode == 'ndjson':
+            output_lines = [json.dumps({
+                'type': 'check',
+                'customer_name': customer_checks.customer_name,
+                'check_name': check.check_name,
+                'check_features': dict(zip(CheckRecord.feature_names,
+                                           check.get_check_features())),
+                'check_result': check.check_result,
+                'error_label': error_label})]
+        else:
+            output_lines = [get_check_line(check)]
+        return self.write_output(output_lines, self.checks_results,
+                                 error_label)
+
+    def write_customer(self, customer_checks):
+        error_label = get_error_label(customer_checks.check_result)
+        output_lines = []
+        if self.output_mode == 'ndjson':
+            customer_output = {
+                'type': 'customer',
+                'customer_name': customer_checks.customer_name,
+                'check_result': customer_checks.check_result,
+                'error_label': error_label,
+                'checks': len(customer_checks.check_sequence)}
+            if self.verbose_level >= 4:
+                customer_output['query_timings'] = \
+                    customer_checks.get_query_timings()
+            output_lines.append(json.dumps(customer_output))
+        else:
+            # the same lines as the text output
+            output_lines.append(str(customer_checks))
+        return self.write_output(output_lines, self.customers_results,
+                                 error_label)
+
+    def get_summary_result(self):
+        customers_labels = [error_label for error_label, customers
+                            in self.customers_results.items() if customers]
+        if not customers_labels:
+            # an empty shard
+            return error_level['OK']
+        return max([error_level[error_label]
+                    for error_label in customers_labels])
+
+    def write_summary(self):
+        """
+            return: the worst result of the customers written
+        """
+        summary_result = self.get_summary_result()
+        error_label = get_error_label(summary_result)
+        run_time = time.time() - self.start_time
+        error_labels = sorted(error_level.keys(),
+                              key=lambda error_label: error_level[error_label])
+        if self.output_mode == 'ndjson':
+            output_line = json.dumps({
+                'type': 'summary',
+                'check_result': summary_result,
+                'error_label': error_label,
+                'customers': sum(self.customers_results.values()),
+                'customers_results': self.customers_results,
+                'checks_results': self.checks_results,
+                'run_time': run_time})
+        else:
+            output_line = '{0}: {1} customers checked in {2:.3f}s, '.format(
+                error_label, sum(self.customers_results.values()), run_time)
+            output_line += ', '.join([
+                '{0} {1}'.format(self.customers_results[customers_label],
+                                 customers_label.lower())
+                for customers_label in error_labels])
+            output_line += ' | '
+            for customers_label in error_labels:
+                output_line += "'customers_{0}'={1};;;; ".format(
+                    customers_label.lower(),
+                    self.customers_results[customers_label])
+            output_line += "'run_time'={0:.6f}s;;;; ".format(run_time)
+        self.write_output([output_line], {}, error_label)
+        return summary_result
+
+
+class CheckScheduler:
+    """
+        status_path: json file where the latest check results are saved
+        stats_path: json file where the query timings are saved
+        shard: (<shard_number>, <shard_count>) to check only the
+               customers of that shard
+        min_period: min seconds between two runs of the same check
+        period_ratio: a check runs every sanity period / period_ratio
+    """
+    def __init__(self, json_path='', engine=None, status_path='',
+                 min_period=60, period_ratio=10, stats_path='', shard=None):
+        self.json_path = json_path
+        self.engine = engine if engine else CheckEngine()
+        self.status_path = status_path if status_path else 'check_status.json'
+        self.stats_path = stats_path
+        self.min_period = min_period
+        self.period_ratio = period_ratio
+        self.shard = shard
+        self.check_map_index = None
+        self.customers_checks = None
+        self.check_schedule = []
+        self.load_customers_checks()
+        self.save_check_status()
+
+    def __repr__(self):
+        print_message = "Status path: '{0}'\n".format(self.status_path)
+        print_message += 'Customers: {0}\n'.format(
+            len(self.customers_checks.customers_checks))
+        print_message += 'Scheduled checks: {0}\n'.format(
+            len(self.check_schedule))
+        if self.check_schedule:
+            print_message += 'Next run in: {0:.1f}s\n'.format(
+                self.check_schedule[0][0] - time.time())
+        return print_message
+
+    def load_customers_checks(self):
+        """
+            return: the customers checks of the check map, all run once and
+                    scheduled, built again when the json file changes
+        """
+        self.check_map_index = get_check_map_index(self.json_path)
+        self.customers_checks = CustomersInfluxDBChecks(
+            json_path=self.json_path, engine=self.engine, shard=self.shard)
+        self.customers_checks.run_customers_checks()
+        self.schedule_checks()
+        return self.customers_checks
+
+    def is_check_map_fresh(self):
+        if self.check_map_index.is_fresh():
+            return True
+        file_hash = self.check_map_index.file_hash
+        self.check_map_index = get_check_map_index(self.json_path)
+        # touched but not changed
+        return self.check_map_index.file_hash == file_hash
+
+    def get_check_period(self, check):
+        check_seconds = get_seconds_from_now(check.measure_unit,
+                                             check.sanity_period)
+        return max(self.min_period, check_seconds / float(self.period_ratio))
+
+    def schedule_checks(self):
+        now = time.time()
+        self.check_schedule = []
+        for customer_index, customer_checks in enumerate(
+                self.customers_checks.customers_checks):
+            for check_index, check in enumerate(
+                    customer_checks.check_sequence):
+                if check.check_name != 'check_feature_availability':
+                    continue
+                heapq.heappush(self.check_schedule,
+                               (now + self.get_check_period(check),
+                                customer_index, check_index))
+        return self.check_schedule
+
+    def run_due_checks(self):
+        if not self.is_check_map_fresh():
+            self.engine.start_run()
+            self.load_customers_checks()
+            self.save_check_status()
+            return len(self.check_schedule)
+        now = time.time()
+        due_checks = []
+        due_customers = set()
+        while self.check_schedule and self.check_schedule[0][0] <= now:
+            check_time, customer_index, check_index = heapq.heappop(
+                self.check_schedule)
+            customer_checks = self.customers_checks.customers_checks[
+                customer_index]
+            check = customer_checks.check_sequence[check_index]
+            due_checks.append(check)
+            due_customers.add(customer_index)
+            heapq.heappush(self.check_schedule,
+                           (now + self.get_check_period(check),
+                            customer_index, check_index))
+        if due_checks:
+            self.engine.start_run()
+            self.engine.run_checks(due_checks)
+            for customer_index in sorted(due_customers):
+                self.customers_checks.customers_checks[
+                    customer_index].analyze_check_results()
+            self.save_check_status()
+        return len(due_checks)
+
+    def save_check_status(self):
+        check_status = {'status_time': time.time(),
+                        'file_hash': self.check_map_index.file_hash,
+                        'customers': {}}
+        for customer_checks in self.customers_checks.customers_checks:
+            check_status['customers'][customer_checks.customer_name] = \
+                customer_checks.get_check_status()
+        if self.stats_path:
+            save_query_timings(self.stats_path,
+                               self.customers_checks.customers_checks)
+        return save_json(self.status_path, check_status)
+
+    def run(self):
+        try:
+            while True:
+                self.run_due_checks()
+                sleep_time = self.min_period
+                if self.check_schedule:
+                    sleep_time = min(sleep_time, self.check_schedule[0][0] -
+                                     time.time())
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+        except KeyboardInterrupt:
+            influxdb_connection_pool.close_connections()
+        return True
+
+
+class CheckEngine:
+    """
+        workers: max number of requests to influxdb at the same time
+        source_workers: max number of requests to the same
+                        '<ip>:<port>' at the same time (0: no limit)
+        query_mode: 'single' (one query per check) or 'batch' (one
+                    group by query per measurement and sanity window)
+        batch_size: max number of checks served by one batch query
+        check_mode: 'fetch' (every point of the sanity period),
+                    'pushdown' (let influxdb look for the 'ok' point),
+                    'stream' (read points in chunks until the 'ok' one)
+                    or 'rollup' (count the 'ok' points of the per minute
+                    rollup, then as 'pushdown' for the series without)
+        pack_size: max number of queries sent to the same database in
+                   one request
+        pack_bytes: max length of the queries packed in one request
+        chunk_size: number of points of every chunk in 'stream' mode
+        max_rows: max number of points of every series fetched at once,
+                  the older ones fetched by the next queries, newest
+                  first, until the check is decided (0: no limit)
+        check_states: CheckStateStore of the series checked by previous
+                      runs, to query only their newer points
+        run_timeout: seconds every run has to be over in, the checks not
+                     queried by then being unknown (0: no limit)
+        request_timeout: max seconds of every request (0: no limit)
+        breaker_failures: consecutive failed requests after which the
+                          checks of an endpoint are unknown without
+                          querying it (0: never)
+        breaker_reset: seconds after which a failing endpoint is queried
+                       again
+    """
+    def __init__(self, workers=1, source_workers=0, query_mode='single',
+                 batch_size=100, check_mode='fetch', pack_size=1,
+                 pack_bytes=65536, chunk_size=10000, max_rows=10000,
+                 check_states=None, run_timeout=0, request_timeout=0,
+                 breaker_failures=3, breaker_reset=60):
+        self.workers = max(workers, 1)
+        self.source_workers = max(source_workers, 0)
+        self.query_mode = query_mode
+        self.batch_size = max(batch_size, 1)
+        self.check_mode = check_mode
+        self.pack_size = max(pack_size, 1)
+        self.pack_bytes = max(pack_bytes, 0)
+        self.chunk_size = max(chunk_size, 1)
+        self.max_rows = max(max_rows, 0)
+        self.check_states = check_states
+        self.epoch = 's'
+        self.run_timeout = max(run_timeout, 0)
+        self.request_timeout = request_timeout if request_timeout > 0 \
+            else None
+        self.circuit_breaker = CircuitBreaker(breaker_failures,
+                                              breaker_reset)
+        self.deadline = None
+        self.start_run()
+        self.workers_slots = threading.BoundedSemaphore(self.workers)
+        self.source_slots = {}
+        self.source_slots_lock = threading.Lock()
+
+    def __repr__(self):
+        print_message = 'Workers: {0}\n'.format(self.workers)
+        print_message += 'Source workers: {0}\n'.format(self.source_workers)
+        print_message += "Query mode: '{0}'\n".format(self.query_mode)
+        print_message += 'Batch size: {0}\n'.format(self.batch_size)
+        print_message += "Check mode: '{0}'\n".format(self.check_mode)
+        print_message += 'Pack size: {0}\n'.format(self.pack_size)
+        print_message += 'Pack bytes: {0}\n'.format(self.pack_bytes)
+        print_message += 'Chunk size: {0}\n'.format(self.chunk_size)
+        print_message += 'Max rows: {0}\n'.format(self.max_rows)
+        print_message += 'Run timeout: {0}\n'.format(self.run_timeout)
+        print_message += 'Request timeout: {0}\n'.format(
+            self.request_timeout)
+        print_message += str(self.circuit_breaker)
+        if self.check_states:
+            print_message += str(self.check_states)
         return print_message
 
-    def load_customer_names(self):
-        if not self.json_path:
-            self.json_path = 'check_map.json'
-        check_map = load_json(self.json_path)
-        for customer_data in check_map['customers']:
-            self.customer_names.append(customer_data['customer_name'])
-        if not self.customer_names:
-            raise DataNotFound(data_name='customers',
-                               source_name='json file')
+    def get_engine_args(self):
+        """
+            return: {<argument>: <value>} of a new engine checking as this
+                    one does, 'check_states' being the arguments of its
+                    CheckStateStore
+        """
+        return {'workers': self.workers,
+                'source_workers': self.source_workers,
+                'query_mode': self.query_mode,
+                'batch_size': self.batch_size,
+                'check_mode': self.check_mode,
+                'pack_size': self.pack_size,
+                'pack_bytes': self.pack_bytes,
+                'chunk_size': self.chunk_size,
+                'max_rows': self.max_rows,
+                'check_states': self.check_states.get_store_args()
+                if self.check_states else None,
+                'run_timeout': self.run_timeout,
+                'request_timeout': self.request_timeout or 0,
+                'breaker_failures': self.circuit_breaker.max_failures,
+                'breaker_reset': self.circuit_breaker.reset_timeout}
+
+    def start_run(self):
+        self.deadline = time.time() + self.run_timeout \
+            if self.run_timeout else None
+        return self.deadline
+
+    def get_source_slots(self, data_source_ip, data_source_port):
+        data_source_key = (data_source_ip, data_source_port)
+        with self.source_slots_lock:
+            if data_source_key not in self.source_slots:
+                self.source_slots[data_source_key] = \
+                    threading.BoundedSemaphore(self.source_workers)
+            return self.source_slots[data_source_key]
+
+    def run_on_source(self, data_source_ip, data_source_port, query_function,
+                      *query_args, **query_kwargs):
+        if self.source_workers:
+            with self.get_source_slots(data_source_ip, data_source_port):
+                with self.workers_slots:
+                    return query_function(*query_args, **query_kwargs)
+        with self.workers_slots:
+            return query_function(*query_args, **query_kwargs)
+
+    def plan_check_batches(self, checks):
+        check_batches = []
+        open_check_batches = {}
+        for check in checks:
+            if check.check_name != 'check_feature_availability':
+                continue
+            if self.query_mode == 'batch':
+                # same endpoint, database, measurement and sanity window
+                check_batch_key = (check.data_source_ip,
+                                   check.data_source_port,
+                                   check.database_name,
+                                   check.measurement_name,
+                                   check.feature_name,
+                                   check.measure_unit,
+                                   check.sanity_period,
+                                   check.availability_mode,
+                                   check.availability_warning,
+                                   check.availability_critical)
+                check_batch = open_check_batches.get(check_batch_key)
+                if check_batch is None or \
+                        len(check_batch) >= self.batch_size:
+                    check_batch = []
+                    open_check_batches[check_batch_key] = check_batch
+                    check_batches.append(check_batch)
+                check_batch.append(check)
+            else:
+                check_batches.append([check])
+        return check_batches
+
+    def get_feature_query(self, check_batch):
+        first_check = check_batch[0]
+        series_states = None
+        if self.check_states and \
+                first_check.availability_mode == 'at_least_one_ok':
+            series_states = self.check_states.get_series_states(check_batch)
+        return FeatureAvailabilityQuery(
+            measure=first_check.measurement_name,
+            series_names=[check.get_series_name() for check in check_batch],
+            feature_name=first_check.feature_name,
+            measure_unit=first_check.measure_unit,
+            sanity_period=first_check.sanity_period,
+            check_mode=self.check_mode,
+            series_grouped=len(check_batch) > 1,
+            series_states=series_states,
+            availability_mode=first_check.availability_mode,
+            availability_warning=first_check.availability_warning,
+            availability_critical=first_check.availability_critical,
+            max_rows=self.max_rows)
+
+    def plan_check_packs(self, check_batches):
+        check_packs = []
+        open_check_packs = {}
+        for check_batch in check_batches:
+            # same endpoint and database
+            first_check = check_batch[0]
+            check_pack_key = (first_check.data_source_ip,
+                              first_check.data_source_port,
+                              first_check.database_name)
+            check_pack = open_check_packs.get(check_pack_key)
+            if check_pack is None or len(check_pack) >= self.pack_size:
+                check_pack = []
+                open_check_packs[check_pack_key] = check_pack
+                check_packs.append(check_pack)
+            check_pack.append((check_batch,
+                               self.get_feature_query(check_batch)))
+        return check_packs
+
+    def check_circuit_breaker(self, first_check):
+        if self.circuit_breaker.is_open(first_check.data_source_ip,
+                                        first_check.data_source_port):
+            raise QuerySkipped(reason='circuit breaker open',
+                               source_name='{0}:{1}'.format(
+                                   first_check.data_source_ip,
+                                   first_check.data_source_port))
+        return True
+
+    def query_check_pack(self, first_check, feature_queries):
+        # the endpoint may have failed while waiting for a slot
+        self.check_circuit_breaker(first_check)
+        return run_feature_queries(first_check.data_source_ip,
+                                   first_check.data_source_port,
+                                   first_check.database_name,
+                                   feature_queries, self.pack_size,
+                                   self.pack_bytes, self.chunk_size,
+                                   self.epoch, self.request_timeout,
+                                   self.deadline)
+
+    def run_check_pack(self, check_pack, checks_callback=None):
+        first_check = check_pack[0][0][0]
+        feature_queries = [feature_query
+                           for check_batch, feature_query in check_pack]
+        query_error = None
+        try:
+            self.check_circuit_breaker(first_check)
+            self.run_on_source(first_check.data_source_ip,
+                               first_check.data_source_port,
+                               self.query_check_pack, first_check,
+                               feature_queries)
+        except (QuerySkipped,) + influxdb_errors as influxdb_error:
+            query_error = influxdb_error
+        return self.set_check_pack_results(check_pack, query_error,
+                                           checks_callback)
+
+    def set_check_pack_results(self, check_pack, query_error=None,
+                               checks_callback=None):
+        """
+            query_error: exception raised by the queries of check_pack,
+                         its checks not done yet being unknown
+            checks_callback: function called with the checks of
+                             check_pack once their results are set
+        """
+        first_check = check_pack[0][0][0]
+        if isinstance(query_error, QuerySkipped):
+            # not sent or not answered in time: nothing told of the endpoint
+            pass
+        elif query_error is not None and is_endpoint_failure(query_error):
+            self.circuit_breaker.add_failure(first_check.data_source_ip,
+                                             first_check.data_source_port)
+        else:
+            self.circuit_breaker.add_success(first_check.data_source_ip,
+                                             first_check.data_source_port)
+        for check_batch, feature_query in check_pack:
+            if not feature_query.is_done():
+                feature_query.set_query_error(query_error)
+            for check, check_result in zip(
+                    check_batch, feature_query.get_check_results()):
+                check.check_result = check_result
+        if checks_callback:
+            checks_callback([check for check_batch, feature_query
+                             in check_pack for check in check_batch])
+        return check_pack
+
+    def plan_checks(self, checks, checks_callback=None):
+        """
+            checks_callback: function called with the checks done without
+                             querying influxdb
+            return: the check packs querying influxdb for checks
+        """
+        checks_to_query = checks
+        if self.check_states:
+            checks_to_query = self.check_states.check_cached_checks(checks)
+            if checks_callback and len(checks_to_query) < len(checks):
+                checks_to_query_ids = set([id(check)
+                                           for check in checks_to_query])
+                checks_callback([check for check in checks
+                                 if id(check) not in checks_to_query_ids])
+        check_batches = self.plan_check_batches(checks_to_query)
+        return self.plan_check_packs(check_batches)
+
+    def run_check_packs(self, check_packs, checks_callback=None):
+        return self.map_tasks(
+            lambda check_pack: self.run_check_pack(check_pack,
+                                                   checks_callback),
+            check_packs)
+
+    def save_check_packs_states(self, check_packs):
+        if self.check_states and check_packs:
+            self.check_states.set_check_packs_states(check_packs)
+            self.check_states.save_series_states()
+        return True
+
+    def run_checks(self, checks, checks_callback=None):
+        """
+            checks_callback: function called with every group of checks
+                             as soon as their results are set, from the
+                             thread that queried them
+        """
+        step_start = time.time()
+        check_packs = self.plan_checks(checks, checks_callback)
+        startup_timings.add_timing('planning', step_start)
+        step_start = time.time()
+        self.run_check_packs(check_packs, checks_callback)
+        self.save_check_packs_states(check_packs)
+        startup_timings.add_timing('queries', step_start)
+        return checks
+
+    def map_tasks(self, task_function, tasks):
+        if self.workers == 1 or len(tasks) <= 1:
+            return [task_function(task) for task in tasks]
+        task_results = [None] * len(tasks)
+        task_errors = [None] * len(tasks)
+        task_queue = Queue.Queue()
+        for task_index, task in enumerate(tasks):
+            task_queue.put((task_index, task))
+
+        def run_tasks():
+            while True:
+                try:
+                    task_index, task = task_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    task_results[task_index] = task_function(task)
+                except:
+                    task_errors[task_index] = sys.exc_info()
+
+        task_threads = [threading.Thread(target=run_tasks)
+                        for _ in range(min(self.workers, len(tasks)))]
+        for task_thread in task_threads:
+            task_thread.daemon = True
+            task_thread.start()
+        for task_thread in task_threads:
+            task_thread.join()
+        for task_error in task_errors:
+            if task_error:
+                raise task_error[0], task_error[1], task_error[2]
+        return task_results
+
+
+class AsyncCheckEngine(CheckEngine):
+    """
+        connections: max number of connections to every influxdb endpoint,
+                     all of them sending and reading on one event loop
+        event_loop: InfluxDBEventLoop to run the queries on (None: new)
+        see CheckEngine, workers and source_workers being replaced by
+        connections
+    """
+    def __init__(self, connections=64, event_loop=None, **engine_args):
+        CheckEngine.__init__(self, **engine_args)
+        self.event_loop = event_loop if event_loop else InfluxDBEventLoop(
+            max_connections=connections,
+            accept_gzip=influxdb_connection_pool.accept_gzip)
+
+    def __repr__(self):
+        print_message = CheckEngine.__repr__(self)
+        print_message += 'Connections: {0}\n'.format(
+            self.event_loop.max_connections)
+        return print_message
+
+    def get_engine_args(self):
+        engine_args = CheckEngine.get_engine_args(self)
+        engine_args['connections'] = self.event_loop.max_connections
+        return engine_args
+
+    def run_check_packs(self, check_packs, checks_callback=None):
+        packs_futures = []
+        for check_pack in check_packs:
+            first_check = check_pack[0][0][0]
+            feature_queries = [feature_query
+                               for check_batch, feature_query in check_pack]
+            try:
+                self.check_circuit_breaker(first_check)
+                packs_futures.append(run_feature_queries_async(
+                    self.event_loop, first_check.data_source_ip,
+                    first_check.data_source_port, first_check.database_name,
+                    feature_queries, self.pack_size, self.pack_bytes,
+                    self.epoch, self.request_timeout, self.deadline))
+            except QuerySkipped as query_skipped:
+                packs_future = QueryFuture()
+                packs_future.set_error(query_skipped)
+                packs_futures.append(packs_future)
+        for check_pack, packs_future in zip(check_packs, packs_futures):
+            packs_future.add_done_callback(
+                lambda packs_future, check_pack=check_pack:
+                self.set_check_pack_results(check_pack, packs_future.error,
+                                            checks_callback))
+        self.event_loop.run_until_complete(packs_futures)
+        for check_pack, packs_future in zip(check_packs, packs_futures):
+            if not packs_future.done:
+                self.set_check_pack_results(
+                    check_pack, QuerySkipped(reason='run deadline reached'),
+                    checks_callback)
+        return check_packs
+
+
+class CircuitBreaker:
+    """
+        max_failures: consecutive failed requests after which an endpoint
+                      is not queried anymore (0: never)
+        reset_timeout: seconds after which the endpoint is queried again,
+                       one more failure stopping it for as long
+    """
+    def __init__(self, max_failures=3, reset_timeout=60):
+        self.max_failures = max(max_failures, 0)
+        self.reset_timeout = reset_timeout
+        self.endpoint_failures = {}
+        self.endpoint_failures_lock = threading.Lock()
+
+    def __repr__(self):
+        print_message = 'Breaker failures: {0}\n'.format(self.max_failures)
+        print_message += 'Breaker reset: {0}\n'.format(self.reset_timeout)
+        with self.endpoint_failures_lock:
+            for endpoint, (failures, failure_time) in sorted(
+                    self.endpoint_failures.items()):
+                print_message += "Failures of '{0}:{1}': {2}\n".format(
+                    endpoint[0], endpoint[1], failures)
+        return print_message
+
+    def is_open(self, ip, port):
+        if not self.max_failures:
+            return False
+        endpoint = (ip, str(port))
+        with self.endpoint_failures_lock:
+            failures, failure_time = self.endpoint_failures.get(endpoint,
+                                                                (0, 0))
+        return failures >= self.max_failures and \
+            time.time() - failure_time < self.reset_timeout
+
+    def add_failure(self, ip, port):
+        endpoint = (ip, str(port))
+        with self.endpoint_failures_lock:
+            failures, failure_time = self.endpoint_failures.get(endpoint,
+                                                                (0, 0))
+            self.endpoint_failures[endpoint] = (failures + 1, time.time())
+            return failures + 1
+
+    def add_success(self, ip, port):
+        endpoint = (ip, str(port))
+        with self.endpoint_failures_lock:
+            self.endpoint_failures.pop(endpoint, None)
+        return True
+
+
+def is_stale_connection_error(request_error, request_sent=True):
+    """
+        request_error: error of a request over a reused keep-alive
+                       connection
+        request_sent: the request was sent, the error being raised while
+                      waiting for the response
+        return: True if the server had closed the connection before
+                reading the request, which can then be sent again
+    """
+    if isinstance(request_error, socket.timeout):
+        return False
+    if not request_sent:
+        return True
+    if isinstance(request_error, httplib.BadStatusLine):
+        # not a byte of the status line, as told by every python 2.7
+        return request_error.line in ('', repr('')) or \
+            request_error.line.startswith('No status line received')
+    if isinstance(request_error, socket.error):
+        return request_error.errno in (errno.ECONNRESET, errno.EPIPE)
+    return False
+
+
+def is_endpoint_failure(query_error):
+    """
+        query_error: error of the requests to an influxdb endpoint
+        return: True if the endpoint could not be reached, timed out or
+                answered a server error (5xx), False if it answered, even
+                with a query error (4xx) or a response not parsed
+    """
+    if isinstance(query_error, urllib2.HTTPError):
+        return query_error.code >= 500
+    return isinstance(query_error, (socket.error, urllib2.URLError,
+                                    httplib.HTTPException))
+
+
+class InfluxDBConnectionPool:
+    """
+        pool_size: max number of idle connections kept for each
+                   (ip, port) influxdb endpoint
+        idle_timeout: seconds after which an idle connection is closed
+        accept_gzip: ask for gzip compressed responses, decompressed
+                     as they are read
+    """
+    def __init__(self, pool_size=4, idle_timeout=60, accept_gzip=True):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.accept_gzip = accept_gzip
+        self.idle_connections = {}
+        self.idle_connections_lock = threading.Lock()
+
+    def __repr__(self):
+        print_message = 'Pool size: {0}\n'.format(self.pool_size)
+        print_message += 'Idle timeout: {0}\n'.format(self.idle_timeout)
+        with self.idle_connections_lock:
+            for endpoint, connections in self.idle_connections.items():
+                print_message += "Idle connections to '{0}:{1}': " \
+                                 "{2}\n".format(endpoint[0], endpoint[1],
+                                                len(connections))
+        return print_message
+
+    def configure(self, pool_size=None, idle_timeout=None):
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        return True
+
+    def get_connection(self, ip, port):
+        endpoint = (ip, str(port))
+        now = time.time()
+        with self.idle_connections_lock:
+            connections = self.idle_connections.get(endpoint, [])
+            while connections:
+                connection, idle_since = connections.pop()
+                if now - idle_since <= self.idle_timeout:
+                    return connection, True
+                connection.close()
+        return httplib.HTTPConnection(ip, int(port)), False
+
+    def release_connection(self, ip, port, connection):
+        endpoint = (ip, str(port))
+        with self.idle_connections_lock:
+            connections = self.idle_connections.setdefault(endpoint, [])
+            if len(connections) < self.pool_size:
+                connections.append((connection, time.time()))
+                return True
+        connection.close()
+        return False
+
+    def close_connections(self):
+        with self.idle_connections_lock:
+            for connections in self.idle_connections.values():
+                for connection, idle_since in connections:
+                    connection.close()
+            self.idle_connections = {}
+        return True
+
+    def get_response(self, ip, port, method, url, body=None, headers=None,
+                     request_timing=None, timeout=None):
+        """
+            request_timing: {} filled with 'connect_time' and
+                            'first_byte_time' of the request
+            timeout: seconds to wait for every socket operation, the
+                     request being retried on a stale connection only
+                     within them (None: socket default)
+        """
+        if headers is None:
+            headers = {}
+        if self.accept_gzip:
+            headers = dict(headers)
+            headers.setdefault('Accept-Encoding', 'gzip')
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        if request_timing is None:
+            request_timing = {}
+        request_timing.setdefault('connect_time', 0.0)
+        request_timing.setdefault('first_byte_time', 0.0)
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    raise socket.timeout('timed out')
+            connection, reused = self.get_connection(ip, port)
+            connection.timeout = timeout
+            request_sent = False
+            try:
+                if reused:
+                    connection.sock.settimeout(timeout)
+                else:
+                    connect_start = time.time()
+                    connection.connect()
+                    request_timing['connect_time'] += \
+                        time.time() - connect_start
+                request_start = time.time()
+                connection.request(method, url, body, headers)
+                request_sent = True
+                response = connection.getresponse()
+                request_timing['first_byte_time'] += \
+                    time.time() - request_start
+            except (httplib.HTTPException, socket.error) as request_error:
+                connection.close()
+                if reused and is_stale_connection_error(request_error,
+                                                        request_sent):
+                    continue
+                raise
+            if response.status != 200:
+                response.read()
+                self.end_response(ip, port, connection, response)
+                raise urllib2.HTTPError('http://{0}:{1}{2}'.format(
+                    ip, port, url), response.status, response.reason,
+                    response.msg, None)
+            return connection, response
+
+    def end_response(self, ip, port, connection, response):
+        if response.will_close:
+            connection.close()
+            return False
+        return self.release_connection(ip, port, connection)
+
+    def request(self, ip, port, method, url, body=None, headers=None,
+                request_timing=None, timeout=None):
+        """
+            request_timing: {} filled with 'connect_time',
+                            'first_byte_time', 'transfer_time' and
+                            'response_bytes' of the request
+        """
+        if request_timing is None:
+            request_timing = {}
+        connection, response = self.get_response(ip, port, method, url, body,
+                                                 headers, request_timing,
+                                                 timeout)
+        transfer_start = time.time()
+        try:
+            response_body = response.read()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            raise
+        request_timing['transfer_time'] = time.time() - transfer_start
+        request_timing['response_bytes'] = len(response_body)
+        self.end_response(ip, port, connection, response)
+        if response.getheader('content-encoding') == 'gzip':
+            response_body = zlib.decompress(response_body,
+                                            16 + zlib.MAX_WBITS)
+        return response_body
+
+    def request_lines(self, ip, port, method, url, body=None, headers=None,
+                      read_size=8192, request_timing=None, timeout=None):
+        """
+            yield: the response body line by line, as soon as it is read;
+                   closing the generator early drops the connection
+            request_timing: {} filled as in request, while reading
+        """
+        if request_timing is None:
+            request_timing = {}
+        connection, response = self.get_response(ip, port, method, url, body,
+                                                 headers, request_timing,
+                                                 timeout)
+        request_timing['transfer_time'] = 0.0
+        request_timing['response_bytes'] = 0
+        response_decompressor = None
+        if response.getheader('content-encoding') == 'gzip':
+            response_decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        response_read = False
+        try:
+            response_buffer = ''
+            while True:
+                transfer_start = time.time()
+                response_data = response.read(read_size)
+                request_timing['transfer_time'] += \
+                    time.time() - transfer_start
+                request_timing['response_bytes'] += len(response_data)
+                if not response_data:
+                    break
+                if response_decompressor:
+                    response_data = response_decompressor.decompress(
+                        response_data)
+                response_lines = (response_buffer + response_data).split('\n')
+                response_buffer = response_lines.pop()
+                for response_line in response_lines:
+                    if response_line.strip():
+                        yield response_line
+            response_read = True
+            if response_decompressor:
+                response_buffer += response_decompressor.flush()
+            for response_line in response_buffer.split('\n'):
+                if response_line.strip():
+                    yield response_line
+        finally:
+            if response_read:
+                self.end_response(ip, port, connection, response)
+            else:
+                connection.close()
+
+
+class QueryTimings:
+    """
+        timings: {('<ip>:<port>', '<database>'): {<timing_name>: <sum>}},
+                 summed over the requests sent to every database
+    """
+    timing_names = ['requests', 'queries', 'connect_time',
+                    'first_byte_time', 'transfer_time', 'parse_time',
+                    'response_bytes']
+
+    def __init__(self):
+        self.timings = {}
+        self.timings_lock = threading.Lock()
+
+    def __repr__(self):
+        print_message = ''
+        for data_source, database in sorted(self.timings.keys()):
+            print_message += "Query timings of '{0}' on '{1}': {2}\n".format(
+                database, data_source, self.timings[(data_source, database)])
+        return print_message
+
+    def add_timing(self, ip, port, database, influxdb_queries,
+                   request_timing):
+        """
+            influxdb_queries: [<list_of_influxql_statements_sent>]
+            request_timing: {<timing_name>: <value>} of one request
+        """
+        timing_key = ('{0}:{1}'.format(ip, port), database)
+        request_time = sum([request_timing.get(timing_name, 0.0)
+                            for timing_name in self.timing_names[2:-1]])
+        with self.timings_lock:
+            timing = self.timings.get(timing_key)
+            if timing is None:
+                timing = dict([(timing_name, 0)
+                               for timing_name in self.timing_names])
+                timing['slowest_time'] = 0.0
+                timing['slowest_query'] = ''
+                self.timings[timing_key] = timing
+            timing['requests'] += 1
+            timing['queries'] += len(influxdb_queries)
+            for timing_name in self.timing_names[2:]:
+                timing[timing_name] += request_timing.get(timing_name, 0)
+            if request_time >= timing['slowest_time']:
+                timing['slowest_time'] = request_time
+                timing['slowest_query'] = ';'.join(influxdb_queries)
+        return timing
+
+    def reset_timings(self):
+        with self.timings_lock:
+            self.timings = {}
+        return True
+
+    def merge_timings(self, timings):
+        """
+            timings: query timings as returned by get_timings, of
+                     another process
+        """
+        with self.timings_lock:
+            for data_source, database_timings in timings.items():
+                for database, other_timing in database_timings.items():
+                    timing_key = (data_source, database)
+                    timing = self.timings.get(timing_key)
+                    if timing is None:
+                        self.timings[timing_key] = dict(other_timing)
+                        continue
+                    for timing_name in self.timing_names:
+                        timing[timing_name] += other_timing[timing_name]
+                    if other_timing['slowest_time'] >= \
+                            timing['slowest_time']:
+                        timing['slowest_time'] = other_timing['slowest_time']
+                        timing['slowest_query'] = \
+                            other_timing['slowest_query']
+        return True
+
+    def get_timings(self, timing_keys=None):
+        """
+            timing_keys: [<list_of_(ip_port, database)>] (None: all)
+            return: {'<ip>:<port>': {'<database>': {<timing_name>: <sum>}}}
+        """
+        timings = {}
+        with self.timings_lock:
+            for timing_key, timing in self.timings.items():
+                if timing_keys is not None and timing_key not in timing_keys:
+                    continue
+                data_source, database = timing_key
+                timings.setdefault(data_source, {})[database] = dict(timing)
+        return timings
+
+
+def get_process_start_time():
+    """
+        return: epoch seconds the process was started at, from /proc on
+                linux, to the clock tick (None: unknown)
+    """
+    try:
+        stat_file = open('/proc/self/stat')
+        process_stat = stat_file.read()
+        stat_file.close()
+        uptime_file = open('/proc/uptime')
+        uptime = float(uptime_file.read().split()[0])
+        uptime_file.close()
+        # the fields after the command name, starttime being the 22nd
+        start_ticks = int(process_stat.rsplit(')', 1)[1].split()[19])
+        return time.time() - uptime + \
+            float(start_ticks) / os.sysconf('SC_CLK_TCK')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupTimings:
+    """
+        step_timings: {<step_name>: <seconds>}, summed over the run
+        imports_time: seconds from the start of the module to the creation
+                      of the global startup timings
+    """
+    def __init__(self):
+        self.step_timings = collections.OrderedDict()
+        self.imports_time = time.time() - module_start_time
+        self.timings_lock = threading.Lock()
+
+    def __repr__(self):
+        print_message = ''
+        for step_name, step_time in self.get_timings().items():
+            print_message += "[ startup | {0} | {1:.1f} ms ]\n".format(
+                step_name, 1000 * step_time)
+        return print_message
+
+    def add_timing(self, step_name, step_start):
+        """
+            step_start: time.time() at the start of the step
+        """
+        step_time = time.time() - step_start
+        with self.timings_lock:
+            self.step_timings[step_name] = \
+                self.step_timings.get(step_name, 0.0) + step_time
+        return step_time
+
+    def get_timings(self):
+        """
+            return: {<step_name>: <seconds>}, from 'interpreter' (when the
+                    process start is known) and 'imports', through the
+                    steps, to 'other' (outside any step) and 'total'
+        """
+        timings = collections.OrderedDict()
+        run_start = module_start_time
+        process_start = get_process_start_time()
+        if process_start is not None and process_start < module_start_time:
+            timings['interpreter'] = module_start_time - process_start
+            run_start = process_start
+        timings['imports'] = self.imports_time
+        with self.timings_lock:
+            timings.update(self.step_timings)
+        total_time = time.time() - run_start
+        timings['other'] = max(total_time - sum(timings.values()), 0.0)
+        timings['total'] = total_time
+        return timings
+
+
+class QueryCache:
+    """
+        max_size: max number of statement results kept (0: no cache)
+        ttl: seconds a statement result is reused for
+    """
+    def __init__(self, max_size=1000, ttl=10):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cached_results = collections.OrderedDict()
+        self.pending_results = {}
+        self.cached_results_lock = threading.Lock()
+
+    def __repr__(self):
+        print_message = 'Cache size: {0}\n'.format(self.max_size)
+        print_message += 'Cache ttl: {0}\n'.format(self.ttl)
+        with self.cached_results_lock:
+            print_message += 'Cached results: {0}\n'.format(
+                len(self.cached_results))
+        return print_message
+
+    def configure(self, max_size=None, ttl=None):
+        if max_size is not None:
+            self.max_size = max_size
+        if ttl is not None:
+            self.ttl = ttl
+        return True
+
+    def get_cache_key(self, ip, port, database, influxdb_query, epoch=None):
+        return (ip, str(port), database, epoch,
+                ' '.join(influxdb_query.split()))
+
+    def get_cached_result(self, cache_key, now):
+        cached_result = self.cached_results.pop(cache_key, None)
+        if cached_result is None:
+            return None
+        result_time, influxdb_result = cached_result
+        if now - result_time > self.ttl:
+            return None
+        # most recently used last
+        self.cached_results[cache_key] = cached_result
+        return influxdb_result
+
+    def claim_results(self, cache_keys, influxdb_results):
+        """
+            influxdb_results: [] filled with the results of cache_keys
+                              found in the cache
+            return: (<indexes_to_fetch>, <pending_events_to_wait_for>)
+        """
+        now = time.time()
+        fetch_indexes = []
+        pending_events = []
+        with self.cached_results_lock:
+            for key_index, cache_key in enumerate(cache_keys):
+                if influxdb_results[key_index] is not None:
+                    continue
+                influxdb_result = self.get_cached_result(cache_key, now)
+                if influxdb_result is not None:
+                    influxdb_results[key_index] = influxdb_result
+                elif cache_key in self.pending_results:
+                    # the same statement is being fetched by another check
+                    pending_events.append(self.pending_results[cache_key])
+                else:
+                    self.pending_results[cache_key] = threading.Event()
+                    fetch_indexes.append(key_index)
+        return fetch_indexes, pending_events
+
+    def get_results(self, cache_keys, influxdb_results):
+        """
+            influxdb_results: [] filled with the results of cache_keys
+                              found in the cache, the others being left
+                              unclaimed, as an event loop merges its own
+                              statements in flight
+            return: [<indexes_to_fetch>]
+        """
+        now = time.time()
+        fetch_indexes = []
+        with self.cached_results_lock:
+            for key_index, cache_key in enumerate(cache_keys):
+                influxdb_result = self.get_cached_result(cache_key, now)
+                if influxdb_result is not None:
+                    influxdb_results[key_index] = influxdb_result
+                else:
+                    fetch_indexes.append(key_index)
+        return fetch_indexes
+
+    def set_results(self, cache_keys, influxdb_results):
+        """
+            influxdb_results: [<results_of_cache_keys>] (None: not fetched)
+        """
+        now = time.time()
+        with self.cached_results_lock:
+            for cache_key, influxdb_result in zip(cache_keys,
+                                                  influxdb_results):
+                if influxdb_result is not None and \
+                        'error' not in influxdb_result:
+                    self.cached_results.pop(cache_key, None)
+                    self.cached_results[cache_key] = (now, influxdb_result)
+                pending_event = self.pending_results.pop(cache_key, None)
+                if pending_event:
+                    pending_event.set()
+            while len(self.cached_results) > self.max_size:
+                self.cached_results.popitem(last=False)
+        return True
+
+
+class QueryPlan:
+    """
+        influxql statements and encoded requests of the checks of a run,
+        saved in '<json_path>.plan' for the next runs of the same
+        customers until the json file changes, the queries not depending
+        on the time of the run being then neither built nor encoded again
+    """
+    plan_version = 2
+
+    def __init__(self):
+        self.plan_path = ''
+        self.plan_scope = None
+        self.file_hash = ''
+        self.statements = {}
+        self.requests = {}
+        self.planned_statements = set()
+        self.plan_changed = False
+
+    def __repr__(self):
+        print_message = "Plan path: '{0}'\n".format(self.plan_path)
+        print_message += 'Plan scope: {0}\n'.format(self.plan_scope)
+        print_message += 'Statements: {0}\n'.format(len(self.statements))
+        print_message += 'Requests: {0}\n'.format(len(self.requests))
+        return print_message
+
+    def load_plan(self, json_path='', plan_scope=None):
+        """
+            plan_scope: customer name, (shard_index, shard_count) or None
+                        (all the customers) of the run, every scope
+                        having its own plan
+        """
+        json_path = json_path if json_path else 'check_map.json'
+        self.plan_path = '{0}.plan'.format(json_path)
+        self.plan_scope = plan_scope
+        self.file_hash = get_check_map_index(json_path).file_hash
+        self.statements = {}
+        self.requests = {}
+        self.plan_changed = False
+        plan_header, plan_items = load_marshal_items(self.plan_path)
+        if plan_header and \
+                plan_header.get('plan_version') == self.plan_version and \
+                plan_header.get('file_hash') == self.file_hash and \
+                plan_scope in plan_header['item_offsets']:
+            scope_plan = load_marshal_item(plan_header['item_offsets'],
+                                           plan_items, plan_scope)
+            self.statements = scope_plan['statements']
+            self.requests = scope_plan['requests']
+        self.planned_statements = set(self.statements.values())
+        return len(self.statements)
+
+    def save_plan(self):
+        """
+            return: True if the plan got new queries and has been saved,
+                    with the plans of the other scopes of the same json
+        """
+        if not self.plan_path or not self.plan_changed:
+            return False
+        scope_plans = {}
+        plan_header, plan_items = load_marshal_items(self.plan_path)
+        if plan_header and \
+                plan_header.get('plan_version') == self.plan_version and \
+                plan_header.get('file_hash') == self.file_hash:
+            for plan_scope in plan_header['item_offsets']:
+                scope_plans[plan_scope] = load_marshal_item(
+                    plan_header['item_offsets'], plan_items, plan_scope)
+        scope_plans[self.plan_scope] = {'statements': self.statements,
+                                        'requests': self.requests}
+        self.plan_changed = False
+        return save_marshal_items(self.plan_path,
+                                 {'plan_version': self.plan_version,
+                                  'file_hash': self.file_hash},
+                                 scope_plans)
+
+    def get_scope_plan(self):
+        """
+            return: {'statements': ..., 'requests': ...} of the run, None
+                    if it got no new queries
+        """
+        if not self.plan_path or not self.plan_changed:
+            return None
+        return {'statements': self.statements, 'requests': self.requests}
+
+    def merge_plan(self, scope_plan):
+        """
+            scope_plan: plan of the same scope got by another process of
+                        the run, as returned by get_scope_plan
+        """
+        if not self.plan_path or not scope_plan:
+            return False
+        for statement_key, influxdb_query in \
+                scope_plan['statements'].items():
+            if statement_key not in self.statements:
+                self.set_statement(statement_key, influxdb_query)
+        for request_key, influxdb_request in scope_plan['requests'].items():
+            if request_key not in self.requests:
+                self.set_request(request_key, influxdb_request)
+        return self.plan_changed
+
+    def get_statement(self, statement_key):
+        if not self.plan_path:
+            return None
+        return self.statements.get(statement_key)
+
+    def set_statement(self, statement_key, influxdb_query):
+        """
+            statement_key: (measure, ..., series_names) of the first query
+                           stage of a check, only the statements coming
+                           from the check map being planned
+        """
+        if not self.plan_path:
+            return False
+        self.statements[statement_key] = influxdb_query
+        self.planned_statements.add(influxdb_query)
+        self.plan_changed = True
+        return True
+
+    def get_request(self, request_key):
+        if not self.plan_path:
+            return None
+        return self.requests.get(request_key)
+
+    def set_request(self, request_key, influxdb_request):
+        """
+            request_key: (database, influxdb_queries, ...), only the
+                         requests of planned statements being kept, up to
+                         one per statement, as the packing of the
+                         statements may change from a run to the next
+                         one without the plan being saved again
+        """
+        if not self.plan_path or \
+                len(self.requests) >= len(self.statements):
+            return False
+        for influxdb_query in request_key[1]:
+            if influxdb_query not in self.planned_statements:
+                return False
+        self.requests[request_key] = influxdb_request
+        return True
+
+
+class QueryFuture:
+    """
+        result of a request run by an InfluxDBEventLoop, set only once
+    """
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.error = None
+        self.done_callbacks = []
+
+    def __repr__(self):
+        print_message = 'Done: {0}\n'.format(self.done)
+        if self.error is not None:
+            print_message += 'Error: {0}\n'.format(repr(self.error))
+        return print_message
+
+    def add_done_callback(self, done_callback):
+        if self.done:
+            done_callback(self)
+        else:
+            self.done_callbacks.append(done_callback)
+        return True
+
+    def set_result(self, result):
+        return self.set_done(result, None)
+
+    def set_error(self, error):
+        return self.set_done(None, error)
+
+    def set_done(self, result, error):
+        if self.done:
+            return False
+        self.done = True
+        self.result = result
+        self.error = error
+        done_callbacks = self.done_callbacks
+        self.done_callbacks = []
+        for done_callback in done_callbacks:
+            done_callback(self)
+        return True
+
+    def get_result(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class AsyncInfluxDBConnection:
+    """
+        non blocking keep-alive http connection to an influxdb endpoint,
+        sending one request at a time
+    """
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = str(port)
+        self.sock = None
+        self.fileno = None
+        self.state = 'closed'
+        self.idle_since = time.time()
+        self.requests_sent = 0
+        self.query_request = None
+        self.reset_response()
+
+    def __repr__(self):
+        print_message = "Endpoint: '{0}:{1}'\n".format(self.ip, self.port)
+        print_message += "State: '{0}'\n".format(self.state)
+        print_message += 'Requests sent: {0}\n'.format(self.requests_sent)
+        return print_message
+
+    def reset_response(self):
+        self.send_buffer = ''
+        self.receive_buffer = ''
+        self.response_status = None
+        self.response_reason = ''
+        self.response_headers = {}
+        self.response_chunks = []
+        self.response_length = None
+        self.response_chunked = False
+        self.response_keep_alive = False
+        self.response_bytes = 0
+        self.operation_start = time.time()
+
+    def open(self):
+        family, socket_type, protocol, canonical_name, address = \
+            socket.getaddrinfo(self.ip, int(self.port), 0,
+                               socket.SOCK_STREAM)[0]
+        self.sock = socket.socket(family, socket_type, protocol)
+        self.sock.setblocking(0)
+        self.fileno = self.sock.fileno()
+        connect_error = self.sock.connect_ex(address)
+        if connect_error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+                                 errno.EALREADY):
+            raise socket.error(connect_error, os.strerror(connect_error))
+        self.state = 'connecting'
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.state = 'closed'
+        return True
+
+    def is_stale(self):
+        # a reused connection closed by the server before answering
+        return self.requests_sent > 1 and self.response_bytes == 0
+
+    def start_request(self, query_request, accept_gzip=True):
+        self.query_request = query_request
+        self.reset_response()
+        request_headers = {'Host': '{0}:{1}'.format(self.ip, self.port)}
+        if accept_gzip:
+            request_headers['Accept-Encoding'] = 'gzip'
+        if query_request['body'] is not None:
+            request_headers['Content-Length'] = len(query_request['body'])
+        request_headers.update(query_request['headers'])
+        request_lines = ['{0} {1} HTTP/1.1'.format(query_request['method'],
+                                                   query_request['url'])]
+        request_lines.extend(['{0}: {1}'.format(header_name, header_value)
+                              for header_name, header_value
+                              in request_headers.items()])
+        self.send_buffer = '\r\n'.join(request_lines) + '\r\n\r\n' + \
+            (query_request['body'] or '')
+        self.requests_sent += 1
+        if self.sock is None:
+            return self.open()
+        self.state = 'sending'
+        return True
+
+    def is_writing(self):
+        return self.state in ('connecting', 'sending')
+
+    def handle_write(self):
+        request_timing = self.query_request['request_timing']
+        if self.state == 'connecting':
+            connect_error = self.sock.getsockopt(socket.SOL_SOCKET,
+                                                 socket.SO_ERROR)
+            if connect_error:
+                raise socket.error(connect_error, os.strerror(connect_error))
+            request_timing['connect_time'] += \
+                time.time() - self.operation_start
+            self.operation_start = time.time()
+            self.state = 'sending'
+        try:
+            bytes_sent = self.sock.send(self.send_buffer)
+        except socket.error as send_error:
+            if send_error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        self.send_buffer = self.send_buffer[bytes_sent:]
+        if not self.send_buffer:
+            self.state = 'receiving'
+        return False
+
+    def handle_read(self, read_size=65536):
+        """
+            return: the response is complete
+        """
+        request_timing = self.query_request['request_timing']
+        try:
+            response_data = self.sock.recv(read_size)
+        except socket.error as receive_error:
+            if receive_error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        if not response_data:
+            if self.response_status is not None and \
+                    not self.response_chunked and \
+                    self.response_length is None:
+                # body delimited by the end of the connection
+                self.response_keep_alive = False
+                self.response_chunks.append(self.receive_buffer)
+                self.receive_buffer = ''
+                return True
+            if not self.response_bytes:
+                raise httplib.BadStatusLine('')
+            raise httplib.IncompleteRead(self.receive_buffer)
+        if not self.response_bytes:
+            request_timing['first_byte_time'] += \
+                time.time() - self.operation_start
+            self.operation_start = time.time()
+        self.response_bytes += len(response_data)
+        self.receive_buffer += response_data
+        response_done = self.parse_response()
+        if response_done:
+            request_timing['transfer_time'] += \
+                time.time() - self.operation_start
+        return response_done
+
+    def parse_response(self):
+        if self.response_status is None:
+            header_end = self.receive_buffer.find('\r\n\r\n')
+            if header_end < 0:
+                return False
+            header_lines = self.receive_buffer[:header_end].split('\r\n')
+            self.receive_buffer = self.receive_buffer[header_end + 4:]
+            status_line = header_lines[0].split(' ', 2)
+            if len(status_line) < 2 or not status_line[1].isdigit():
+                raise httplib.BadStatusLine(header_lines[0])
+            self.response_status = int(status_line[1])
+            self.response_reason = status_line[2] \
+                if len(status_line) > 2 else ''
+            for header_line in header_lines[1:]:
+                header_name, header_separator, header_value = \
+                    header_line.partition(':')
+                self.response_headers[header_name.strip().lower()] = \
+                    header_value.strip()
+            connection_header = self.response_headers.get(
+                'connection', '').lower()
+            if status_line[0] == 'HTTP/1.0':
+                self.response_keep_alive = connection_header == 'keep-alive'
+            else:
+                self.response_keep_alive = connection_header != 'close'
+            self.response_chunked = 'chunked' in self.response_headers.get(
+                'transfer-encoding', '').lower()
+            if 'content-length' in self.response_headers:
+                try:
+                    self.response_length = int(
+                        self.response_headers['content-length'])
+                except ValueError:
+                    # read until closed, as httplib does
+                    self.response_length = None
+            if self.response_status in (204, 304) or \
+                    100 <= self.response_status < 200:
+                self.response_length = 0
+        if self.response_chunked:
+            while True:
+                line_end = self.receive_buffer.find('\r\n')
+                if line_end < 0:
+                    return False
+                try:
+                    chunk_size = int(
+                        self.receive_buffer[:line_end].split(';')[0], 16)
+                except ValueError:
+                    raise httplib.IncompleteRead(self.receive_buffer)
+                if not chunk_size:
+                    # last chunk, then optional trailers and an empty line
+                    if self.receive_buffer.find('\r\n\r\n',
+                                                line_end) < 0:
+                        return False
+                    self.receive_buffer = ''
+                    return True
+                chunk_end = line_end + 2 + chunk_size
+                if len(self.receive_buffer) < chunk_end + 2:
+                    return False
+                self.response_chunks.append(
+                    self.receive_buffer[line_end + 2:chunk_end])
+                self.receive_buffer = self.receive_buffer[chunk_end + 2:]
+        if self.response_length is not None and \
+                len(self.receive_buffer) >= self.response_length:
+            self.response_chunks.append(
+                self.receive_buffer[:self.response_length])
+            self.receive_buffer = ''
+            return True
+        return False
+
+    def get_response_body(self):
+        response_body = ''.join(self.response_chunks)
+        self.query_request['request_timing']['response_bytes'] = \
+            len(response_body)
+        if self.response_headers.get('content-encoding') == 'gzip':
+            response_body = zlib.decompress(response_body,
+                                            16 + zlib.MAX_WBITS)
+        return response_body
+
+
+class InfluxDBEventLoop:
+    """
+        max_connections: max number of connections open to every
+                         (ip, port) influxdb endpoint, the requests over
+                         it waiting for a free one
+        idle_timeout: seconds after which an idle connection is closed
+        accept_gzip: ask for gzip compressed responses
+        every request is sent and read by the thread running the loop
+    """
+    def __init__(self, max_connections=64, idle_timeout=60,
+                 accept_gzip=True):
+        self.max_connections = max(max_connections, 1)
+        self.idle_timeout = idle_timeout
+        self.accept_gzip = accept_gzip
+        self.open_connections = {}
+        self.idle_connections = {}
+        self.waiting_requests = {}
+        self.busy_connections = {}
+        self.pending_queries = {}
+        self.poller = select.poll() if hasattr(select, 'poll') else None
+
+    def __repr__(self):
+        print_message = 'Max connections: {0}\n'.format(self.max_connections)
+        print_message += 'Idle timeout: {0}\n'.format(self.idle_timeout)
+        print_message += 'Busy connections: {0}\n'.format(
+            len(self.busy_connections))
+        for endpoint, connections in sorted(self.idle_connections.items()):
+            print_message += "Idle connections to '{0}:{1}': " \
+                             "{2}\n".format(endpoint[0], endpoint[1],
+                                            len(connections))
+        return print_message
+
+    def request(self, ip, port, method, url, body=None, headers=None,
+                timeout=None):
+        """
+            timeout: seconds the request may wait, for a connection too
+                     (None: no limit)
+            return: QueryFuture of (response_body, request_timing)
+        """
+        query_request = {'method': method,
+                         'url': url,
+                         'body': body,
+                         'headers': headers if headers else {},
+                         'future': QueryFuture(),
+                         'deadline': time.time() + timeout
+                         if timeout else None,
+                         'request_timing': {'connect_time': 0.0,
+                                            'first_byte_time': 0.0,
+                                            'transfer_time': 0.0,
+                                            'response_bytes': 0},
+                         'retried': False}
+        endpoint = (ip, str(port))
+        self.waiting_requests.setdefault(endpoint, collections.deque()).append(
+            query_request)
+        self.dispatch_requests(endpoint)
+        return query_request['future']
+
+    def dispatch_requests(self, endpoint):
+        waiting_requests = self.waiting_requests.get(endpoint)
+        while waiting_requests:
+            connection = self.get_connection(endpoint)
+            if connection is None:
+                break
+            self.start_request(connection, waiting_requests.popleft())
+        return True
+
+    def get_connection(self, endpoint):
+        now = time.time()
+        idle_connections = self.idle_connections.get(endpoint, [])
+        while idle_connections:
+            connection = idle_connections.pop()
+            if now - connection.idle_since <= self.idle_timeout:
+                return connection
+            self.close_connection(connection)
+        if self.open_connections.get(endpoint, 0) >= self.max_connections:
+            return None
+        self.open_connections[endpoint] = \
+            self.open_connections.get(endpoint, 0) + 1
+        return AsyncInfluxDBConnection(endpoint[0], endpoint[1])
+
+    def close_connection(self, connection):
+        connection.close()
+        endpoint = (connection.ip, connection.port)
+        self.open_connections[endpoint] -= 1
+        return True
+
+    def close_connections(self):
+        for idle_connections in self.idle_connections.values():
+            for connection in idle_connections:
+                self.close_connection(connection)
+        self.idle_connections = {}
+        return True
+
+    def watch_connection(self, connection):
+        self.busy_connections[connection.fileno] = connection
+        if self.poller is not None:
+            self.poller.register(connection.fileno,
+                                 select.POLLOUT if connection.is_writing()
+                                 else select.POLLIN)
+        return True
+
+    def unwatch_connection(self, connection):
+        if connection.fileno is None:
+            return False
+        self.busy_connections.pop(connection.fileno, None)
+        if self.poller is not None:
+            try:
+                self.poller.unregister(connection.fileno)
+            except KeyError:
+                pass
+        return True
+
+    def start_request(self, connection, query_request):
+        try:
+            connection.start_request(query_request, self.accept_gzip)
+        except influxdb_errors as request_error:
+            return self.end_request(connection, request_error)
+        return self.watch_connection(connection)
+
+    def end_request(self, connection, request_error=None, retry=False):
+        query_request = connection.query_request
+        query_future = query_request['future']
+        endpoint = (connection.ip, connection.port)
+        self.unwatch_connection(connection)
+        if request_error is None:
+            try:
+                response_body = connection.get_response_body()
+            except influxdb_errors as response_error:
+                request_error = response_error
+        connection.query_request = None
+        if request_error is not None:
+            self.close_connection(connection)
+            if retry and not query_request['retried']:
+                query_request['retried'] = True
+                self.waiting_requests[endpoint].appendleft(query_request)
+            else:
+                query_future.set_error(request_error)
+            return self.dispatch_requests(endpoint)
+        if connection.response_keep_alive:
+            connection.idle_since = time.time()
+            connection.state = 'idle'
+            self.idle_connections.setdefault(endpoint, []).append(connection)
+        else:
+            self.close_connection(connection)
+        if connection.response_status != 200:
+            query_future.set_error(urllib2.HTTPError(
+                'http://{0}:{1}{2}'.format(endpoint[0], endpoint[1],
+                                           query_request['url']),
+                connection.response_status, connection.response_reason,
+                connection.response_headers, None))
+        else:
+            query_future.set_result((response_body,
+                                     query_request['request_timing']))
+        return self.dispatch_requests(endpoint)
+
+    def get_wait_time(self, max_wait_time):
+        now = time.time()
+        request_deadlines = [
+            connection.query_request['deadline']
+            for connection in self.busy_connections.values()
+            if connection.query_request['deadline'] is not None]
+        for waiting_requests in self.waiting_requests.values():
+            request_deadlines.extend([
+                query_request['deadline'] for query_request
+                in waiting_requests if query_request['deadline'] is not None])
+        if not request_deadlines:
+            return max_wait_time
+        return max(min(min(request_deadlines) - now, max_wait_time), 0)
+
+    def wait_events(self, wait_time):
+        """
+            return: [<list_of_connections_ready_to_send_or_receive>]
+        """
+        if self.poller is not None:
+            return [self.busy_connections[fileno]
+                    for fileno, poll_event
+                    in self.poller.poll(wait_time * 1000)
+                    if fileno in self.busy_connections]
+        write_connections = [connection for connection
+                             in self.busy_connections.values()
+                             if connection.is_writing()]
+        read_connections = [connection for connection
+                            in self.busy_connections.values()
+                            if not connection.is_writing()]
+        read_ready, write_ready, error_ready = select.select(
+            [connection.sock for connection in read_connections],
+            [connection.sock for connection in write_connections],
+            [connection.sock for connection in write_connections],
+            wait_time)
+        ready_sockets = set(read_ready + write_ready + error_ready)
+        return [connection for connection
+                in read_connections + write_connections
+                if connection.sock in ready_sockets]
+
+    def expire_requests(self):
+        now = time.time()
+        for connection in self.busy_connections.values():
+            if connection.query_request is None:
+                continue
+            request_deadline = connection.query_request['deadline']
+            if request_deadline is not None and request_deadline <= now:
+                self.end_request(connection, socket.timeout('timed out'))
+        for waiting_requests in self.waiting_requests.values():
+            for query_request in list(waiting_requests):
+                if query_request['deadline'] is not None and \
+                        query_request['deadline'] <= now:
+                    waiting_requests.remove(query_request)
+                    query_request['future'].set_error(
+                        socket.timeout('timed out'))
+        return True
+
+    def run_once(self, max_wait_time=1.0):
+        for connection in self.wait_events(
+                self.get_wait_time(max_wait_time)):
+            if connection.query_request is None:
+                # ended by a callback of a previous event
+                continue
+            request_done = False
+            request_error = None
+            try:
+                if connection.is_writing():
+                    connection.handle_write()
+                    self.watch_connection(connection)
+                else:
+                    request_done = connection.handle_read()
+            except influxdb_errors as connection_error:
+                request_done = True
+                request_error = connection_error
+            if request_done:
+                self.end_request(connection, request_error,
+                                 request_error is not None and
+                                 connection.is_stale())
+        self.expire_requests()
+        return True
+
+    def run_until_complete(self, futures):
+        """
+            futures: [<list_of_query_futures_to_wait_for>]
+            return: futures, every one of them done
+        """
+        while not all([future.done for future in futures]):
+            if not self.busy_connections:
+                break
+            self.run_once()
+        return futures
+
+
+class InvalidResponse(Exception):
+    def __init__(self, reason='', source_name=''):
+        self.reason = reason
+        self.source_name = source_name
+
+    def __str__(self):
+        exception_message = ''
+        if self.reason:
+            exception_message += "'{0}'".format(self.reason)
+        if self.source_name:
+            exception_message += " from '{0}'".format(self.source_name)
+        return exception_message
+
+
+influxdb_connection_pool = InfluxDBConnectionPool()
+influxdb_query_cache = QueryCache()
+influxdb_query_plan = QueryPlan()
+influxdb_errors = (httplib.HTTPException, socket.error, urllib2.URLError,
+                   zlib.error, InvalidResponse)
+influxdb_query_timings = QueryTimings()
+startup_timings = StartupTimings()
+influxdb_max_url_length = 4096
+# seconds of every rollup point, and min sanity window of 'rollup' checks
+rollup_interval = 60
+rollup_min_window = 5 * rollup_interval
+check_state_overlap = 60
+check_map_indexes = {}
+shard_worker = {}
+check_map_indexes_lock = threading.Lock()
+interned_strings = {}
+
+
+class FeatureAvailabilityQuery:
+    """
+        series_names: [<list_of_(host, testcase, transaction)_to_check>]
+        check_mode: 'fetch' (every point of the sanity period),
+                    'pushdown' (let influxdb look for the 'ok' point),
+                    'stream' (read points in chunks until the 'ok' one)
+                    or 'rollup' (count the 'ok' points of the per minute
+                    rollup, then as 'pushdown' for the series without)
+        series_grouped: one group by query for all the series_names
+        series_states: {<series_name>: <state_of_the_previous_runs>},
+                       query only the points newer than the last query
+        availability_mode: availability_modes key, any mode but
+                           'at_least_one_ok' fetching every point
+        availability_warning: metric threshold of the warning checks
+                              (None: the availability_modes default)
+        availability_critical: metric threshold of the critical checks
+                               (None: the availability_modes default)
+        max_rows: max number of points of every series fetched at once,
+                  a series cut by it or by the influxdb max-row-limit
+                  being fetched again in older time ranges, newest first,
+                  until its check is decided (0: no limit)
+    """
+    series_tags = ['host', 'test_name', 'transaction_name']
+
+    def __init__(self, measure, series_names, feature_name, measure_unit,
+                 sanity_period, check_mode='fetch', series_grouped=False,
+                 series_states=None, availability_mode='at_least_one_ok',
+                 availability_warning=None, availability_critical=None,
+                 max_rows=10000):
+        self.measure = measure
+        self.series_names = [tuple(series_name)
+                             for series_name in series_names]
+        self.feature_name = feature_name
+        self.seconds_from_now = get_seconds_from_now(measure_unit,
+                                                     sanity_period)
+        self.availability_mode = availability_mode
+        self.availability_warning = availability_warning
+        self.availability_critical = availability_critical
+        if availability_mode != 'at_least_one_ok' and \
+                check_mode in ('pushdown', 'rollup'):
+            # the metric needs every point, not only the 'ok' one
+            check_mode = 'fetch'
+        elif check_mode == 'rollup' and \
+                self.seconds_from_now < rollup_min_window:
+            # too few rollup points, the latest ones not rolled up yet
+            check_mode = 'pushdown'
+        self.check_mode = check_mode
+        self.series_grouped = series_grouped
+        self.series_states = series_states
+        self.query_time = time.time()
+        self.window_start = self.query_time - self.seconds_from_now
+        self.time_from = self.get_time_from()
+        self.series_checks = {}
+        self.series_times = {}
+        self.series_names_to_check = self.series_names[:]
+        # series not checked by the query stage, for the next one
+        self.series_names_deferred = []
+        self.max_rows = max(max_rows, 0)
+        # {<series_name>: [<fetched_series_of_every_time_range>]}
+        self.series_pages = {}
+        # {<series_name>: [time_to, time_span, skip_points]} of the cut
+        # series, the skip_points latest of the time_to second fetched
+        self.page_ranges = collections.OrderedDict()
+        self.query_error = None
+        if self.check_mode == 'rollup':
+            self.query_stage = 'rollup'
+        elif self.check_mode == 'pushdown':
+            self.query_stage = 'ok'
+        else:
+            self.query_stage = 'fetch'
+        self.first_query_stage = self.query_stage
+
+    def __repr__(self):
+        print_message = "Query stage: '{0}'\n".format(self.query_stage)
+        print_message += 'Query: {0}\n'.format(self.get_query())
+        return print_message
+
+    def is_done(self):
+        return self.query_stage == 'done'
+
+    def get_time_from(self):
+        if self.series_states is None:
+            return None
+        series_times_from = []
+        for series_name in self.series_names:
+            series_state = self.series_states.get(series_name)
+            if not series_state or not series_state.get('last_query'):
+                return None
+            series_time_from = series_state['last_query'] - \
+                check_state_overlap
+            if series_time_from <= self.window_start:
+                return None
+            series_times_from.append(series_time_from)
+        return min(series_times_from)
+
+    def get_query(self):
+        if self.is_done():
+            return None
+        series_names = self.series_names_to_check
+        time_from = self.time_from
+        time_to = None
+        skip_points = 0
+        if self.query_stage == 'fetch' and self.page_ranges:
+            # the next time range of the first cut series, with every cut
+            # series paged up to the same point
+            series_names, time_from, time_to, skip_points = \
+                self.get_page_range()
+        if time_from or time_to or \
+                self.query_stage != self.first_query_stage or \
+                series_names != self.series_names:
+            # depends on the results of the run, not planned
+            return self.build_query(series_names, time_from, time_to,
+                                    skip_points)
+        statement_key = (self.measure, self.feature_name,
+                         self.seconds_from_now, self.check_mode,
+                         self.max_rows, self.query_stage,
+                         self.series_grouped, tuple(series_names))
+        influxdb_query = influxdb_query_plan.get_statement(statement_key)
+        if influxdb_query is None:
+            influxdb_query = self.build_query(series_names)
+            influxdb_query_plan.set_statement(statement_key, influxdb_query)
+        return influxdb_query
+
+    def build_query(self, series_names, time_from=None, time_to=None,
+                    skip_points=0):
+        """
+            time_to: paged up to this second, included, its skip_points
+                     latest points being already fetched
+        """
+        feature_filter = {}
+        feature_filters = None
+        feature_groups = None
+        if self.series_grouped:
+            feature_filters = [dict(zip(self.series_tags, series_name))
+                               for series_name in series_names]
+            feature_groups = self.series_tags
+        else:
+            feature_filter.update(zip(self.series_tags, series_names[0]))
+        # only the columns the check reads, the series tags being known
+        features = ['time', self.feature_name]
+        measure = self.measure
+        if self.query_stage == 'rollup':
+            features = ['sum(ok) AS ok']
+            measure = get_rollup_measure(self.measure, self.feature_name)
+            feature_limit = None
+        elif self.query_stage == 'ok':
+            feature_filter[self.feature_name] = 'ok'
+            feature_limit = 1
+        else:
+            feature_limit = self.get_fetch_limit()
+        return get_influxdb_query(measure=measure,
+                                  seconds_from_now=self.seconds_from_now,
+                                  features=features,
+                                  feature_filter=feature_filter,
+                                  feature_order='desc',
+                                  feature_filters=feature_filters,
+                                  feature_groups=feature_groups,
+                                  feature_limit=feature_limit,
+                                  time_from=time_from,
+                                  time_to=time_to,
+                                  time_to_included=time_to is not None,
+                                  feature_offset=skip_points)
+
+    def get_fetch_limit(self):
+        if self.check_mode in ('pushdown', 'rollup'):
+            # no 'ok' point: one point tells critical from unknown
+            return 1
+        elif self.check_mode == 'stream':
+            # chunked responses are not cut by the max-row-limit
+            return None
+        return self.max_rows or None
+
+    def get_page_range(self):
+        """
+            return: (series_names, time_from, time_to, skip_points) of the
+                    next time range of the first cut series, shared by
+                    every cut series paged up to the same point, time_from
+                    being self.time_from once the range reaches the start
+                    of the window
+        """
+        time_to, time_span, skip_points = next(
+            iter(self.page_ranges.values()))
+        series_names = [series_name for series_name, page_range
+                        in self.page_ranges.items()
+                        if page_range[0] == time_to and
+                        page_range[2] == skip_points]
+        time_from = time_to - min([self.page_ranges[series_name][1]
+                                   for series_name in series_names])
+        if time_from <= (self.time_from or self.window_start):
+            time_from = self.time_from
+        return series_names, time_from, time_to, skip_points
+
+    def is_series_cut(self, influxdb_series):
+        """
+            return: True if the max-row-limit or the limit of max_rows,
+                    applied to every series, may have cut the series
+        """
+        if influxdb_series.get('partial'):
+            return True
+        elif not self.max_rows or \
+                self.get_fetch_limit() != self.max_rows:
+            return False
+        return len(influxdb_series['values']) >= self.max_rows
+
+    def get_dropped_series_names(self, influxdb_series_list,
+                                 series_names=None):
+        """
+            series_names: series queried (None: the series to check)
+            return: the series_names missing from influxdb_series_list
+                    and sorted after its last series, the ones the
+                    max-row-limit may have dropped, as influxdb sorts the
+                    grouped series by their tags
+        """
+        if series_names is None:
+            series_names = self.series_names_to_check
+        if not self.series_grouped or not influxdb_series_list:
+            return []
+        fetched_series_names = set([
+            self.get_series_name(influxdb_series)
+            for influxdb_series in influxdb_series_list])
+        last_series_name = self.get_series_name(influxdb_series_list[-1])
+        return [series_name for series_name in series_names
+                if series_name not in fetched_series_names and
+                series_name > last_series_name]
+
+    def set_stage_result(self, influxdb_series_list, next_query_stage):
+        """
+            the series dropped by the max-row-limit are queried again in
+            the same stage, then the series not checked in next_query_stage
+        """
+        dropped_series_names = self.get_dropped_series_names(
+            influxdb_series_list)
+        self.series_names_deferred.extend([
+            series_name for series_name in self.series_names_to_check
+            if series_name not in self.series_checks and
+            series_name not in dropped_series_names])
+        if dropped_series_names:
+            self.series_names_to_check = dropped_series_names
+            return self.query_stage
+        self.series_names_to_check = self.series_names_deferred
+        self.series_names_deferred = []
+        self.query_stage = next_query_stage if self.series_names_to_check \
+            else 'done'
+        return self.query_stage
+
+    def is_series_decided(self, influxdb_series):
+        """
+            return: True if the older points cannot change the check of
+                    the series, its latest 'ok' point being fetched
+        """
+        if self.feature_name not in influxdb_series['columns']:
+            return True
+        elif self.availability_mode not in ('at_least_one_ok',
+                                            'last_failures'):
+            return False
+        feature_index = influxdb_series['columns'].index(self.feature_name)
+        return any([measure_point[feature_index] == 'ok'
+                    for measure_point in influxdb_series['values']])
+
+    def add_series_page(self, series_name, influxdb_series):
+        series_pages = self.series_pages.setdefault(series_name, [])
+        if self.availability_mode == 'at_least_one_ok':
+            # only the latest point and the first 'ok' one are needed
+            del series_pages[1:]
+        series_pages.append(influxdb_series)
+        return series_pages
+
+    def set_series_check(self, series_name):
+        self.series_times[series_name] = {}
+        self.series_checks[series_name] = check_series_chunks_availability(
+            self.series_pages.pop(series_name), self.feature_name,
+            self.series_times[series_name], self.availability_mode,
+            self.availability_warning, self.availability_critical)
+        return self.series_checks[series_name]
+
+    def set_fetch_result(self, influxdb_series_list):
+        dropped_series_names = self.get_dropped_series_names(
+            influxdb_series_list)
+        for influxdb_series in influxdb_series_list:
+            series_name = self.get_series_name(influxdb_series)
+            self.add_series_page(series_name, influxdb_series)
+            if self.is_series_cut(influxdb_series) and \
+                    influxdb_series['values'] and \
+                    not self.is_series_decided(influxdb_series):
+                time_to, skip_points = self.get_last_points(
+                    influxdb_series)
+                self.page_ranges[series_name] = [
+                    time_to, max(int(self.query_time - time_to), 1),
+                    skip_points]
+            else:
+                self.set_series_check(series_name)
+        # the other series not fetched have no points in the window
+        self.series_names_to_check = list(self.page_ranges) + \
+            dropped_series_names
+        return self.series_names_to_check
+
+    def set_page_result(self, influxdb_series_list):
+        series_names, time_from, time_to, skip_points = \
+            self.get_page_range()
+        dropped_series_names = self.get_dropped_series_names(
+            influxdb_series_list, series_names)
+        paged_series = dict([(self.get_series_name(influxdb_series),
+                              influxdb_series)
+                             for influxdb_series in influxdb_series_list])
+        for series_name in series_names:
+            if series_name in dropped_series_names:
+                # the same range again
+                continue
+            time_span = self.page_ranges[series_name][1]
+            influxdb_series = paged_series.get(series_name)
+            if influxdb_series:
+                self.add_series_page(series_name, influxdb_series)
+            if influxdb_series and influxdb_series['values'] and \
+                    self.is_series_cut(influxdb_series) and \
+                    not self.is_series_decided(influxdb_series):
+                # go on from the oldest point, in a range as long as this
+                # one, its second's points fetched being skipped
+                last_timestamp, last_points = self.get_last_points(
+                    influxdb_series)
+                if last_timestamp == time_to:
+                    last_points += skip_points
+                self.page_ranges[series_name] = [
+                    last_timestamp, max(int(time_to - last_timestamp), 1),
+                    last_points]
+            elif time_from == self.time_from or (
+                    influxdb_series and
+                    self.is_series_decided(influxdb_series)):
+                del self.page_ranges[series_name]
+                self.set_series_check(series_name)
+            else:
+                # not cut: the next older range can be longer
+                self.page_ranges[series_name] = [time_from, 2 * time_span,
+                                                 0]
+        self.series_names_to_check = [
+            series_name for series_name in self.series_names_to_check
+            if series_name not in self.series_checks]
+        return self.series_names_to_check
+
+    def get_last_timestamp(self, influxdb_series):
+        timestamp_index = influxdb_series['columns'].index('time')
+        return influxdb_series['values'][-1][timestamp_index]
+
+    def get_last_points(self, influxdb_series):
+        """
+            return: (last_timestamp, number of points of its second), the
+                    points of the same second the next page skips
+        """
+        timestamp_index = influxdb_series['columns'].index('time')
+        last_timestamp = self.get_last_timestamp(influxdb_series)
+        last_points = 0
+        for measure_point in reversed(influxdb_series['values']):
+            if measure_point[timestamp_index] != last_timestamp:
+                break
+            last_points += 1
+        return last_timestamp, last_points
+
+    def get_series_name(self, influxdb_series):
+        if not self.series_grouped:
+            return self.series_names_to_check[0]
+        return tuple([influxdb_series['tags'][series_tag]
+                      for series_tag in self.series_tags])
+
+    def set_result(self, influxdb_result):
+        influxdb_series_list = influxdb_result.get('series', [])
+        if not self.series_grouped:
+            influxdb_series_list = influxdb_series_list[:1]
+        if self.query_stage == 'rollup':
+            for influxdb_series in influxdb_series_list:
+                ok_index = influxdb_series['columns'].index('ok')
+                if not any([measure_point[ok_index]
+                            for measure_point in influxdb_series['values']]):
+                    continue
+                series_name = self.get_series_name(influxdb_series)
+                self.series_checks[series_name] = error_level['OK']
+                # the 'ok' points are in the window, their time unknown
+                self.series_times[series_name] = {'last_ok': None,
+                                                  'last_point': None,
+                                                  'complete': False}
+            self.set_stage_result(influxdb_series_list, 'ok')
+        elif self.query_stage == 'ok':
+            for influxdb_series in influxdb_series_list:
+                series_name = self.get_series_name(influxdb_series)
+                self.series_checks[series_name] = error_level['OK']
+                # the latest 'ok' point, not the latest point
+                self.series_times[series_name] = {
+                    'last_ok': influxdb_series['values'][0][
+                        influxdb_series['columns'].index('time')],
+                    'last_point': None,
+                    'complete': False}
+            self.set_stage_result(influxdb_series_list, 'fetch')
+        elif self.query_stage == 'fetch':
+            if self.page_ranges:
+                self.set_page_result(influxdb_series_list)
+            else:
+                self.set_fetch_result(influxdb_series_list)
+            if not self.series_names_to_check:
+                self.query_stage = 'done'
+        return self.is_done()
+
+    def set_result_chunks(self, influxdb_result_chunks):
+        """
+            influxdb_result_chunks: iterator over the chunked results of
+                                    the fetch query
+        """
+        influxdb_series_chunks = (
+            influxdb_series
+            for influxdb_result in influxdb_result_chunks
+            for influxdb_series in influxdb_result.get('series', []))
+        try:
+            for series_name, series_chunks in itertools.groupby(
+                    influxdb_series_chunks, self.get_series_name):
+                self.series_times[series_name] = {}
+                self.series_checks[series_name] = \
+                    check_series_chunks_availability(
+                        series_chunks, self.feature_name,
+                        self.series_times[series_name],
+                        self.availability_mode, self.availability_warning,
+                        self.availability_critical)
+                if not self.series_grouped:
+                    break
+        finally:
+            influxdb_result_chunks.close()
+        self.query_stage = 'done'
+        return self.is_done()
+
+    def set_query_error(self, query_error):
+        """
+            query_error: exception raised by the query, leaving the series
+                         not checked yet unknown
+        """
+        self.query_error = query_error
+        self.query_stage = 'done'
+        return self.is_done()
+
+    def get_check_results(self):
+        check_results = []
+        for series_name in self.series_names:
+            if self.query_error is not None and \
+                    series_name not in self.series_checks:
+                check_results.append(error_level['UNKNOWN'])
+                continue
+            check_result = self.series_checks.get(series_name,
+                                                  error_level['UNKNOWN'])
+            if check_result == error_level['UNKNOWN'] and \
+                    self.series_states and series_name not in \
+                    self.series_times:
+                # no newer points, but the older ones are in the window
+                series_state = self.series_states.get(series_name)
+                if series_state and series_state.get('last_point') and \
+                        series_state['last_point'] > self.window_start:
+                    check_result = error_level['CRITICAL']
+            check_results.append(check_result)
+        return check_results
+
+    def get_series_states(self):
+        series_states = {}
+        for series_name in self.series_names:
+            series_times = self.series_times.get(series_name, {})
+            series_states[series_name] = {
+                'last_ok': series_times.get('last_ok'),
+                'last_point': series_times.get('last_point'),
+                'last_query': self.query_time
+                if series_times.get('complete', True) else None}
+        return series_states
+
+
+class CheckStateStore:
+    """
+        state_path: json file of the last 'ok' point, last point and last
+                    query time of every checked series
+        state_age: seconds after which a series state is forgotten
+    """
+    def __init__(self, state_path='', state_age=86400):
+        self.state_path = state_path if state_path else 'check_state.json'
+        self.lock_path = '{0}.lock'.format(self.state_path)
+        self.state_age = state_age
+        self.series_states = {}
+        self.updated_series_states = {}
+        self.series_states_lock = threading.Lock()
+        self.load_series_states()
+
+    def __repr__(self):
+        print_message = "State path: '{0}'\n".format(self.state_path)
+        print_message += 'State age: {0}\n'.format(self.state_age)
+        print_message += 'Series states: {0}\n'.format(
+            len(self.series_states))
+        return print_message
+
+    def get_store_args(self):
+        return {'state_path': self.state_path, 'state_age': self.state_age}
+
+    def get_state_key(self, check):
+        return u'|'.join([unicode(feature)
+                          for feature in check.get_check_features()[:8]])
+
+    def lock_state_file(self, shared=False):
+        if fcntl is None:
+            return None
+        try:
+            lock_file = open(self.lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        except IOError:
+            return None
+        return lock_file
+
+    def unlock_state_file(self, lock_file):
+        if lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        return True
+
+    def read_series_states(self):
+        try:
+            state_file = open(self.state_path)
+            series_states = json.load(state_file)
+            state_file.close()
+        except (IOError, ValueError):
+            return {}
+        return series_states
+
+    def load_series_states(self):
+        lock_file = self.lock_state_file(shared=True)
+        try:
+            self.series_states = self.read_series_states()
+        finally:
+            self.unlock_state_file(lock_file)
+        return True
+
+    def merge_series_states(self, series_state, new_series_state):
+        if not series_state:
+            return new_series_state
+        merged_series_state = dict(new_series_state)
+        for series_time in ('last_ok', 'last_point'):
+            merged_series_state[series_time] = max(
+                series_state.get(series_time),
+                new_series_state.get(series_time))
+        return merged_series_state
+
+    def get_series_states(self, check_batch):
+        series_states = {}
+        for check in check_batch:
+            series_state = self.series_states.get(self.get_state_key(check))
+            if series_state:
+                series_states[check.get_series_name()] = series_state
+        return series_states
+
+    def check_cached_checks(self, checks):
+        """
+            return: the checks to query, the others being ok thanks to an
+                    'ok' point still in their sanity period
+        """
+        now = time.time()
+        checks_to_query = []
+        for check in checks:
+            if check.check_name == 'check_feature_availability' and \
+                    check.availability_mode == 'at_least_one_ok':
+                series_state = self.series_states.get(
+                    self.get_state_key(check))
+                window_start = now - get_seconds_from_now(check.measure_unit,
+                                                          check.sanity_period)
+                if series_state and series_state.get('last_ok') and \
+                        series_state['last_ok'] > window_start:
+                    check.check_result = error_level['OK']
+                    continue
+            checks_to_query.append(check)
+        return checks_to_query
+
+    def set_series_state(self, check, series_state):
+        state_key = self.get_state_key(check)
+        series_state = dict(series_state)
+        series_state['last_update'] = time.time()
+        with self.series_states_lock:
+            series_state = self.merge_series_states(
+                self.series_states.get(state_key), series_state)
+            self.series_states[state_key] = series_state
+            self.updated_series_states[state_key] = series_state
+        return series_state
+
+    def set_check_packs_states(self, check_packs):
+        for check_pack in check_packs:
+            for check_batch, feature_query in check_pack:
+                if feature_query.query_error is not None:
+                    # not checked: keep the previous states
+                    continue
+                series_states = feature_query.get_series_states()
+                for check in check_batch:
+                    self.set_series_state(
+                        check, series_states[check.get_series_name()])
         return True
 
-    def run_customers_checks(self):
-        for customer in self.customer_names:
-            cc = CustomerInfluxDBCheck(customer_name=customer,
-                                       json_path=self.json_path,
-                                       verbose_level=self.verbose_level)
-            self.customers_checks.append(cc)
+    def save_series_states(self):
+        with self.series_states_lock:
+            lock_file = self.lock_state_file()
+            try:
+                # merge with the states saved by concurrent runs
+                series_states = self.read_series_states()
+                for state_key, series_state in \
+                        self.updated_series_states.items():
+                    saved_series_state = series_states.get(state_key)
+                    if saved_series_state and \
+                            saved_series_state.get('last_update', 0) > \
+                            series_state['last_update']:
+                        series_state = self.merge_series_states(
+                            series_state, saved_series_state)
+                    else:
+                        series_state = self.merge_series_states(
+                            saved_series_state, series_state)
+                    series_states[state_key] = series_state
+                now = time.time()
+                for state_key, series_state in series_states.items():
+                    if now - series_state.get('last_update', 0) > \
+                            self.state_age:
+                        del series_states[state_key]
+                save_json(self.state_path, series_states)
+                self.series_states = series_states
+                self.updated_series_states = {}
+            finally:
+                self.unlock_state_file(lock_file)
+        return True
 
 
 class DataNotFound(Exception):
@@ -322,6 +3290,20 @@ class DataNotFound(Exception):
         return exception_message
 
 
+class QuerySkipped(Exception):
+    def __init__(self, reason='', source_name=''):
+        self.reason = reason
+        self.source_name = source_name
+
+    def __str__(self):
+        exception_message = ''
+        if self.reason:
+            exception_message += "'{0}'".format(self.reason)
+        if self.source_name:
+            exception_message += " on '{0}'".format(self.source_name)
+        return exception_message
+
+
 def load_json(file_path):
     try:
         json_file = open(file_path)
@@ -338,22 +3320,422 @@ def load_json(file_path):
     return json_object
 
 
+def intern_string(string):
+    if not isinstance(string, basestring):
+        return string
+    return interned_strings.setdefault(string, string)
+
+
+def get_check_map_index(json_path=''):
+    """
+        return: the check map index of json_path, shared by every check
+                of the process and rebuilt when the json file changes
+    """
+    json_path = json_path if json_path else 'check_map.json'
+    with check_map_indexes_lock:
+        check_map_index = check_map_indexes.get(json_path)
+        if check_map_index is None or not check_map_index.is_fresh():
+            step_start = time.time()
+            check_map_index = CheckMapIndex(json_path)
+            check_map_indexes[json_path] = check_map_index
+            startup_timings.add_timing('check map', step_start)
+        return check_map_index
+
+
+def save_marshal_items(file_path, header, items):
+    """
+        header: {<dict_marshalled_first>}, saved with the 'item_offsets' of
+                the items
+        items: {<item_name>: <object_marshalled_alone>}, so that loading
+               one of them does not load the others
+        return: True if saved, file_path being replaced at once
+    """
+    item_offsets = {}
+    items_data = []
+    items_size = 0
+    for item_name, item in items.items():
+        item_data = marshal.dumps(item, 2)
+        item_offsets[item_name] = (items_size, len(item_data))
+        items_data.append(item_data)
+        items_size += len(item_data)
+    header_data = marshal.dumps(dict(header, item_offsets=item_offsets), 2)
+    temporary_file_path = '{0}.{1}.tmp'.format(file_path, os.getpid())
+    try:
+        marshal_file = open(temporary_file_path, 'wb')
+        marshal_file.write('{0:016d}'.format(len(header_data)))
+        marshal_file.write(header_data)
+        for item_data in items_data:
+            marshal_file.write(item_data)
+        marshal_file.close()
+        if os.path.isfile(file_path) and os.name == 'nt':
+            os.remove(file_path)
+        os.rename(temporary_file_path, file_path)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def is_private_file(file_path):
+    """
+        return: True if file_path is owned by the user of the run and not
+                writable by the others, False if it may have been written
+                by somebody else
+    """
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return False
+    if os.name == 'nt':
+        return True
+    return file_stat.st_uid == os.getuid() and \
+        not file_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def load_marshal_items(file_path):
+    """
+        return: (header, items_data) saved by save_marshal_items, only the
+                header being loaded, (None, None) if not readable or not
+                private to the user of the run
+    """
+    if not is_private_file(file_path):
+        return None, None
+    try:
+        marshal_file = open(file_path, 'rb')
+        marshal_data = marshal_file.read()
+        marshal_file.close()
+        header_size = int(marshal_data[:16])
+        header = marshal.loads(marshal_data[16:16 + header_size])
+    except Exception:
+        return None, None
+    if not isinstance(header, dict) or 'item_offsets' not in header:
+        return None, None
+    return header, buffer(marshal_data, 16 + header_size)
+
+
+def load_marshal_item(item_offsets, items_data, item_name):
+    item_offset, item_size = item_offsets[item_name]
+    return marshal.loads(items_data[item_offset:item_offset + item_size])
+
+
+def save_json(file_path, json_object):
+    temporary_file_path = '{0}.tmp'.format(file_path)
+    try:
+        json_file = open(temporary_file_path, 'w')
+        json.dump(json_object, json_file)
+        json_file.close()
+        if os.path.isfile(file_path) and os.name == 'nt':
+            os.remove(file_path)
+        os.rename(temporary_file_path, file_path)
+    except (IOError, OSError):
+        print('error | json file saving issue')
+        return False
+    return True
+
+
+def save_query_timings(stats_path, customers_checks):
+    """
+        stats_path: json file where the query timings are saved
+        customers_checks: [<list_of_customer_influxdb_checks>]
+    """
+    query_stats = {'stats_time': time.time(),
+                   'customers': {},
+                   'data_sources': influxdb_query_timings.get_timings()}
+    for customer_checks in customers_checks:
+        query_stats['customers'][customer_checks.customer_name] = \
+            customer_checks.get_query_timings()
+    return save_json(stats_path, query_stats)
+
+
+def get_customer_shard(customer_name, shard_count):
+    """
+        return: the shard, from 1 to shard_count, of customer_name, the
+                same on every host and run
+    """
+    customer_hash = hashlib.md5(customer_name.encode('utf-8')).hexdigest()
+    return int(customer_hash, 16) % shard_count + 1
+
+
+def parse_shard(shard_text):
+    """
+        shard_text: '<shard_number>/<shard_count>'
+        return: (<shard_number>, <shard_count>) or None when not valid
+    """
+    try:
+        shard_number, shard_count = [int(shard_part) for shard_part
+                                     in shard_text.split('/')]
+    except ValueError:
+        return None
+    if not 1 <= shard_number <= shard_count:
+        return None
+    return shard_number, shard_count
+
+
+def set_shard_worker(worker_setup):
+    """
+        worker_setup: see ShardedCustomersInfluxDBChecks.
+                      get_shard_worker_setup
+    """
+    shard_worker['json_path'] = worker_setup['json_path']
+    influxdb_connection_pool.configure(**worker_setup['pool_args'])
+    influxdb_query_cache.configure(**worker_setup['cache_args'])
+    engine_args = dict(worker_setup['engine_args'])
+    if engine_args['check_states']:
+        engine_args['check_states'] = CheckStateStore(
+            **engine_args['check_states'])
+    engine = worker_setup['engine_class'](**engine_args)
+    # the deadline of the whole run, not restarted by the worker
+    engine.deadline = worker_setup['deadline']
+    shard_worker['engine'] = engine
+    if worker_setup['plan_cache']:
+        load_query_plan(worker_setup['json_path'],
+                        worker_setup['plan_scope'])
+    return True
+
+
+def run_shard_worker(customer_names):
+    """
+        return: ({<customer_name>: <check_status>}, <query_timings>,
+                <scope_plan>) of the customers checks run at once by a
+                worker process, scope_plan being None if its query plan
+                got no new queries
+    """
+    influxdb_query_timings.reset_timings()
+    customers_checks = [CustomerInfluxDBCheck(
+        customer_name=customer_name,
+        json_path=shard_worker['json_path'],
+        engine=shard_worker['engine'])
+        for customer_name in customer_names]
+    shard_worker['engine'].run_checks(
+        [check for customer_checks in customers_checks
+         for check in customer_checks.check_sequence])
+    customers_statuses = {}
+    for customer_checks in customers_checks:
+        customer_checks.analyze_check_results()
+        customers_statuses[customer_checks.customer_name] = \
+            customer_checks.get_check_status()
+    return customers_statuses, influxdb_query_timings.get_timings(), \
+        influxdb_query_plan.get_scope_plan()
+
+
+def get_rollup_measure(measure, feature_name):
+    return '{0}_{1}_rollup'.format(measure, feature_name)
+
+
+def get_rollup_queries(database, measure, feature_name, seconds_from_now=0):
+    """
+        seconds_from_now: seconds of raw points to roll up at once, for
+                          the rollup to cover the sanity windows before
+                          the continuous queries fill it (0: none)
+        return: [<list_of_influxql_statements_counting_every_minute_the_
+                 total_and_'ok'_points_of_every_series>]
+    """
+    rollup_measure = get_rollup_measure(measure, feature_name)
+    rollup_groups = 'GROUP BY time({0}s), {1}'.format(
+        rollup_interval, ', '.join(FeatureAvailabilityQuery.series_tags))
+    rollup_statements = []
+    for rollup_field, rollup_selection in [
+            ('total', []), ('ok', ["{0} = 'ok'".format(feature_name)])]:
+        rollup_select = 'SELECT count({0}) AS {1} INTO "{2}".."{3}" ' \
+                        'FROM {4}'.format(feature_name, rollup_field,
+                                          database, rollup_measure, measure)
+        rollup_statements.append((rollup_field, rollup_select,
+                                  rollup_selection))
+    rollup_queries = []
+    for rollup_field, rollup_select, rollup_selection in rollup_statements:
+        rollup_where = ''
+        if rollup_selection:
+            rollup_where = ' WHERE ' + ' AND '.join(rollup_selection)
+        # late points counted again for two more intervals
+        rollup_queries.append(
+            'CREATE CONTINUOUS QUERY "{0}_{1}" ON "{2}" '
+            'RESAMPLE FOR {3}s BEGIN {4}{5} {6} END'.format(
+                rollup_measure, rollup_field, database,
+                3 * rollup_interval, rollup_select, rollup_where,
+                rollup_groups))
+    if seconds_from_now:
+        for rollup_field, rollup_select, rollup_selection in \
+                rollup_statements:
+            rollup_where = ' WHERE ' + ' AND '.join(rollup_selection + [
+                'time > now() - {0}s'.format(seconds_from_now),
+                'time < now()'])
+            rollup_queries.append('{0}{1} {2}'.format(
+                rollup_select, rollup_where, rollup_groups))
+    return rollup_queries
+
+
+def get_check_map_rollup_queries(json_path='', customer_names=None):
+    """
+        customer_names: [<list_of_customers_to_roll_up>] (None: all)
+        return: [<list_of_(ip, port, database, rollup_queries)>] of the
+                measurements and features checked by the check map
+    """
+    check_map_index = get_check_map_index(json_path)
+    if customer_names is None:
+        customer_names = check_map_index.customer_names
+    rollup_windows = collections.OrderedDict()
+    for customer_name in customer_names:
+        for check_name, check_feature, check_options in \
+                check_map_index.get_customer_index(customer_name)['checks']:
+            if check_name != 'check_feature_availability':
+                continue
+            check = CheckRecord(check_name, check_feature,
+                                check_options=check_options)
+            rollup_key = (check.data_source_ip, check.data_source_port,
+                          check.database_name, check.measurement_name,
+                          check.feature_name)
+            rollup_windows[rollup_key] = max(
+                rollup_windows.get(rollup_key, 0),
+                get_seconds_from_now(check.measure_unit,
+                                     check.sanity_period))
+    return [(ip, port, database, get_rollup_queries(database, measure,
+                                                    feature_name,
+                                                    seconds_from_now))
+            for (ip, port, database, measure, feature_name),
+            seconds_from_now in rollup_windows.items()]
+
+
+def setup_influxdb_rollups(json_path='', customer_name=None,
+                           print_only=False, timeout=None):
+    """
+        print_only: print the rollup queries without sending them
+        timeout: max seconds of every request (None: no limit)
+        return: error level of the setup, unknown if a query failed
+    """
+    customer_names = [customer_name] if customer_name else None
+    setup_result = error_level['OK']
+    for ip, port, database, rollup_queries in \
+            get_check_map_rollup_queries(json_path, customer_names):
+        if print_only:
+            print('\n'.join(['{0};'.format(rollup_query)
+                             for rollup_query in rollup_queries]))
+            continue
+        try:
+            influxdb_results = request_influxdb(
+                ip, port, database, rollup_queries, timeout=timeout,
+                post=True)['results']
+        except influxdb_errors as influxdb_error:
+            influxdb_results = [{'error': str(influxdb_error)}] * \
+                len(rollup_queries)
+        for rollup_query, influxdb_result in zip(rollup_queries,
+                                                 influxdb_results):
+            rollup_result = error_level['OK']
+            if 'error' in influxdb_result:
+                rollup_result = error_level['UNKNOWN']
+                setup_result = rollup_result
+            print('[ {0} | {1}:{2} | {3} | {4} ]'.format(
+                get_error_label(rollup_result), ip, port, database,
+                influxdb_result.get('error', rollup_query)))
+    return setup_result
+
+
+def load_check_statuses(status_path, status_age, json_path=''):
+    """
+        status_path: json file saved by the daemon mode
+        status_age: max age in seconds of the check results to trust
+        json_path: check map the results must come from
+        return: {<customer_name>: <check_status>} or {} when stale or
+                saved from another check map
+    """
+    try:
+        status_file = open(status_path)
+        check_status = json.load(status_file)
+        status_file.close()
+    except (IOError, ValueError):
+        return {}
+    if time.time() - check_status.get('status_time', 0) > status_age:
+        return {}
+    if check_status.get('file_hash') != \
+            get_check_map_index(json_path).file_hash:
+        return {}
+    return check_status.get('customers', {})
+
+
 def get_influxdb_data(ip, database, measure, seconds_from_now, port='8086',
-                      features=None, feature_filter=None, feature_order='desc'):
+                      features=None, feature_filter=None, feature_order='desc',
+                      feature_filters=None, feature_groups=None,
+                      feature_limit=None, time_from=None, timeout=None,
+                      epoch='s'):
     """
         database: '<influxdb_database_name>'
+        timeout: seconds to wait for influxdb (None: no limit)
+        epoch: 's' (epoch seconds) or None (rfc3339 timestamps)
+        see get_influxdb_query
+    """
+    influxdb_query = get_influxdb_query(measure=measure,
+                                        seconds_from_now=seconds_from_now,
+                                        features=features,
+                                        feature_filter=feature_filter,
+                                        feature_order=feature_order,
+                                        feature_filters=feature_filters,
+                                        feature_groups=feature_groups,
+                                        feature_limit=feature_limit,
+                                        time_from=time_from)
+    influxdb_response = query_influxdb(ip, port, database, [influxdb_query],
+                                       epoch=epoch, timeout=timeout)
+    # print(influxdb_response)
+    # print_influxdb_data(influxdb_response)
+    return influxdb_response
+
+
+def get_influxdb_data_async(event_loop, ip, database, measure,
+                            seconds_from_now, port='8086', features=None,
+                            feature_filter=None, feature_order='desc',
+                            feature_filters=None, feature_groups=None,
+                            feature_limit=None, time_from=None, timeout=None,
+                            epoch='s'):
+    """
+        event_loop: InfluxDBEventLoop sending the query
+        return: QueryFuture of the influxdb response
+        see get_influxdb_data
+    """
+    influxdb_query = get_influxdb_query(measure=measure,
+                                        seconds_from_now=seconds_from_now,
+                                        features=features,
+                                        feature_filter=feature_filter,
+                                        feature_order=feature_order,
+                                        feature_filters=feature_filters,
+                                        feature_groups=feature_groups,
+                                        feature_limit=feature_limit,
+                                        time_from=time_from)
+    return query_influxdb_async(event_loop, ip, port, database,
+                                [influxdb_query], epoch=epoch,
+                                timeout=timeout)
+
+
+def get_influxdb_query(measure, seconds_from_now, features=None,
+                       feature_filter=None, feature_order='desc',
+                       feature_filters=None, feature_groups=None,
+                       feature_limit=None, time_from=None, time_to=None,
+                       time_to_included=False, feature_offset=None):
+    """
         measure: '<influxdb_measurement_name>'
         features: [<list_of_features_to_fetch>]
         feature_filter: {<dict_of_features_and_their_values_to_filter_in>}
         feature_order: 'asc' or 'desc'
+        feature_filters: [<list_of_feature_filter_dicts_to_filter_in_any>]
+        feature_groups: [<list_of_tags_to_group_series_by>]
+        feature_limit: <max_number_of_points_to_fetch_per_series>
+        time_from: <epoch_seconds_after_which_to_fetch>, instead of
+                   seconds_from_now
+        time_to: <epoch_seconds_before_which_to_fetch>, instead of now
+        time_to_included: fetch the points of the time_to second too
+        feature_offset: <number_of_latest_points_to_skip_per_series>
     """
-    influxdb_base_url = 'http://{0}:{1}/query'.format(ip, port)
     if features is None:
         features = ['*']
     influxdb_query_features = 'SELECT ' + ', '.join(features)
     influxdb_query_measure = 'FROM {0}'.format(measure)
-    influxdb_query_selection = 'WHERE time > now() - {0}s ' \
-                               'AND time < now()'.format(seconds_from_now)
+    if time_from:
+        influxdb_query_selection = 'WHERE time > {0}s '.format(
+            int(time_from))
+    else:
+        influxdb_query_selection = 'WHERE time > now() - {0}s '.format(
+            seconds_from_now)
+    if time_to:
+        influxdb_query_selection += 'AND time {0} {1}s'.format(
+            '<=' if time_to_included else '<', int(time_to))
+    else:
+        influxdb_query_selection += 'AND time < now()'
     if feature_filter:
         feature_filter_influxdb_format = ["{0} = '{1}'".format(
             feature_name, feature_value)
@@ -361,23 +3743,407 @@ def get_influxdb_data(ip, database, measure, seconds_from_now, port='8086',
             in feature_filter.items()]
         influxdb_query_selection += ' AND ' + ' AND '.join(
             feature_filter_influxdb_format)
+    if feature_filters:
+        feature_filters_influxdb_format = ['(' + ' AND '.join([
+            "{0} = '{1}'".format(feature_name, feature_value)
+            for feature_name, feature_value
+            in sorted(any_feature_filter.items())]) + ')'
+            for any_feature_filter in feature_filters]
+        influxdb_query_selection += ' AND (' + ' OR '.join(
+            feature_filters_influxdb_format) + ')'
+    influxdb_query_group = ''
+    if feature_groups:
+        influxdb_query_group = 'GROUP BY ' + ', '.join(feature_groups)
     influxdb_query_order = 'ORDER BY time '
     if feature_order == 'asc':
         influxdb_query_order += 'ASC'
     elif feature_order == 'desc':
         influxdb_query_order += 'DESC'
     influxdb_query = ' '.join([influxdb_query_features, influxdb_query_measure,
-                               influxdb_query_selection, influxdb_query_order])
-    influxdb_query_url = urllib.urlencode({'q': influxdb_query,
-                                           'db': database})
-    influxdb_request = '{0}?{1}'.format(influxdb_base_url, influxdb_query_url)
-    # print(influxdb_request)
-    influxdb_response = json.load(urllib2.urlopen(influxdb_request))
-    # print(influxdb_response)
-    # print_influxdb_data(influxdb_response)
+                               influxdb_query_selection])
+    if influxdb_query_group:
+        influxdb_query += ' ' + influxdb_query_group
+    influxdb_query += ' ' + influxdb_query_order
+    if feature_limit:
+        influxdb_query += ' LIMIT {0}'.format(feature_limit)
+    if feature_offset:
+        influxdb_query += ' OFFSET {0}'.format(feature_offset)
+    return influxdb_query
+
+
+def query_influxdb(ip, port, database, influxdb_queries, epoch=None,
+                   timeout=None):
+    """
+        influxdb_queries: [<list_of_influxql_statements_to_send_at_once>]
+        epoch: None (rfc3339 timestamps) or 's' (epoch seconds)
+        timeout: seconds to wait for every socket operation (None: no
+                 limit)
+        return: influxdb response, one 'results' item per statement,
+                the statements sent in the last cache ttl seconds being
+                neither sent nor waited for twice
+    """
+    if not influxdb_query_cache.max_size:
+        return request_influxdb(ip, port, database, influxdb_queries, epoch,
+                                timeout)
+    cache_keys = [influxdb_query_cache.get_cache_key(ip, port, database,
+                                                     influxdb_query, epoch)
+                  for influxdb_query in influxdb_queries]
+    influxdb_results = [None] * len(influxdb_queries)
+    while None in influxdb_results:
+        fetch_indexes, pending_events = influxdb_query_cache.claim_results(
+            cache_keys, influxdb_results)
+        if fetch_indexes:
+            fetch_results = [None] * len(fetch_indexes)
+            try:
+                influxdb_response = request_influxdb(
+                    ip, port, database,
+                    [influxdb_queries[fetch_index]
+                     for fetch_index in fetch_indexes],
+                    epoch, timeout)
+                for result_index, influxdb_result in enumerate(
+                        influxdb_response['results'][:len(fetch_results)]):
+                    fetch_results[result_index] = influxdb_result
+            finally:
+                influxdb_query_cache.set_results(
+                    [cache_keys[fetch_index]
+                     for fetch_index in fetch_indexes], fetch_results)
+            for fetch_index, influxdb_result in zip(fetch_indexes,
+                                                    fetch_results):
+                influxdb_results[fetch_index] = influxdb_result
+        for pending_event in pending_events:
+            pending_event.wait(timeout)
+    return {'results': [dict(influxdb_result, statement_id=statement_id)
+                        for statement_id, influxdb_result
+                        in enumerate(influxdb_results)]}
+
+
+def get_influxdb_request(database, influxdb_queries, epoch=None,
+                         chunk_size=None, post=False):
+    """
+        chunk_size: number of points of every chunk (None: not chunked)
+        post: send a form post whatever the url length, as the statements
+              writing to influxdb require
+        return: (method, url, body, headers) of the /query request, a
+                form post when the url would be too long
+    """
+    request_key = (database, tuple(influxdb_queries), epoch, chunk_size,
+                   post)
+    influxdb_request = influxdb_query_plan.get_request(request_key)
+    if influxdb_request is not None:
+        return influxdb_request
+    influxdb_query_params = {'q': ';'.join(influxdb_queries),
+                             'db': database}
+    if chunk_size:
+        influxdb_query_params['chunked'] = 'true'
+        influxdb_query_params['chunk_size'] = chunk_size
+    if epoch:
+        influxdb_query_params['epoch'] = epoch
+    influxdb_query_url = urllib.urlencode(influxdb_query_params)
+    if not post and len(influxdb_query_url) <= influxdb_max_url_length:
+        influxdb_request = ('GET', '/query?{0}'.format(influxdb_query_url),
+                            None, {})
+    else:
+        influxdb_request = ('POST', '/query', influxdb_query_url, {
+            'Content-Type': 'application/x-www-form-urlencoded'})
+    influxdb_query_plan.set_request(request_key, influxdb_request)
+    return influxdb_request
+
+
+def parse_influxdb_response(influxdb_response_body):
+    """
+        return: the influxdb response, InvalidResponse being raised if it
+                is not a json object holding the 'results'
+    """
+    try:
+        influxdb_response = json.loads(influxdb_response_body)
+    except ValueError as parse_error:
+        raise InvalidResponse(reason=str(parse_error))
+    if not isinstance(influxdb_response, dict) or \
+            not isinstance(influxdb_response.get('results'), list):
+        raise InvalidResponse(reason="no 'results'")
+    return influxdb_response
+
+
+def request_influxdb(ip, port, database, influxdb_queries, epoch=None,
+                     timeout=None, post=False):
+    """
+        post: send the statements in a form post
+        see query_influxdb, sending every statement
+    """
+    method, url, body, headers = get_influxdb_request(
+        database, influxdb_queries, epoch, post=post)
+    request_timing = {}
+    influxdb_response_body = influxdb_connection_pool.request(
+        ip, port, method, url, body, headers, request_timing=request_timing,
+        timeout=timeout)
+    parse_start = time.time()
+    influxdb_response = parse_influxdb_response(influxdb_response_body)
+    request_timing['parse_time'] = time.time() - parse_start
+    influxdb_query_timings.add_timing(ip, port, database, influxdb_queries,
+                                      request_timing)
     return influxdb_response
 
 
+def stream_influxdb(ip, port, database, influxdb_query, chunk_size=10000,
+                    epoch=None, timeout=None):
+    """
+        influxdb_query: influxql statement, its points sent in chunks
+        timeout: seconds to wait for every socket operation (None: no
+                 limit)
+        yield: influxdb result of every chunk, as soon as it is read
+    """
+    method, url, body, headers = get_influxdb_request(
+        database, [influxdb_query], epoch, chunk_size)
+    request_timing = {'parse_time': 0.0}
+    influxdb_response_lines = influxdb_connection_pool.request_lines(
+        ip, port, method, url, body, headers, request_timing=request_timing,
+        timeout=timeout)
+    try:
+        for influxdb_response_line in influxdb_response_lines:
+            parse_start = time.time()
+            influxdb_results = parse_influxdb_response(
+                influxdb_response_line)['results']
+            request_timing['parse_time'] += time.time() - parse_start
+            for influxdb_result in influxdb_results:
+                yield influxdb_result
+    finally:
+        influxdb_response_lines.close()
+        influxdb_query_timings.add_timing(ip, port, database,
+                                          [influxdb_query], request_timing)
+
+
+def query_influxdb_async(event_loop, ip, port, database, influxdb_queries,
+                         epoch=None, timeout=None):
+    """
+        event_loop: InfluxDBEventLoop sending the request
+        return: QueryFuture of the influxdb response, one 'results' item
+                per statement, the statements sent in the last cache ttl
+                seconds being not sent twice
+        see query_influxdb
+    """
+    if not influxdb_query_cache.max_size:
+        return send_influxdb_queries_async(event_loop, ip, port, database,
+                                           influxdb_queries, epoch, timeout)
+    cache_keys = [influxdb_query_cache.get_cache_key(ip, port, database,
+                                                     influxdb_query, epoch)
+                  for influxdb_query in influxdb_queries]
+    influxdb_results = [None] * len(influxdb_queries)
+    fetch_indexes = influxdb_query_cache.get_results(cache_keys,
+                                                     influxdb_results)
+    query_future = QueryFuture()
+
+    def set_influxdb_results(fetch_future):
+        fetch_results = [None] * len(fetch_indexes)
+        if fetch_future is not None and fetch_future.error is None:
+            for result_index, influxdb_result in enumerate(
+                    fetch_future.result['results'][:len(fetch_results)]):
+                fetch_results[result_index] = influxdb_result
+        if fetch_future is not None:
+            influxdb_query_cache.set_results(
+                [cache_keys[fetch_index] for fetch_index in fetch_indexes],
+                fetch_results)
+            if fetch_future.error is not None:
+                query_future.set_error(fetch_future.error)
+                return
+        for fetch_index, influxdb_result in zip(fetch_indexes,
+                                                fetch_results):
+            # a statement without result, as influxdb tells no more
+            influxdb_results[fetch_index] = influxdb_result if \
+                influxdb_result is not None else {'error': 'no result'}
+        query_future.set_result({'results': [
+            dict(influxdb_result, statement_id=statement_id)
+            for statement_id, influxdb_result
+            in enumerate(influxdb_results)]})
+
+    if not fetch_indexes:
+        set_influxdb_results(None)
+    else:
+        send_influxdb_queries_async(
+            event_loop, ip, port, database,
+            [influxdb_queries[fetch_index] for fetch_index in fetch_indexes],
+            epoch, timeout).add_done_callback(set_influxdb_results)
+    return query_future
+
+
+def send_influxdb_queries_async(event_loop, ip, port, database,
+                                influxdb_queries, epoch=None, timeout=None):
+    """
+        return: QueryFuture of the influxdb response, shared by the
+                queries of the same statements while in flight
+        see query_influxdb_async
+    """
+    query_key = (ip, str(port), database, epoch,
+                 ';'.join([' '.join(influxdb_query.split())
+                           for influxdb_query in influxdb_queries]))
+    query_future = event_loop.pending_queries.get(query_key)
+    if query_future is not None:
+        return query_future
+    query_future = QueryFuture()
+    event_loop.pending_queries[query_key] = query_future
+    method, url, body, headers = get_influxdb_request(database,
+                                                      influxdb_queries, epoch)
+
+    def set_influxdb_response(request_future):
+        event_loop.pending_queries.pop(query_key, None)
+        if request_future.error is not None:
+            query_future.set_error(request_future.error)
+            return
+        influxdb_response_body, request_timing = request_future.result
+        parse_start = time.time()
+        try:
+            influxdb_response = parse_influxdb_response(
+                influxdb_response_body)
+        except InvalidResponse as parse_error:
+            query_future.set_error(parse_error)
+            return
+        request_timing['parse_time'] = time.time() - parse_start
+        influxdb_query_timings.add_timing(ip, port, database,
+                                          influxdb_queries, request_timing)
+        query_future.set_result(influxdb_response)
+
+    event_loop.request(ip, port, method, url, body, headers,
+                       timeout).add_done_callback(set_influxdb_response)
+    return query_future
+
+
+def pack_influxdb_queries(influxdb_queries, pack_size=1, pack_bytes=0):
+    """
+        influxdb_queries: [<list_of_influxql_statements>]
+        pack_size: max number of statements in one request
+        pack_bytes: max length of the statements in one request (0: none)
+        return: [<list_of_packs_of_statement_indexes>]
+    """
+    query_packs = []
+    query_pack = []
+    query_pack_bytes = 0
+    for query_index, influxdb_query in enumerate(influxdb_queries):
+        query_bytes = len(influxdb_query) + 1
+        if query_pack and (len(query_pack) >= pack_size or (
+                pack_bytes and query_pack_bytes + query_bytes > pack_bytes)):
+            query_packs.append(query_pack)
+            query_pack = []
+            query_pack_bytes = 0
+        query_pack.append(query_index)
+        query_pack_bytes += query_bytes
+    if query_pack:
+        query_packs.append(query_pack)
+    return query_packs
+
+
+def get_request_timeout(request_timeout=None, deadline=None):
+    """
+        request_timeout: max seconds of one request (None: no limit)
+        deadline: epoch seconds when the run has to be over (None: none)
+        return: seconds left to the request, raising QuerySkipped once
+                the deadline is over
+    """
+    if deadline is None:
+        return request_timeout
+    deadline_timeout = deadline - time.time()
+    if deadline_timeout <= 0:
+        raise QuerySkipped(reason='run deadline reached')
+    if request_timeout is None:
+        return deadline_timeout
+    return min(request_timeout, deadline_timeout)
+
+
+def run_feature_queries(ip, port, database, feature_queries, pack_size=1,
+                        pack_bytes=0, chunk_size=10000, epoch='s',
+                        request_timeout=None, deadline=None):
+    """
+        feature_queries: [<list_of_feature_queries_on_the_same_database>]
+        request_timeout: max seconds of every request (None: no limit)
+        deadline: epoch seconds when the run has to be over (None: none)
+        return: feature_queries, every one of them done
+    """
+    for feature_query in feature_queries:
+        if feature_query.check_mode == 'stream':
+            # one request each: stopping early drops its connection
+            feature_query.set_result_chunks(stream_influxdb(
+                ip, port, database, feature_query.get_query(), chunk_size,
+                epoch, get_request_timeout(request_timeout, deadline)))
+    pending_feature_queries = [feature_query
+                               for feature_query in feature_queries
+                               if not feature_query.is_done()]
+    while pending_feature_queries:
+        influxdb_queries = [feature_query.get_query()
+                            for feature_query in pending_feature_queries]
+        for query_pack in pack_influxdb_queries(influxdb_queries, pack_size,
+                                                pack_bytes):
+            influxdb_response = query_influxdb(
+                ip, port, database,
+                [influxdb_queries[query_index] for query_index in query_pack],
+                epoch, get_request_timeout(request_timeout, deadline))
+            for query_index, influxdb_result in zip(
+                    query_pack, influxdb_response['results']):
+                pending_feature_queries[query_index].set_result(
+                    influxdb_result)
+        pending_feature_queries = [feature_query
+                                   for feature_query in pending_feature_queries
+                                   if not feature_query.is_done()]
+    return feature_queries
+
+
+def run_feature_queries_async(event_loop, ip, port, database,
+                              feature_queries, pack_size=1, pack_bytes=0,
+                              epoch='s', request_timeout=None,
+                              deadline=None):
+    """
+        event_loop: InfluxDBEventLoop sending the queries, the packs of
+                    every query stage at the same time, with the time
+                    left to deadline
+        return: QueryFuture of feature_queries, set once every one of
+                them is done; 'stream' ones are fetched in one response
+        see run_feature_queries
+    """
+    queries_future = QueryFuture()
+
+    def query_stage():
+        pending_feature_queries = [feature_query
+                                   for feature_query in feature_queries
+                                   if not feature_query.is_done()]
+        if not pending_feature_queries:
+            queries_future.set_result(feature_queries)
+            return
+        try:
+            timeout = get_request_timeout(request_timeout, deadline)
+        except QuerySkipped as query_skipped:
+            queries_future.set_error(query_skipped)
+            return
+        influxdb_queries = [feature_query.get_query()
+                            for feature_query in pending_feature_queries]
+        query_packs = pack_influxdb_queries(influxdb_queries, pack_size,
+                                            pack_bytes)
+        query_packs_left = [len(query_packs)]
+
+        def set_pack_results(query_pack, pack_future):
+            if queries_future.done:
+                return
+            try:
+                influxdb_response = pack_future.get_result()
+                for query_index, influxdb_result in zip(
+                        query_pack, influxdb_response['results']):
+                    pending_feature_queries[query_index].set_result(
+                        influxdb_result)
+            except influxdb_errors as query_error:
+                queries_future.set_error(query_error)
+                return
+            query_packs_left[0] -= 1
+            if not query_packs_left[0]:
+                query_stage()
+
+        for query_pack in query_packs:
+            query_influxdb_async(
+                event_loop, ip, port, database,
+                [influxdb_queries[query_index] for query_index in query_pack],
+                epoch, timeout).add_done_callback(
+                lambda pack_future, query_pack=query_pack:
+                set_pack_results(query_pack, pack_future))
+
+    query_stage()
+    return queries_future
+
+
 def print_influxdb_data(influxdb_data):
     if 'series' in influxdb_data['results'][0].keys():
         # if 'values' in influxdb_data['results'][0]['series'][0].keys():
@@ -392,45 +4158,139 @@ def print_influxdb_data(influxdb_data):
         return False
 
 
-def check_feature_availability(ip, port, database, measure, host, testcase,
-                               transaction, feature_name, measure_unit,
-                               sanity_period):
-    feature_filter = {'host': host, 'test_name': testcase,
-                      'transaction_name': transaction}
+def get_seconds_from_now(measure_unit, sanity_period):
     seconds_converter = {'seconds': 1, 'minutes': 60, 'hours': 60*60,
                          'days': 60*60*24}
-    seconds_from_now = sanity_period * seconds_converter[measure_unit]
-    features = ['time', 'host', 'test_name', 'transaction_name', 'performance',
-                'warning_threshold', 'critical_threshold', 'state']
-    influxdb_response = get_influxdb_data(ip=ip, port=port,
-                                          database=database,
-                                          measure=measure,
-                                          seconds_from_now=seconds_from_now,
-                                          features=features,
-                                          feature_filter=feature_filter,
-                                          feature_order='desc')
-    # print(influxdb_response)
-    # print_influxdb_data(influxdb_response)
-    if 'series' in influxdb_response['results'][0].keys():
-        influxdb_response_features = influxdb_response[
-            'results'][0]['series'][0]['columns']
-        # print(influxdb_response_features)
-    else:
+    return sanity_period * seconds_converter[measure_unit]
+
+
+def check_feature_availability(ip, port, database, measure, host, testcase,
+                               transaction, feature_name, measure_unit,
+                               sanity_period, check_mode='fetch',
+                               availability_mode='at_least_one_ok',
+                               availability_warning=None,
+                               availability_critical=None):
+    """
+        check_mode: 'fetch' (every point of the sanity period),
+                    'pushdown' (let influxdb look for the 'ok' point),
+                    'stream' (read points in chunks until the 'ok' one)
+                    or 'rollup' (count the 'ok' points of the per minute
+                    rollup, then as 'pushdown' for the series without)
+        availability_mode: 'at_least_one_ok', 'availability_ratio',
+                           'longest_outage' or 'last_failures'
+        availability_warning: metric threshold of the warning result
+        availability_critical: metric threshold of the critical result
+    """
+    feature_query = FeatureAvailabilityQuery(
+        measure=measure, series_names=[(host, testcase, transaction)],
+        feature_name=feature_name, measure_unit=measure_unit,
+        sanity_period=sanity_period, check_mode=check_mode,
+        availability_mode=availability_mode,
+        availability_warning=availability_warning,
+        availability_critical=availability_critical)
+    run_feature_queries(ip, port, database, [feature_query])
+    return feature_query.get_check_results()[0]
+
+
+def check_features_availability(ip, port, database, measure, series_names,
+                                feature_name, measure_unit, sanity_period,
+                                check_mode='fetch',
+                                availability_mode='at_least_one_ok',
+                                availability_warning=None,
+                                availability_critical=None):
+    """
+        series_names: [<list_of_(host, testcase, transaction)_to_check>]
+        return: [<list_of_check_results_in_series_names_order>]
+    """
+    feature_query = FeatureAvailabilityQuery(
+        measure=measure, series_names=series_names,
+        feature_name=feature_name, measure_unit=measure_unit,
+        sanity_period=sanity_period, check_mode=check_mode,
+        series_grouped=True, availability_mode=availability_mode,
+        availability_warning=availability_warning,
+        availability_critical=availability_critical)
+    run_feature_queries(ip, port, database, [feature_query])
+    return feature_query.get_check_results()
+
+
+def check_feature_availability_async(event_loop, ip, port, database, measure,
+                                     host, testcase, transaction,
+                                     feature_name, measure_unit,
+                                     sanity_period, check_mode='fetch',
+                                     availability_mode='at_least_one_ok',
+                                     availability_warning=None,
+                                     availability_critical=None):
+    """
+        event_loop: InfluxDBEventLoop sending the queries
+        return: QueryFuture of the check result
+        see check_feature_availability
+    """
+    feature_query = FeatureAvailabilityQuery(
+        measure=measure, series_names=[(host, testcase, transaction)],
+        feature_name=feature_name, measure_unit=measure_unit,
+        sanity_period=sanity_period, check_mode=check_mode,
+        availability_mode=availability_mode,
+        availability_warning=availability_warning,
+        availability_critical=availability_critical)
+    check_future = QueryFuture()
+
+    def set_check_result(queries_future):
+        if queries_future.error is not None:
+            check_future.set_error(queries_future.error)
+        else:
+            check_future.set_result(feature_query.get_check_results()[0])
+
+    run_feature_queries_async(event_loop, ip, port, database,
+                              [feature_query]).add_done_callback(
+        set_check_result)
+    return check_future
+
+
+def check_series_availability(influxdb_series, feature_name,
+                              series_times=None,
+                              availability_mode='at_least_one_ok',
+                              availability_warning=None,
+                              availability_critical=None):
+    return check_series_chunks_availability([influxdb_series], feature_name,
+                                            series_times, availability_mode,
+                                            availability_warning,
+                                            availability_critical)
+
+
+def check_series_chunks_availability(influxdb_series_chunks, feature_name,
+                                     series_times=None,
+                                     availability_mode='at_least_one_ok',
+                                     availability_warning=None,
+                                     availability_critical=None):
+    """
+        series_times: {} filled with the 'last_point' and 'last_ok'
+                      timestamps met by the check
+        availability_mode: availability_modes key
+    """
+    influxdb_series_chunks = iter(influxdb_series_chunks)
+    influxdb_series = next(influxdb_series_chunks, None)
+    if influxdb_series is None:
         # print('no results')
         return error_level['UNKNOWN']
-    if feature_name in influxdb_response_features:
-        timestamp_index = influxdb_response_features.index('time')
-        feature_index = influxdb_response_features.index(feature_name)
-        measure_points = influxdb_response[
-            'results'][0]['series'][0]['values']
-        check_sequence = []
-        for measure_point in measure_points:
-            # print(measure_point)
-            timestamp = measure_point[timestamp_index]
-            measure_state = measure_point[feature_index]
-            measure_check = 1 if measure_state == 'ok' else 0
-            check_sequence.append((measure_check, timestamp))
-        # print(availability_sequence)
+    influxdb_response_features = influxdb_series['columns']
+    # print(influxdb_response_features)
+    if feature_name in influxdb_response_features and \
+            availability_mode != 'at_least_one_ok':
+        measure_checks, timestamps = get_series_arrays(
+            itertools.chain([influxdb_series], influxdb_series_chunks),
+            feature_name)
+        if series_times is not None:
+            get_arrays_times(measure_checks, timestamps, series_times)
+        return check_availability_arrays(measure_checks, timestamps,
+                                         availability_mode,
+                                         availability_warning,
+                                         availability_critical)
+    elif feature_name in influxdb_response_features:
+        check_sequence = get_series_sequence(
+            itertools.chain([influxdb_series], influxdb_series_chunks),
+            feature_name)
+        if series_times is not None:
+            check_sequence = get_sequence_times(check_sequence, series_times)
         check = check_availability_sequence(check_sequence,
                                             'at_least_one_ok')
         # print(check)
@@ -440,13 +4300,218 @@ def check_feature_availability(ip, port, database, measure, host, testcase,
         return error_level['UNKNOWN']
 
 
-def check_availability_sequence(availability_sequence, availability_mode):
+def get_sequence_times(check_sequence, series_times):
+    series_times.setdefault('last_point', None)
+    series_times.setdefault('last_ok', None)
+    for (measure_check, timestamp) in check_sequence:
+        if series_times['last_point'] is None:
+            series_times['last_point'] = timestamp
+        if measure_check == 1 and series_times['last_ok'] is None:
+            series_times['last_ok'] = timestamp
+        yield (measure_check, timestamp)
+
+
+def get_series_sequence(influxdb_series_chunks, feature_name):
+    """
+        influxdb_series_chunks: iterator over the chunks of one series
+        yield: (measure_check, timestamp) of every measure point
+    """
+    for influxdb_series in influxdb_series_chunks:
+        influxdb_response_features = influxdb_series['columns']
+        timestamp_index = influxdb_response_features.index('time')
+        feature_index = influxdb_response_features.index(feature_name)
+        for measure_point in influxdb_series['values']:
+            # print(measure_point)
+            timestamp = measure_point[timestamp_index]
+            measure_state = measure_point[feature_index]
+            measure_check = 1 if measure_state == 'ok' else 0
+            yield (measure_check, timestamp)
+
+
+def import_numpy():
+    """
+        return: the numpy module, imported the first time an availability
+                mode needs it, None if not installed
+    """
+    global numpy, numpy_imported
+    if not numpy_imported:
+        try:
+            import numpy as numpy_module
+        except ImportError:
+            numpy_module = None
+        numpy = numpy_module
+        numpy_imported = True
+    return numpy
+
+
+def get_series_arrays(influxdb_series_chunks, feature_name):
+    """
+        influxdb_series_chunks: iterator over the chunks of one series
+        return: (measure_checks, timestamps) of every measure point, numpy
+                arrays when numpy is available, lists otherwise
+    """
+    import_numpy()
+    measure_checks = []
+    timestamps = []
+    for influxdb_series in influxdb_series_chunks:
+        influxdb_response_features = influxdb_series['columns']
+        timestamp_index = influxdb_response_features.index('time')
+        feature_index = influxdb_response_features.index(feature_name)
+        measure_points = influxdb_series['values']
+        if not measure_points:
+            continue
+        if numpy is not None:
+            measure_points = numpy.array(measure_points, dtype=object)
+            measure_checks.append(measure_points[:, feature_index] == 'ok')
+            timestamps.append(measure_points[:, timestamp_index])
+        else:
+            measure_checks.extend([measure_point[feature_index] == 'ok'
+                                   for measure_point in measure_points])
+            timestamps.extend([measure_point[timestamp_index]
+                               for measure_point in measure_points])
+    if numpy is not None:
+        if not measure_checks:
+            return numpy.zeros(0, dtype=bool), numpy.zeros(0, dtype=int)
+        return numpy.concatenate(measure_checks).astype(bool), \
+            numpy.concatenate(timestamps).astype(int)
+    return measure_checks, timestamps
+
+
+def get_arrays_times(measure_checks, timestamps, series_times):
+    series_times['last_point'] = None
+    series_times['last_ok'] = None
+    if len(timestamps):
+        series_times['last_point'] = int(timestamps[0])
+        last_ok_index = get_last_failures(measure_checks)
+        if last_ok_index < len(timestamps):
+            series_times['last_ok'] = int(timestamps[last_ok_index])
+    return series_times
+
+
+def get_availability_ratio(measure_checks):
+    """
+        return: percentage of 'ok' points
+    """
+    if numpy is not None:
+        return 100.0 * numpy.count_nonzero(measure_checks) / \
+            len(measure_checks)
+    return 100.0 * sum(measure_checks) / len(measure_checks)
+
+
+def get_longest_outage(measure_checks, timestamps):
+    """
+        measure_checks: latest point first, as timestamps
+        return: longest seconds from the first not 'ok' point of an outage
+                to the 'ok' point ending it, or to the latest point
+    """
+    if numpy is not None:
+        # oldest point first: +1 where an outage starts, -1 where it ends
+        outage_edges = numpy.diff(numpy.concatenate((
+            [0], numpy.logical_not(measure_checks[::-1]).astype(int), [0])))
+        outage_starts = numpy.flatnonzero(outage_edges == 1)
+        if not len(outage_starts):
+            return 0
+        outage_ends = numpy.minimum(numpy.flatnonzero(outage_edges == -1),
+                                    len(timestamps) - 1)
+        ascending_timestamps = timestamps[::-1]
+        return int(numpy.max(ascending_timestamps[outage_ends] -
+                             ascending_timestamps[outage_starts]))
+    longest_outage = 0
+    outage_start = None
+    for measure_check, timestamp in zip(reversed(measure_checks),
+                                        reversed(timestamps)):
+        if not measure_check and outage_start is None:
+            outage_start = timestamp
+        elif measure_check and outage_start is not None:
+            longest_outage = max(longest_outage, timestamp - outage_start)
+            outage_start = None
+    if outage_start is not None:
+        longest_outage = max(longest_outage, timestamps[0] - outage_start)
+    return longest_outage
+
+
+def get_last_failures(measure_checks):
+    """
+        measure_checks: latest point first
+        return: number of not 'ok' points before the latest 'ok' one
+    """
+    if numpy is not None:
+        ok_indexes = numpy.flatnonzero(measure_checks)
+        return int(ok_indexes[0]) if len(ok_indexes) else len(measure_checks)
+    for measure_index, measure_check in enumerate(measure_checks):
+        if measure_check:
+            return measure_index
+    return len(measure_checks)
+
+
+def get_availability_metric(measure_checks, timestamps, availability_mode):
+    if availability_mode == 'availability_ratio':
+        return get_availability_ratio(measure_checks)
+    elif availability_mode == 'longest_outage':
+        return get_longest_outage(measure_checks, timestamps)
+    elif availability_mode == 'last_failures':
+        return get_last_failures(measure_checks)
+
+
+def check_availability_arrays(measure_checks, timestamps, availability_mode,
+                              availability_warning=None,
+                              availability_critical=None):
+    """
+        availability_warning: metric threshold reached by warning checks
+        availability_critical: metric threshold reached by critical checks
+    """
+    if availability_mode not in availability_modes or \
+            not len(measure_checks):
+        return error_level['UNKNOWN']
+    availability_thresholds = availability_modes[availability_mode]
+    if availability_warning is None:
+        availability_warning = availability_thresholds[
+            'availability_warning']
+    if availability_critical is None:
+        availability_critical = availability_thresholds[
+            'availability_critical']
+    availability_metric = get_availability_metric(
+        measure_checks, timestamps, availability_mode)
+    if availability_thresholds['lower_is_worse']:
+        availability_metric = -availability_metric
+        availability_warning = -availability_warning
+        availability_critical = -availability_critical
+    if availability_metric >= availability_critical:
+        return error_level['CRITICAL']
+    elif availability_metric >= availability_warning:
+        return error_level['WARNING']
+    return error_level['OK']
+
+
+def check_availability_sequence(availability_sequence, availability_mode,
+                                availability_warning=None,
+                                availability_critical=None):
     if availability_mode == 'at_least_one_ok':
         # print(availability_sequence)
         for (measure_check, timestamp) in availability_sequence:
             if measure_check == 1:
                 return error_level['OK']
         return error_level['CRITICAL']
+    measure_checks = []
+    timestamps = []
+    for (measure_check, timestamp) in availability_sequence:
+        measure_checks.append(measure_check == 1)
+        timestamps.append(timestamp)
+    if import_numpy() is not None:
+        measure_checks = numpy.array(measure_checks, dtype=bool)
+        timestamps = numpy.array(timestamps, dtype=int)
+    return check_availability_arrays(measure_checks, timestamps,
+                                     availability_mode, availability_warning,
+                                     availability_critical)
+
+
+def get_check_line(check):
+    check_line = '[ {0} '.format(get_error_label(check.check_result))
+    check_line += '| {0} '.format(check.check_name)
+    for feature in check.get_check_features():
+        check_line += '| {0} '.format(feature)
+    check_line += ']'
+    return check_line
 
 
 def get_error_label(error_code):
@@ -457,18 +4522,104 @@ def get_error_label(error_code):
             return error_label
 
 
-def check_customer_influxdb_checks(customer, json_path='', verbose=1):
+def check_customer_influxdb_checks(customer, json_path='', verbose=1,
+                                   engine=None, check_statuses=None,
+                                   stats_path='', plan_cache=False):
+    """
+        plan_cache: reuse the queries of the previous runs of the customer
+                    (see QueryPlan)
+    """
+    check_status = check_statuses.get(customer) if check_statuses else None
+    if plan_cache:
+        load_query_plan(json_path, customer)
     cc = CustomerInfluxDBCheck(customer_name=customer,
                                json_path=json_path,
-                               verbose_level=verbose)
+                               verbose_level=verbose,
+                               engine=engine,
+                               check_status=check_status)
+    cc.run_checks()
+    step_start = time.time()
     print(cc)
+    startup_timings.add_timing('output', step_start)
+    if stats_path:
+        save_query_timings(stats_path, [cc])
+    if plan_cache:
+        save_query_plan()
     cc.exit_check_result()
 
 
-def check_customers_influxdb_checks(json_path='', verbose=1):
-    csc = CustomersInfluxDBChecks(json_path=json_path,
-                                  verbose_level=verbose)
-    print(csc)
+def check_customers_influxdb_checks(json_path='', verbose=1, engine=None,
+                                    check_statuses=None, stats_path='',
+                                    shard=None, processes=1,
+                                    output_mode='text', plan_cache=False):
+    """
+        output_mode: 'text' (every customer printed once all are checked),
+                     'stream' or 'ndjson' (see CheckOutputStream)
+        plan_cache: reuse the queries of the previous runs of the same
+                    shard (see QueryPlan)
+    """
+    if plan_cache:
+        load_query_plan(json_path, shard)
+    output_stream = None
+    if output_mode != 'text':
+        output_stream = CheckOutputStream(output_mode, verbose)
+    customers_checks_args = {}
+    customers_checks_class = CustomersInfluxDBChecks
+    if processes > 1:
+        customers_checks_args['processes'] = processes
+        customers_checks_class = ShardedCustomersInfluxDBChecks
+    elif isinstance(engine, AsyncCheckEngine):
+        customers_checks_class = AsyncCustomersInfluxDBChecks
+    csc = customers_checks_class(json_path=json_path,
+                                 verbose_level=verbose,
+                                 engine=engine,
+                                 check_statuses=check_statuses,
+                                 shard=shard,
+                                 output_stream=output_stream,
+                                 **customers_checks_args)
+    csc.run_customers_checks()
+    if not output_stream:
+        step_start = time.time()
+        print(csc)
+        startup_timings.add_timing('output', step_start)
+    if stats_path:
+        save_query_timings(stats_path, csc.customers_checks)
+    if plan_cache:
+        save_query_plan()
+    if output_stream:
+        exit(output_stream.write_summary())
+
+
+def load_query_plan(json_path='', plan_scope=None):
+    step_start = time.time()
+    planned_statements = influxdb_query_plan.load_plan(json_path, plan_scope)
+    startup_timings.add_timing('query plan', step_start)
+    return planned_statements
+
+
+def save_query_plan():
+    step_start = time.time()
+    plan_saved = influxdb_query_plan.save_plan()
+    startup_timings.add_timing('query plan', step_start)
+    return plan_saved
+
+
+def print_startup_timings():
+    sys.stderr.write(repr(startup_timings))
+    return True
+
+
+def run_customers_influxdb_checks_daemon(json_path='', engine=None,
+                                         status_path='', min_period=60,
+                                         stats_path='', shard=None):
+    cs = CheckScheduler(json_path=json_path,
+                        engine=engine,
+                        status_path=status_path,
+                        min_period=min_period,
+                        stats_path=stats_path,
+                        shard=shard)
+    print(cs)
+    cs.run()
 
 
 def set_check_map():
@@ -535,6 +4686,8 @@ def set_check_map():
 
 
 def main():
+    step_start = time.time()
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--json_path',
                         help='set the json path of the check map')
@@ -543,20 +4696,223 @@ def main():
                              'influxdb data')
     parser.add_argument('-v', '--verbose_level',
                         help='verbose the check output')
+    parser.add_argument('-w', '--workers',
+                        help='set how many checks query influxdb '
+                             'at the same time')
+    parser.add_argument('-s', '--source_workers',
+                        help='set how many checks query the same '
+                             'influxdb data source at the same time')
+    parser.add_argument('-q', '--query_mode',
+                        help="set 'single' (one query per check) or "
+                             "'batch' (one query per measurement)")
+    parser.add_argument('--batch_size',
+                        help='set how many checks one batch query serves')
+    parser.add_argument('-m', '--check_mode',
+                        help="set 'fetch' (every point of the sanity "
+                             "period), 'pushdown' (let influxdb look "
+                             "for the 'ok' point), 'stream' (read "
+                             "points in chunks until the 'ok' one) or "
+                             "'rollup' (count the 'ok' points per minute "
+                             "of the rollup setup)")
+    parser.add_argument('--chunk_size',
+                        help="set how many points every chunk holds in "
+                             "'stream' check mode")
+    parser.add_argument('--max_rows',
+                        help='set how many points of every series one '
+                             'query fetches at most, the older ones '
+                             'fetched by the next queries until the check '
+                             'is decided (0: no limit)')
+    parser.add_argument('--pack_size',
+                        help='set how many queries to the same database '
+                             'are sent in one request')
+    parser.add_argument('--pack_bytes',
+                        help='set the max length of the queries sent in '
+                             'one request')
+    parser.add_argument('--pool_size',
+                        help='set how many idle connections are kept '
+                             'for each influxdb data source')
+    parser.add_argument('--pool_idle',
+                        help='set after how many seconds an idle '
+                             'connection is closed')
+    parser.add_argument('--state_path',
+                        help='set the json path of the state file, '
+                             'query only the points newer than the '
+                             'previous run')
+    parser.add_argument('--state_age',
+                        help='set after how many seconds a series state '
+                             'is forgotten')
+    parser.add_argument('-d', '--daemon', action='store_true',
+                        help='keep running the checks, saving their '
+                             'results in the status file')
+    parser.add_argument('--daemon_period',
+                        help='set the min seconds between two runs of '
+                             'the same check in daemon mode')
+    parser.add_argument('--status_path',
+                        help='set the json path of the status file, '
+                             'read the results from it if fresh')
+    parser.add_argument('--status_age',
+                        help='set after how many seconds the status file '
+                             'results are too old to be read')
+    parser.add_argument('--run_timeout',
+                        help='set the seconds every run has to be over in, '
+                             'the checks not queried by then being unknown')
+    parser.add_argument('--request_timeout',
+                        help='set the max seconds of every influxdb '
+                             'request')
+    parser.add_argument('--breaker_failures',
+                        help='set after how many consecutive failed '
+                             'requests the checks of an influxdb data '
+                             'source are unknown without querying it')
+    parser.add_argument('--breaker_reset',
+                        help='set after how many seconds a failing '
+                             'influxdb data source is queried again')
+    parser.add_argument('-a', '--async_checks', action='store_true',
+                        help='run the checks together on one event loop '
+                             'of non blocking connections')
+    parser.add_argument('--connections',
+                        help='set how many connections the event loop '
+                             'opens to each influxdb data source')
+    parser.add_argument('--processes',
+                        help='set how many processes share the customers '
+                             'to check')
+    parser.add_argument('--shard',
+                        help="set the 'i/N' shard of the customers to "
+                             "check, to share them among N hosts")
+    parser.add_argument('--cache_size',
+                        help='set how many query results are kept to be '
+                             'shared by the checks sending the same query')
+    parser.add_argument('--cache_ttl',
+                        help='set for how many seconds a query result is '
+                             'shared')
+    parser.add_argument('--stats_path',
+                        help='set the json path where the query timings '
+                             'are saved')
+    parser.add_argument('-o', '--output_mode',
+                        help="set 'text' (every customer printed once all "
+                             "are checked), 'stream' (every customer "
+                             "printed as soon as its checks are done, then "
+                             "a summary line) or 'ndjson' (one json line "
+                             "per customer, then the summary one)")
+    parser.add_argument('--rollup_setup', action='store_true',
+                        help="create the continuous queries counting the "
+                             "'ok' and total points per minute of every "
+                             "checked series, for the 'rollup' check mode")
+    parser.add_argument('--rollup_queries', action='store_true',
+                        help='print the queries of the rollup setup '
+                             'without sending them')
+    parser.add_argument('--plan_cache', action='store_true',
+                        help='save the queries of the run next to the json '
+                             'of the check map, to send them again without '
+                             'building them until the json changes')
+    parser.add_argument('--profile_startup', '--profile-startup',
+                        action='store_true',
+                        help='print on stderr the milliseconds spent by '
+                             'every step of the run, from the start of '
+                             'the interpreter')
 
     cli_args = sys.argv[1:]
     if cli_args:
         args = parser.parse_args()
+        if args.profile_startup:
+            import atexit
+            atexit.register(print_startup_timings)
         json_path = args.json_path if args.json_path else ''
         customer_name = args.customer_name if args.customer_name else False
         verbose_level = int(args.verbose_level) if args.verbose_level else 1
-        if customer_name:
+        workers = int(args.workers) if args.workers else 1
+        source_workers = int(args.source_workers) \
+            if args.source_workers else 0
+        pool_size = int(args.pool_size) if args.pool_size else None
+        pool_idle = int(args.pool_idle) if args.pool_idle else None
+        influxdb_connection_pool.configure(pool_size=pool_size,
+                                           idle_timeout=pool_idle)
+        cache_size = int(args.cache_size) if args.cache_size else None
+        cache_ttl = float(args.cache_ttl) if args.cache_ttl else None
+        influxdb_query_cache.configure(max_size=cache_size, ttl=cache_ttl)
+        query_mode = args.query_mode if args.query_mode else 'single'
+        batch_size = int(args.batch_size) if args.batch_size else 100
+        check_mode = args.check_mode if args.check_mode else 'fetch'
+        pack_size = int(args.pack_size) if args.pack_size else 1
+        pack_bytes = int(args.pack_bytes) if args.pack_bytes else 65536
+        chunk_size = int(args.chunk_size) if args.chunk_size else 10000
+        max_rows = int(args.max_rows) if args.max_rows else 10000
+        state_age = int(args.state_age) if args.state_age else 86400
+        check_states = CheckStateStore(args.state_path, state_age) \
+            if args.state_path else None
+        run_timeout = float(args.run_timeout) if args.run_timeout else 0
+        request_timeout = float(args.request_timeout) \
+            if args.request_timeout else 0
+        breaker_failures = int(args.breaker_failures) \
+            if args.breaker_failures else 3
+        breaker_reset = int(args.breaker_reset) if args.breaker_reset else 60
+        engine_args = {'query_mode': query_mode,
+                       'batch_size': batch_size,
+                       'check_mode': check_mode,
+                       'pack_size': pack_size,
+                       'pack_bytes': pack_bytes,
+                       'chunk_size': chunk_size,
+                       'max_rows': max_rows,
+                       'check_states': check_states,
+                       'run_timeout': run_timeout,
+                       'request_timeout': request_timeout,
+                       'breaker_failures': breaker_failures,
+                       'breaker_reset': breaker_reset}
+        if args.async_checks:
+            connections = int(args.connections) if args.connections else 64
+            engine = AsyncCheckEngine(connections=connections,
+                                      **engine_args)
+        else:
+            engine = CheckEngine(workers=workers,
+                                 source_workers=source_workers,
+                                 **engine_args)
+        status_path = args.status_path if args.status_path else ''
+        status_age = int(args.status_age) if args.status_age else 600
+        daemon_period = int(args.daemon_period) if args.daemon_period \
+            else 60
+        stats_path = args.stats_path if args.stats_path else ''
+        processes = int(args.processes) if args.processes else 1
+        output_mode = args.output_mode if args.output_mode else 'text'
+        shard = None
+        if args.shard:
+            shard = parse_shard(args.shard)
+            if shard is None:
+                parser.error("argument --shard: expected 'i/N', "
+                             "with 1 <= i <= N")
+        check_statuses = None
+        if status_path and not args.daemon:
+            check_statuses = load_check_statuses(status_path, status_age,
+                                                 json_path)
+        startup_timings.add_timing('arguments', step_start)
+        if args.rollup_setup or args.rollup_queries:
+            exit(setup_influxdb_rollups(json_path,
+                                        customer_name,
+                                        args.rollup_queries,
+                                        request_timeout or None))
+        elif args.daemon:
+            run_customers_influxdb_checks_daemon(json_path,
+                                                 engine,
+                                                 status_path,
+                                                 daemon_period,
+                                                 stats_path,
+                                                 shard)
+        elif customer_name:
             check_customer_influxdb_checks(customer_name,
                                            json_path,
-                                           verbose_level)
+                                           verbose_level,
+                                           engine,
+                                           check_statuses,
+                                           stats_path,
+                                           args.plan_cache)
         else:
             check_customers_influxdb_checks(json_path,
-                                            verbose_level)
+                                            verbose_level,
+                                            engine,
+                                            check_statuses,
+                                            stats_path,
+                                            shard,
+                                            processes,
+                                            output_mode,
+                                            args.plan_cache)
     else:
         # print(CustomerData('<customer_name>'))
         # print(CustomerInfluxDBData('<customer_name>'))